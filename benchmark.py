@@ -0,0 +1,242 @@
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+import numpy as np
+
+from lms200 import LmsScan, LMSPlotter, ScannerConfig, make_offline_slam, run_offline_slam
+from lms200.simulator import load_raw_scans, SickIOException
+from convert_old_log import LogParser, convert_log
+
+
+def best_of(repeat, function, *args):
+    """Run function repeat times, returns the shortest duration and the last result"""
+    durations = []
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = function(*args)
+        durations.append(time.perf_counter() - t0)
+    return min(durations), result
+
+
+def load_corpus(paths):
+    """Scans and scanner config of every log that has scans"""
+    corpus = []
+    for path in paths:
+        try:
+            scans, config = load_raw_scans(path)
+        except SickIOException:
+            continue  # logs recorded without the LMS200 running
+        corpus.append((path, scans, config))
+    return corpus
+
+
+def bench_lms_scan_parse(corpus, repeat):
+    lines = []
+    for _, scans, _ in corpus:
+        for n, scan in enumerate(scans):
+            lines.append(str(LmsScan(1500000000.0 + n * 0.2, n, 5.0, tuple(scan.tolist()))))
+    num_bytes = sum(len(line) for line in lines)
+
+    duration, _ = best_of(repeat, lambda: [LmsScan.parse(line) for line in lines])
+    return dict(scans=len(lines), seconds=duration, scans_per_s=len(lines) / duration,
+                mb_per_s=num_bytes / 1e6 / duration)
+
+
+def bench_log_parser(paths, repeat):
+    def parse_all():
+        num_records = 0
+        num_chars = 0
+        for path in paths:
+            log = LogParser(path, compressed=True)
+            for _ in log.records():
+                num_records += 1
+            num_chars += log.chars_read
+        return num_records, num_chars
+
+    def convert_all(output_directory):
+        for path in paths:
+            convert_log(path, output_directory)
+
+    parse_duration, (num_records, num_chars) = best_of(repeat, parse_all)
+
+    output_directory = tempfile.mkdtemp()
+    try:
+        convert_duration, _ = best_of(repeat, convert_all, output_directory)
+
+        # tracing slows everything down, peak memory gets a run of its own
+        tracemalloc.start()
+        convert_all(output_directory)
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        shutil.rmtree(output_directory)
+
+    return dict(logs=len(paths), records=num_records, mb=num_chars / 1e6,
+                parse_records_per_s=num_records / parse_duration, parse_mb_per_s=num_chars / 1e6 / parse_duration,
+                convert_mb_per_s=num_chars / 1e6 / convert_duration, convert_peak_bytes=peak_bytes)
+
+
+def bench_slam(corpus, deterministic, map_size_pixels, map_size_meters, max_scans, seed):
+    # scan matching depends on everything before it, a repeat is a new map from the start
+    num_scans = 0
+    duration = 0.0
+    slam = None
+    for path, scans, config in corpus:
+        scans = scans[:max_scans - num_scans]
+        if len(scans) == 0:
+            break
+        slam = make_offline_slam(scans.shape[1], config, map_size_pixels, map_size_meters, deterministic,
+                                 parameters=dict(random_seed=seed))
+        duration += run_offline_slam(slam, scans)
+        num_scans += len(scans)
+        slam.metrics.close()
+
+    return dict(scans=num_scans, seconds=duration, scans_per_s=num_scans / duration if duration > 0 else 0.0), slam
+
+
+def bench_make_image(slam, repeat):
+    directory = tempfile.mkdtemp()
+    results = {}
+    try:
+        for image_format in ("pgm", "png"):
+            path = os.path.join(directory, "map")
+            duration, _ = best_of(repeat, slam.make_image, path, image_format)
+            results[image_format + "_seconds"] = duration
+            results[image_format + "_bytes"] = os.path.getsize(path + "." + image_format)
+    finally:
+        shutil.rmtree(directory)
+    results["map_size_pixels"] = slam.map_size_pixels
+    return results
+
+
+def bench_point_cloud(corpus, repeat, batch_size=16):
+    _, scans, config = max(corpus, key=lambda entry: len(entry[1]))
+    plotter = LMSPlotter()
+    plotter.lms = ScannerConfig(config)
+    batches = [scans[start: start + batch_size] for start in range(0, len(scans), batch_size)]
+
+    single_duration, _ = best_of(repeat, lambda: [plotter.get_point_cloud(scan) for scan in scans])
+    batch_duration, _ = best_of(repeat, lambda: [plotter.get_point_clouds(list(batch)) for batch in batches])
+    return dict(scans=len(scans), scan_us=single_duration / len(scans) * 1e6,
+                batched_scan_us=batch_duration / len(scans) * 1e6)
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(python=platform.python_version(), numpy=np.__version__, platform=platform.platform(),
+                processor=platform.processor(), cpus=os.cpu_count(), commit=commit, time=time.time())
+
+
+def run_benchmarks(paths, benchmarks, repeat=3, map_size_pixels=800, map_size_meters=40, max_scans=500, seed=1):
+    results = {}
+
+    def report(name, result):
+        results[name] = result
+        print("%s: %s" % (name, ", ".join("%s=%0.4g" % item for item in result.items())))
+
+    corpus = load_corpus(paths)
+    if len(corpus) == 0:
+        raise ValueError("None of the %s logs have scans" % len(paths))
+
+    if "lms_scan_parse" in benchmarks:
+        report("lms_scan_parse", bench_lms_scan_parse(corpus, repeat))
+    if "log_parser" in benchmarks:
+        report("log_parser", bench_log_parser(paths, repeat))
+
+    slam = None
+    if "slam_rmhc" in benchmarks or "make_image" in benchmarks:
+        result, slam = bench_slam(corpus, False, map_size_pixels, map_size_meters, max_scans, seed)
+        if "slam_rmhc" in benchmarks:
+            report("slam_rmhc", result)
+    if "slam_deterministic" in benchmarks:
+        result, _ = bench_slam(corpus, True, map_size_pixels, map_size_meters, max_scans, seed)
+        report("slam_deterministic", result)
+    if "make_image" in benchmarks:
+        report("make_image", bench_make_image(slam, repeat))
+
+    if "point_cloud" in benchmarks:
+        report("point_cloud", bench_point_cloud(corpus, repeat))
+
+    return dict(
+        environment=environment(),
+        config=dict(logs=paths, repeat=repeat, map_size_pixels=map_size_pixels, map_size_meters=map_size_meters,
+                    max_scans=max_scans, seed=seed),
+        results=results,
+    )
+
+
+def metric_direction(name):
+    """1 if bigger is better, -1 if smaller is better, 0 if the metric only describes the run"""
+    if name.endswith("_per_s"):
+        return 1
+    if name.endswith(("_seconds", "_us", "_bytes")) or name == "seconds":
+        return -1
+    return 0
+
+
+def compare(results, baseline, tolerance):
+    """Every metric that got worse than the baseline by more than tolerance, as (name, baseline, now, change)"""
+    regressions = []
+    for benchmark, metrics in results["results"].items():
+        baseline_metrics = baseline["results"].get(benchmark, {})
+        for name, value in metrics.items():
+            direction = metric_direction(name)
+            previous = baseline_metrics.get(name)
+            if direction == 0 or not previous:
+                continue
+
+            change = (value - previous) / previous * direction
+            print("%-40s %12.4g %12.4g %+7.1f%%" % ("%s.%s" % (benchmark, name), previous, value, change * 100))
+            if change < -tolerance:
+                regressions.append(("%s.%s" % (benchmark, name), previous, value, change))
+    return regressions
+
+
+all_benchmarks = ("lms_scan_parse", "log_parser", "slam_rmhc", "slam_deterministic", "make_image", "point_cloud")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark parsing, conversion, SLAM and plotting on the recorded logs")
+    parser.add_argument("paths", nargs="*", help="logs to run on. Defaults to logs/*/*.log.xz")
+    parser.add_argument("-b", "--benchmarks", nargs="+", choices=all_benchmarks, default=all_benchmarks)
+    parser.add_argument("-o", "--output", help="write the results to this JSON file")
+    parser.add_argument("-c", "--compare", metavar="BASELINE", help="compare against an earlier results file")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.1,
+                        help="fraction a metric can get worse by before it counts as a regression")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="runs per benchmark, the fastest is kept")
+    parser.add_argument("--max-scans", type=int, default=500, help="scans SLAM is benchmarked on")
+    parser.add_argument("--seed", type=int, default=1, help="RMHC random seed")
+    args = parser.parse_args()
+
+    paths = args.paths or sorted(glob.glob(os.path.join("logs", "*", "*.log.xz")))
+    results = run_benchmarks(paths, args.benchmarks, args.repeat, max_scans=args.max_scans, seed=args.seed)
+
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=4)
+
+    if args.compare is not None:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print("%s regressions beyond %0.0f%%:" % (len(regressions), args.tolerance * 100))
+            for name, previous, value, change in regressions:
+                print("    %s: %0.4g -> %0.4g (%+0.1f%%)" % (name, previous, value, change * 100))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,29 @@
 import re
 import os
 import glob
+import json
 import time
+import hashlib
 import logging
+import argparse
 import datetime
 import lzma as xz
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from lms200.scanlog import ScanLogWriter, parse_config_flag, scan_log_extension, config_num_values
 
 
 class LogParser:
     """
-    Parse a log file to simulate how the robot behaved that day
+    Parse a log file to simulate how the robot behaved that day. Records are read from the (compressed) file
+    one line at a time and yielded by records(), so memory use is bounded by the longest record.
     """
 
     def __init__(self, file_name, directory="", compressed=False):
-        # regex string code. Logs follow a certain format. Parse out these pieces of info.
+        # regex string code. Every record starts with a line in this format. Lines that don't match
+        # belong to the message of the record before them.
         self.pattern = re.compile(
-            r"(((?P<name>[a-zA-Z0-9]*) @ "
+            r"(?P<header>\[(?P<name>[a-zA-Z0-9]*) @ "
             r"(?P<filename>.*\.py):"
             r"(?P<linenumber>[0-9]*)\]\["
             r"(?P<loglevelstr>[A-Z]*)\] "
@@ -26,37 +34,25 @@ class LogParser:
             r"(?P<minute>[0-9]*):"
             r"(?P<second>[0-9]*),"
             r"(?P<millisecond>[0-9]*): )"
-            r"(?P<message>([.\S\s]+?(\n\[))))"
+            r"(?P<message>.*)"
         )
 
         # info about the log file path
         self.file_name = file_name
         self.directory = directory
         self.full_path = os.path.join(self.directory, self.file_name)
+        self.compressed = compressed
 
         self.logged_streams = {}
         self.encountered_names = set()
 
-        # current line of the log we're on
+        # current record of the log we're on
         self.line_number = 0
         self.line = ""
-
-        self.prev_time = None
-
-        # decompress the log file
-        with open(self.full_path, 'rb') as log_file:
-            if compressed:
-                self.content = xz.decompress(log_file.read()).decode()
-            else:
-                self.content = log_file.read().decode()
-
-        # all pieces information in each line
-        self.matches = re.finditer(self.pattern, self.content)
-
-        self.lines = []
         self.start_index = 0
+        self.chars_read = 0
 
-        self.run()
+        self.prev_time = None
 
     def make_line_info(self):
         return dict(
@@ -65,42 +61,51 @@ class LogParser:
             message="", header="", full=""
         )
 
-    def find_start(self):
-        for match_num, match in enumerate(self.matches):
-            line_info = self.make_line_info()
-            self._post_match(line_info, match_num, match)
-            if line_info["name"] == "Robot" and \
-                            line_info["filename"] == "robot.py" and \
-                            line_info["loglevel"] == 10 and \
-                            line_info["message"] == "Starting coroutine":
-                self.start_index = match_num
-                break
-
-    def run(self):
-        self.find_start()
-        # find all matches in the log
-
-        for match_num, match in enumerate(self.matches):
-            line_info = self.make_line_info()
-            self._post_match(line_info, match_num, match)
-
-    def _post_match(self, line_info, match_num, match):
+    def open(self):
+        if self.compressed:
+            return xz.open(self.full_path, 'rt')
+        else:
+            return open(self.full_path, 'r')
+
+    def records(self):
+        """Yield a line_info dict for every record in the log, in order"""
+        match = None
+        message_lines = []
+        record_number = 0
+
+        with self.open() as log_file:
+            for line in log_file:
+                self.chars_read += len(line)
+                next_match = self.pattern.match(line)
+                if next_match is None:
+                    message_lines.append(line)
+                    continue
+
+                if match is not None:
+                    yield self._post_match(record_number, match, message_lines)
+                    record_number += 1
+
+                match = next_match
+                message_lines = [match.group("message") + "\n"]
+
+            if match is not None:
+                yield self._post_match(record_number, match, message_lines)
+
+    def _post_match(self, match_num, match, message_lines):
         self.line_number = match_num
+        line_info = self.make_line_info()
 
         for line_key, line_value in match.groupdict().items():
             # convert the matched element to the corresponding line_info's type
             # if line_info["year"] is of type int, convert the match to an int and assign the value to line_info
-            line_info[line_key] = type(line_info[line_key])(line_value)
+            if line_key in line_info:
+                line_info[line_key] = type(line_info[line_key])(line_value)
 
-        # a quirk of the way I'm parsing with regex. Move the last character of the message to the beginning and
-        # remove trailing newlines
-        line = match.group()
-        self.line = (line[-1] + line[:-1]).strip("\n")
-        line_info["message"] = line_info["message"][:-1].strip("\n")
-
-        # under scrutiny, not sure what this was for
-        # if self.prev_time is not None:
-        #     self.prev_time = line_info["timestamp"]
+        # messages can span several lines. Remove trailing newlines
+        line_info["message"] = "".join(message_lines).strip("\n")
+        line_info["header"] = match.group("header")
+        line_info["full"] = line_info["header"] + line_info["message"]
+        self.line = line_info["full"]
 
         # create a unix timestamp using the date
         current_date = datetime.datetime(
@@ -118,6 +123,12 @@ class LogParser:
         # convert string to logging integer code
         line_info["loglevel"] = logging.getLevelName(line_info["loglevelstr"])
 
+        if line_info["name"] == "Robot" and \
+                        line_info["filename"] == "robot.py" and \
+                        line_info["loglevel"] == 10 and \
+                        line_info["message"] == "Starting coroutine":
+            self.start_index = match_num
+
         # notify stream if its name is found in the log
         if line_info["name"] in self.logged_streams:
             stream = self.logged_streams[line_info["name"]]
@@ -126,85 +137,208 @@ class LogParser:
         if line_info["name"] not in self.encountered_names:
             self.encountered_names.add(line_info["name"])
 
-        line_info["full"] = match.group(1)
-        line_info["full"] = (line_info["full"][-1] + line_info["full"][:-1]).strip("\n")
-        line_info["header"] = "[" + match.group(2)
-
-        self.lines.append(line_info)
+        return line_info
 
 
-def convert_log(path):
-    log = LogParser(path, compressed=True)
-
-    split = log.full_path.split(os.sep)[1:]
-    old_dir = split[:-1]
-    old_name = split[-1]
-    new_dir = os.path.join("converted", *old_dir)
-    new_name = os.path.splitext(old_name)[0]
-
-    log_files = {}
-    for name in log.encountered_names:
-        log_dir = os.path.join(new_dir, name)
-        if not os.path.isdir(log_dir):
-            os.makedirs(log_dir)
-        log_files[name] = open(os.path.join(log_dir, new_name), 'w')
+class LmsLogConverter:
+    """
+    Rewrites the old LMS200 records, a "scan #<n> @ <rate>hz" line followed by a "scan: (...)" line, into single
+    LmsScan lines. The scans are also recorded in a binary scan log next to the text log.
+    """
 
-    for line in log.lines:
-        name = line["name"]
-        message_text = "[%(name)s @ %(filename)s:%(linenumber)s][%(loglevelstr)s] " \
-                       "%(year)s-%(month)s-%(day)s %(hour)s:%(minute)s:%(second)s,%(millisecond)s: %(message)s\n" % line
-        log_files[name].write(message_text)
+    scan_info_header = "scan #"
+    info_split = " @ "
+    scan_header = "scan: ("
 
-    for log_file in log_files.values():
-        log_file.close()
+    def __init__(self, text_file, scan_log_path):
+        self.text_file = text_file
+        self.scan_log_path = scan_log_path
+        self.scan_log = None
+        self.config = {}
 
+        self.scan_num = ""
+        self.avg_update_hz = ""
 
-def convert_lms_log(path):
-    log = LogParser(path)
-    new_path = os.path.splitext(path)[0] + "-new.log"
-    new_file = open(new_path, 'w')
+    def write(self, line, header):
+        message = line["message"]
+        if message.startswith(self.scan_info_header):
+            raw_info = message[len(self.scan_info_header):]
+            split_index = raw_info.find(self.info_split)
+            self.scan_num = raw_info[:split_index]
+            self.avg_update_hz = raw_info[split_index + len(self.info_split):].rstrip("hz")
 
-    scan_num = ""
-    avg_update_hz = ""
+        elif message.startswith(self.scan_header):
+            raw_scan = message[len(self.scan_header):-1].replace(" ", "")
 
-    scan_info_header = "scan #"
-    info_split = " @ "
-    scan_header = "scan: ("
+            self.text_file.write("%sLmsScan(t=%s, n=%s, avg=%s, scan=(%s))\n" % (
+                header, line["timestamp"], self.scan_num, self.avg_update_hz, raw_scan
+            ))
+            self.write_scan(line["timestamp"], raw_scan)
 
-    for line in log.lines:
-        message = line["message"]
-        if message.startswith(scan_info_header):
-            raw_info = message[len(scan_info_header):]
-            split_index = raw_info.find(info_split)
-            scan_num = raw_info[:split_index]
-            avg_update_hz = raw_info[split_index + len(info_split):]
-
-        elif message.startswith(scan_header):
-            raw_scan = message[len(scan_header):-1].replace(" ", "")
-
-            new_line = "%sLmsScan(t=%s, n=%s, avg=%s, scan=%s)\n" % (
-                line["header"], line["timestamp"], scan_num, avg_update_hz, raw_scan
-            )
-            new_file.write(new_line)
         elif message.startswith("posted scan"):
             pass
         else:
-            new_file.write(line["full"] + "\n")
-    new_file.close()
+            parse_config_flag(message, self.config)
+            self.text_file.write(header + message + "\n")
+
+    def write_scan(self, timestamp, raw_scan):
+        scan = list(map(int, raw_scan.split(",")))
+        if self.scan_log is None:
+            # sized for a full scan, a later scan can be longer than the first one
+            num_values = max(config_num_values(self.config), len(scan))
+            self.scan_log = ScanLogWriter(self.scan_log_path, num_values, **self.config)
+        self.scan_log.write(timestamp, int(self.scan_num or 0), float(self.avg_update_hz or 0.0), scan)
+
+    def close(self):
+        if self.scan_log is not None:
+            self.scan_log.close()
+
+
+def output_paths(path, output_directory="converted"):
+    """The directory a log's streams are written to and the file name each stream gets"""
+    day = os.path.basename(os.path.dirname(path))
+    new_name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(output_directory, day), new_name
 
-    os.rename(new_path, path)
 
+def stamp_path(path, output_directory="converted"):
+    new_dir, new_name = output_paths(path, output_directory)
+    return os.path.join(new_dir, "." + new_name + ".json")
 
-def convert_all():
-    for directory in glob.glob("logs/*"):
-        for path in glob.glob(directory + "/*"):
-            convert_log(path)
-            directory, file_name = path.split(os.sep)[1:]
 
-            new_file_name = os.path.splitext(file_name)[0]
-            new_path = os.path.join("converted", directory.split(os.sep)[-1], "LMS200", new_file_name)
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
 
-            convert_lms_log(new_path)
 
+def make_stamp(path, use_hash=False):
+    stat = os.stat(path)
+    stamp = dict(size=stat.st_size, mtime=stat.st_mtime)
+    if use_hash:
+        stamp["sha1"] = file_hash(path)
+    return stamp
 
-convert_all()
+
+def is_up_to_date(path, output_directory="converted", use_hash=False):
+    """Check the stamp left by the last conversion of this log against the log and its outputs"""
+    try:
+        with open(stamp_path(path, output_directory)) as stamp_file:
+            previous = json.load(stamp_file)
+    except (OSError, ValueError):
+        return False
+
+    if not all(os.path.isfile(output) for output in previous.get("outputs", [])):
+        return False
+
+    if use_hash:
+        return previous.get("sha1") == file_hash(path)
+    else:
+        current = make_stamp(path)
+        return previous.get("size") == current["size"] and previous.get("mtime") == current["mtime"]
+
+
+def convert_log(path, output_directory="converted", use_hash=False):
+    """
+    Split one compressed log into a text log per stream, converting LMS200 scans to LmsScan lines and a
+    binary scan log in the same pass. Returns conversion stats.
+    """
+    t0 = time.time()
+    log = LogParser(path, compressed=True)
+    new_dir, new_name = output_paths(path, output_directory)
+
+    # each stream's file is opened the first time its name shows up
+    log_files = {}
+    lms_converter = None
+    num_records = 0
+    try:
+        for line in log.records():
+            name = line["name"]
+            if name not in log_files:
+                log_dir = os.path.join(new_dir, name)
+                if not os.path.isdir(log_dir):
+                    os.makedirs(log_dir)
+                log_files[name] = open(os.path.join(log_dir, new_name), 'w')
+                if name == "LMS200":
+                    scan_log_name = os.path.splitext(new_name)[0] + scan_log_extension
+                    lms_converter = LmsLogConverter(log_files[name], os.path.join(log_dir, scan_log_name))
+
+            header = "[%(name)s @ %(filename)s:%(linenumber)s][%(loglevelstr)s] " \
+                     "%(year)s-%(month)s-%(day)s %(hour)s:%(minute)s:%(second)s,%(millisecond)s: " % line
+            if name == "LMS200":
+                lms_converter.write(line, header)
+            else:
+                log_files[name].write(header + line["message"] + "\n")
+            num_records += 1
+    finally:
+        for log_file in log_files.values():
+            log_file.close()
+        if lms_converter is not None:
+            lms_converter.close()
+
+    outputs = [log_file.name for log_file in log_files.values()]
+    if lms_converter is not None and lms_converter.scan_log is not None:
+        outputs.append(lms_converter.scan_log_path)
+
+    stamp = make_stamp(path, use_hash)
+    stamp["outputs"] = outputs
+    with open(stamp_path(path, output_directory), 'w') as stamp_file:
+        json.dump(stamp, stamp_file)
+
+    return dict(path=path, skipped=False, records=num_records, size=log.chars_read, duration=time.time() - t0)
+
+
+def convert_if_needed(path, output_directory="converted", force=False, use_hash=False):
+    if not force and is_up_to_date(path, output_directory, use_hash):
+        return dict(path=path, skipped=True)
+    return convert_log(path, output_directory, use_hash)
+
+
+def report(stats):
+    if stats["skipped"]:
+        print("%s: up to date" % stats["path"])
+    else:
+        megabytes = stats["size"] / 1e6
+        print("%s: %s records, %0.1f MB in %0.2fs (%0.1f MB/s, %0.0f records/s)" % (
+            stats["path"], stats["records"], megabytes, stats["duration"],
+            megabytes / stats["duration"], stats["records"] / stats["duration"]))
+
+
+def convert_all(paths=None, output_directory="converted", jobs=None, force=False, use_hash=False):
+    """Convert logs with a process per core, one log per worker at a time"""
+    if paths is None:
+        paths = sorted(glob.glob(os.path.join("logs", "*", "*.log.xz")))
+
+    t0 = time.time()
+    total_size = 0
+    num_converted = 0
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(convert_if_needed, path, output_directory, force, use_hash) for path in paths]
+        for future in as_completed(futures):
+            stats = future.result()
+            report(stats)
+            if not stats["skipped"]:
+                num_converted += 1
+                total_size += stats["size"]
+
+    duration = time.time() - t0
+    print("converted %s of %s logs, %0.1f MB in %0.2fs (%0.1f MB/s)" % (
+        num_converted, len(paths), total_size / 1e6, duration, total_size / 1e6 / duration))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Split old robot logs into per-stream logs and LMS200 scan logs")
+    parser.add_argument("paths", nargs="*", help="logs to convert. Defaults to logs/*/*.log.xz")
+    parser.add_argument("-o", "--output", default="converted", help="directory to write converted logs to")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes. Defaults to the core count")
+    parser.add_argument("-f", "--force", action="store_true", help="convert logs that are already up to date")
+    parser.add_argument("--hash", action="store_true", help="detect changed logs by content hash instead of mtime")
+    args = parser.parse_args()
+
+    convert_all(args.paths or None, args.output, args.jobs, args.force, args.hash)
+
+
+if __name__ == "__main__":
+    main()
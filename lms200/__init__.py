@@ -1,4 +1,15 @@
 from .lms200 import *
 from .slam import *
+from .slamworker import *
+from .trajectory import *
+from .tiledmap import *
+from .scannergroup import *
+from .simulator import *
+from .metrics import *
+from .offline import *
+from .preprocessing import *
 from .playback import *
-from .plotter import *
\ No newline at end of file
+from .scancache import *
+from .plotter import *
+from .ringbuffer import *
+from .scanlog import *
\ No newline at end of file
@@ -1,19 +1,99 @@
+import os
 import time
 import asyncio
 import multiprocessing
-from multiprocessing.managers import BaseManager
+import numpy as np
 
 from atlasbuggy.device import Generic
 
-from .sicktoolbox import SickLMS, units, bauds, measuring_modes, SickIOException
+from .sick import SickLMS, units, bauds, measuring_modes, operating_modes, scan_angles, scan_resolutions, \
+    SickIOException, MAX_NUM_MEASUREMENTS
 from .messages import LmsScan
+from .ringbuffer import ScanRingBuffer
+from .metrics import PipelineMetrics
+from .scanlog import ScanLogWriter, scan_log_extension, beam_dtype
 
 
 class LMS200(Generic):
-    def __init__(self, address, baud=38400, enabled=True):
+    device_starting = 0
+    device_running = 1
+    device_failed = -1
+
+    baud_rates = {
+        9600: bauds.SICK_BAUD_9600,
+        19200: bauds.SICK_BAUD_19200,
+        38400: bauds.SICK_BAUD_38400,
+        500000: bauds.SICK_BAUD_500K,  # RS-422 only
+    }
+    variant_angles = {
+        90: scan_angles.ANGLE_90,
+        100: scan_angles.ANGLE_100,
+        180: scan_angles.ANGLE_180,
+    }
+    variant_resolutions = {
+        0.25: scan_resolutions.RESOLUTION_25,
+        0.5: scan_resolutions.RESOLUTION_50,
+        1.0: scan_resolutions.RESOLUTION_100,
+    }
+    stream_modes = (
+        operating_modes.MONITOR_STREAM_VALUES,
+        operating_modes.MONITOR_STREAM_MEAN_VALUES,
+        operating_modes.MONITOR_STREAM_VALUES_SUBRANGE,
+        operating_modes.MONITOR_STREAM_RANGE_AND_REFLECT,
+    )
+
+    mean_sample_sizes = range(2, 251)  # scans the LMS can average in MONITOR_STREAM_MEAN_VALUES
+
+    is_live = True  # scans are stamped when they're read, see Slam's scan_age
+
+    motor_rate_hz = 75.0  # mirror revolutions per second
+    telegram_overhead_bytes = 10  # header, status and CRC around the measured values
+
+    def __init__(self, address, baud=38400, enabled=True, ring_size=64, overflow_policy="overwrite",
+                 stream_mode=operating_modes.MONITOR_STREAM_VALUES, scan_angle=None, scan_resolution=None,
+                 measuring_mode=None, measuring_units=None, mean_sample_size=2, subrange=None, scan_log_directory=None,
+                 device=None, metrics=None):
+        """
+        :param baud: 9600, 19200, 38400 or 500000
+        :param stream_mode: MONITOR_STREAM_VALUES, MONITOR_STREAM_MEAN_VALUES, MONITOR_STREAM_VALUES_SUBRANGE or
+            MONITOR_STREAM_RANGE_AND_REFLECT. The last sends scans as beam_dtype arrays of range and reflectivity
+        :param scan_angle: 90, 100 or 180 degrees. None keeps the device's setting
+        :param scan_resolution: 0.25, 0.5 or 1.0 degrees. None keeps the device's setting
+        :param measuring_mode: a measuring_modes value. None keeps the device's setting
+        :param measuring_units: units.CM or units.MM. None keeps the device's setting
+        :param mean_sample_size: number of scans averaged in MONITOR_STREAM_MEAN_VALUES, 2 to 250
+        :param subrange: (start index, stop index) of the values sent in MONITOR_STREAM_VALUES_SUBRANGE
+        :param scan_log_directory: record scans to a binary scan log in this directory instead of as text log lines
+        :param device: a SickLMS stand-in to read from instead of the scanner at address, like SimulatedSickLMS
+        :param metrics: PipelineMetrics to record timings in. None creates one, Slam records into it too
+        """
         super(LMS200, self).__init__(enabled)
 
+        if baud not in self.baud_rates:
+            raise ValueError("Invalid baud: %s" % baud)
+        if stream_mode not in self.stream_modes:
+            raise ValueError("Unsupported stream mode: %s" % stream_mode)
+        if scan_angle is not None and scan_angle not in self.variant_angles:
+            raise ValueError("Invalid scan angle: %s" % scan_angle)
+        if scan_resolution is not None and scan_resolution not in self.variant_resolutions:
+            raise ValueError("Invalid scan resolution: %s" % scan_resolution)
+        if mean_sample_size not in self.mean_sample_sizes:
+            raise ValueError("Invalid mean sample size: %s" % mean_sample_size)
+        if stream_mode == operating_modes.MONITOR_STREAM_VALUES_SUBRANGE and subrange is None:
+            raise ValueError("Subrange stream mode needs a (start, stop) subrange")
+
+        self.address = address
         self.session_baud = baud
+        self.baud = None
+
+        self.stream_mode = stream_mode
+        self.requested_scan_angle = scan_angle
+        self.requested_scan_resolution = scan_resolution
+        self.requested_measuring_mode = measuring_mode
+        self.requested_measuring_units = measuring_units
+        self.mean_sample_size = mean_sample_size
+        self.subrange = subrange
+        self.num_values = 0
 
         self.scan_resolution = 0.0
         self.scan_angle = 0.0
@@ -22,23 +102,42 @@ class LMS200(Generic):
 
         self.num_scans = 0
         self.update_rate_hz = 5.0
-        self._sum_update_hz = 0.0
-        self._avg_update_hz = multiprocessing.Value('d')
+        self.metrics = PipelineMetrics() if metrics is None else metrics
 
         self.operating_mode = None
         self.measuring_mode = None
 
-        BaseManager.register("SickLMS", SickLMS)
-        self.manager = BaseManager()
-        self.manager.start()
-        self.lms = self.manager.SickLMS(address)
+        # the SickLMS lives in the device process. Scans come back through shared memory, the config
+        # the device negotiated comes back through these
+        self.lms = None
+        self.device = device
+        self._device_status = multiprocessing.Value('i', self.device_starting)
+        self._device_config = multiprocessing.Array('d', 6)
+
+        # with reflectivity the device fills beam records straight into the ring, ranges stay uint32 otherwise
+        self.scans = ScanRingBuffer(ring_size, MAX_NUM_MEASUREMENTS, overflow_policy,
+                                    dtype=beam_dtype if self.has_reflectivity else np.uint32)
+        self.scan_reader = self.scans.reader()
+
+        self.scan_log_directory = scan_log_directory
+        self.scan_log = None
+
+    @property
+    def has_reflectivity(self):
+        return self.stream_mode == operating_modes.MONITOR_STREAM_RANGE_AND_REFLECT
 
     def get_config(self):
-        self.operating_mode = self.lms.get_operating_mode()
-        self.measuring_mode = self.lms.get_measuring_mode()
-        self.measuring_units = self.lms.get_measuring_units()
-        self.scan_resolution = self.lms.get_scan_resolution()
-        self.scan_angle = self.lms.get_scan_angle()
+        with self._device_config.get_lock():
+            config = self._device_config[:]
+        operating_mode, measuring_mode, measuring_units, scan_resolution, scan_angle, num_values = config
+
+        self.operating_mode = operating_modes.values[int(operating_mode)]
+        self.measuring_mode = measuring_modes.values[int(measuring_mode)]
+        self.measuring_units = units.values[int(measuring_units)]
+        self.scan_resolution = scan_resolution
+        self.scan_angle = scan_angle
+        self.num_values = int(num_values)
+        self.update_rate_hz = self.get_update_rate(self.session_baud, self.scan_resolution, self.num_values)
 
         self.logger.debug("Operating mode: %s" % self.operating_mode)
         self.logger.debug("Measuring mode: %s" % self.measuring_mode)
@@ -50,6 +149,36 @@ class LMS200(Generic):
         self.max_distance = self.get_max_dist(self.measuring_mode)
         self.logger.debug("Max distance: %s" % self.max_distance)
 
+    def share_config(self, num_values):
+        """Called in the device process once the first scan has switched the scanner into its streaming mode"""
+        with self._device_config.get_lock():
+            self._device_config[:] = [
+                int(self.lms.get_operating_mode()),
+                int(self.lms.get_measuring_mode()),
+                int(self.lms.get_measuring_units()),
+                self.lms.get_scan_resolution(),
+                self.lms.get_scan_angle(),
+                num_values,
+            ]
+
+    def get_update_rate(self, baud, scan_resolution, num_values):
+        """
+        Scans per second the configuration can sustain: the slower of what the scanner produces and what fits
+        through the serial link.
+        """
+        # finer resolutions interlace several mirror revolutions into one scan
+        interlaced_revolutions = max(1, int(round(1.0 / scan_resolution))) if scan_resolution > 0 else 1
+        scanner_rate_hz = self.motor_rate_hz / interlaced_revolutions
+        if self.stream_mode == operating_modes.MONITOR_STREAM_MEAN_VALUES:
+            scanner_rate_hz /= self.mean_sample_size
+
+        # two bytes per value, plus one for its reflectivity. 10 bits per byte on the wire (start + 8 data + stop)
+        value_bytes = 3 if self.has_reflectivity else 2
+        telegram_bits = (value_bytes * num_values + self.telegram_overhead_bytes) * 10
+        link_rate_hz = baud / telegram_bits
+
+        return min(scanner_rate_hz, link_rate_hz)
+
     def get_max_dist(self, measuring_mode):
         if measuring_mode in (measuring_modes.MODE_8_OR_80_FA_FB_DAZZLE, measuring_modes.MODE_8_OR_80_REFLECTOR,
                               measuring_modes.MODE_8_OR_80_FA_FB_FC):
@@ -64,67 +193,147 @@ class LMS200(Generic):
 
     @property
     def avg_update_hz(self):
-        with self._avg_update_hz.get_lock():
-            return self._avg_update_hz.value
+        """Scans per second read off the device over the last few seconds"""
+        return self.metrics.rate("serial_read")
+
+    @property
+    def dropped_scans(self):
+        """Scans lost because the ring buffer was full (drop policy) or lapped a reader (overwrite policy)"""
+        return self.scans.dropped + self.scan_reader.overruns
 
     async def setup(self):
         self.initialize()
-        time.sleep(0.5)  # wait for device to warm up
+
+        while self._device_status.value == self.device_starting:
+            await asyncio.sleep(0.01)
+
+        if self._device_status.value == self.device_failed:
+            self.stop_device()
+            raise RuntimeError("Failed to initialize LMS200 at %s" % self.address)
+
+        self.get_config()
+        self.logger.info("Metrics in shared memory %s, read them with python -m lms200.metrics %s" % (
+            self.metrics.name, self.metrics.name))
+        if self.scan_log_directory is not None:
+            self.open_scan_log()
+        await asyncio.sleep(0.5)  # wait for device to warm up
+
+    def open_scan_log(self):
+        if not os.path.isdir(self.scan_log_directory):
+            os.makedirs(self.scan_log_directory)
+        path = os.path.join(self.scan_log_directory, time.strftime("%H;%M;%S") + scan_log_extension)
+
+        # sized for any scan the device can send, the first scan can be shorter than later ones
+        self.scan_log = ScanLogWriter(
+            path, MAX_NUM_MEASUREMENTS, session_baud=self.session_baud, operating_mode=int(self.operating_mode),
+            measuring_mode=int(self.measuring_mode), measuring_units=int(self.measuring_units),
+            scan_resolution=self.scan_resolution, scan_angle=self.scan_angle, max_distance=self.max_distance,
+            update_rate_hz=self.update_rate_hz, reflectivity=self.has_reflectivity
+        )
+        self.logger.info("Recording scans to %s" % path)
 
     def initialize(self):
         self.logger.debug("Selected baud: %s" % self.session_baud)
+        self.baud = self.baud_rates[self.session_baud]
 
-        if self.session_baud == 9600:
-            baud = bauds.SICK_BAUD_9600
-            self.update_rate_hz = 1.0
-        elif self.session_baud == 19200:
-            baud = bauds.SICK_BAUD_19200
-            self.update_rate_hz = 2.5
-        elif self.session_baud == 38400:
-            baud = bauds.SICK_BAUD_38400
-            self.update_rate_hz = 5.0
-        else:
-            raise ValueError("Invalid baud: %s" % self.session_baud)
+        self.device_process.start()
 
-        try:
-            self.lms.initialize(baud)
-        except:
-            self.stop_device()
-            raise
+    def configure_device(self):
+        """Apply the requested settings in the device process. The scanner keeps them until it's reconfigured"""
+        if self.requested_measuring_units is not None:
+            self.lms.set_measuring_units(self.requested_measuring_units)
+        if self.requested_measuring_mode is not None:
+            self.lms.set_measuring_mode(self.requested_measuring_mode)
 
-        self.get_config()
+        if self.requested_scan_angle is not None or self.requested_scan_resolution is not None:
+            scan_angle = self.requested_scan_angle
+            if scan_angle is None:
+                scan_angle = int(self.lms.get_scan_angle())
+            scan_resolution = self.requested_scan_resolution
+            if scan_resolution is None:
+                scan_resolution = self.lms.get_scan_resolution()
+
+            self.lms.set_variant(self.variant_angles[scan_angle], self.variant_resolutions[scan_resolution])
+
+    def read_scan(self, buffer):
+        """Read the next scan of the selected stream mode into buffer. Returns the number of values"""
+        if self.stream_mode == operating_modes.MONITOR_STREAM_MEAN_VALUES:
+            return self.lms.get_mean_values_into(self.mean_sample_size, buffer)
+        elif self.stream_mode == operating_modes.MONITOR_STREAM_VALUES_SUBRANGE:
+            start_index, stop_index = self.subrange
+            return self.lms.get_scan_subrange_into(start_index, stop_index, buffer)
+        elif self.stream_mode == operating_modes.MONITOR_STREAM_RANGE_AND_REFLECT:
+            return self.lms.get_range_and_reflect_into(buffer)
+        else:
+            return self.lms.get_scan_into(buffer)
 
     def poll_device(self):
         self.logger.info("polling device")
 
-        while self.device_active():
-            t0 = time.time()
-            scan = self.lms.get_scan()
-            self.num_scans += 1
-            self.device_read_queue.put((t0, scan, self.num_scans))
-            t1 = time.time()
+        self.lms = SickLMS(self.address) if self.device is None else self.device
+        try:
+            self.lms.initialize(self.baud)
+            self.configure_device()
 
-            self._sum_update_hz += 1 / (t1 - t0)
-            with self._avg_update_hz.get_lock():
-                self._avg_update_hz.value = self._sum_update_hz / self.num_scans
+            prev_t0 = None
+            while self.device_active():
+                t0 = time.time()
+                num_values = self.read_scan(self.scans.claim())
+                t1 = time.time()
+                self.num_scans += 1
+                self.scans.publish(t0, self.num_scans, num_values)
 
-    async def loop(self):
-        self.device_process.start()
+                if self._device_status.value == self.device_starting:
+                    self.share_config(num_values)
+                    self._device_status.value = self.device_running
 
+                self.metrics.record("serial_read", t1 - t0, t1)
+                if prev_t0 is not None:
+                    self.metrics.record("scan_interval", t0 - prev_t0, t1)
+                prev_t0 = t0
+        except:
+            if self._device_status.value == self.device_starting:
+                self._device_status.value = self.device_failed
+            raise
+        finally:
+            self.lms.uninitialize()
+            self.scans.notify()  # wake up loop so it sees the device is no longer active
+
+    async def loop(self):
         while self.device_active():
-            if not self.empty():
-                timestamp, scan, scan_num = self.read()
+            scan = self.scan_reader.read()
+            if scan is not None:
+                timestamp, scan_num, values = scan
+                self.num_scans = scan_num
+                read_time = time.time()
+                self.metrics.record("ipc_handoff", read_time - self.scan_reader.published, read_time)
+                self.metrics.set("ring_depth", self.scan_reader.pending())
+                self.metrics.set("ring_dropped", self.dropped_scans)
 
-                message = LmsScan(timestamp, scan_num, self.avg_update_hz, scan)
-                self.log_to_buffer(timestamp, message)
-                self.check_buffer(scan_num)
+                message = LmsScan(timestamp, scan_num, self.avg_update_hz, values)
+                if self.scan_log is not None:
+                    self.scan_log.write_message(message)
+                else:
+                    self.log_to_buffer(timestamp, message)
+                    self.check_buffer(scan_num)
 
+                broadcast_time = time.time()
                 await self.broadcast(message)
+                self.metrics.record("broadcast", time.time() - broadcast_time)
             else:
-                await asyncio.sleep(0.001)
+                await self.scan_reader.wait()
         self.logger.info("Device no longer active. Shutting down.")
 
     async def teardown(self):
         self.device_exit_event.set()
-        await asyncio.sleep(0.01)  # wait for device to exit
-        self.lms.uninitialize()
+        exit_time = time.time()
+        while self.device_process.is_alive() and time.time() - exit_time < 1.0:
+            await asyncio.sleep(0.01)  # wait for device to finish its last scan and uninitialize
+
+        if self.dropped_scans > 0:
+            self.logger.warning("%s scans dropped (%s full, %s overrun)" % (
+                self.dropped_scans, self.scans.dropped, self.scan_reader.overruns))
+        self.logger.info("Pipeline metrics:\n%s" % self.metrics.format_summary())
+        self.scans.close()
+        if self.scan_log is not None:
+            self.scan_log.close()
@@ -1,16 +1,36 @@
 import re
+import numpy as np
 
 from atlasbuggy import Message
 
+from .scanlog import beam_dtype, make_beams
+
 
 class LmsScan(Message):
-    message_regex = r"LmsScan\(t=([\d.]*), n=(\d*), avg=([\d.]*), scan=\((.+)\)\)"
+    """
+    scan is a tuple or array of ranges, or a beam_dtype array when the scanner streams reflectivity too.
+    ranges and reflectivity are views of its fields, they don't copy the scan
+    """
+    message_regex = r"LmsScan\(t=([\d.]*), n=(\d*), avg=([\d.]*), scan=\(([^)]+)\)(?:, reflect=\(([^)]+)\))?\)"
 
     def __init__(self, timestamp, n, avg_update_hz, scan):
         self.avg_update_hz = avg_update_hz
         self.scan = scan
         super(LmsScan, self).__init__(timestamp, n)
 
+    @property
+    def has_reflectivity(self):
+        return isinstance(self.scan, np.ndarray) and self.scan.dtype.names is not None
+
+    @property
+    def ranges(self):
+        return self.scan["range"] if self.has_reflectivity else self.scan
+
+    @property
+    def reflectivity(self):
+        """Reflectivity of each beam, None if the scanner only sent ranges"""
+        return self.scan["reflectivity"] if self.has_reflectivity else None
+
     @classmethod
     def parse(cls, message):
         match = re.match(cls.message_regex, message)
@@ -20,14 +40,26 @@ class LmsScan(Message):
             message_time = float(match.group(1))
             n = int(match.group(2))
             avg_update_rate = float(match.group(3))
-            scan = match.group(4)
-            scan = tuple(map(int, scan.split(",")))
+            scan = tuple(map(int, match.group(4).split(",")))
+            if match.group(5) is not None:
+                scan = make_beams(scan, tuple(map(int, match.group(5).split(","))))
 
             return LmsScan(message_time, n, avg_update_rate, scan)
 
     def __str__(self):
-        return "%s(t=%s, n=%s, avg=%s, scan=%s)" % (
-            self.__class__.__name__, self.timestamp, self.n, self.avg_update_hz, self.scan)
+        if self.has_reflectivity:
+            return "%s(t=%s, n=%s, avg=%s, scan=(%s), reflect=(%s))" % (
+                self.__class__.__name__, self.timestamp, self.n, self.avg_update_hz, format_scan(self.ranges),
+                format_scan(self.reflectivity))
+        return "%s(t=%s, n=%s, avg=%s, scan=(%s))" % (
+            self.__class__.__name__, self.timestamp, self.n, self.avg_update_hz, format_scan(self.scan))
+
+
+def format_scan(scan):
+    """Format a scan tuple or numpy array the same way regardless of its container"""
+    if hasattr(scan, "tolist"):
+        scan = scan.tolist()
+    return ", ".join(map(str, scan))
 
 
 class OdometryMessage(Message):
@@ -86,3 +118,37 @@ class PoseMessage(Message):
     def __str__(self):
         return "%s(t=%s, n=%s, x=%s, y=%s, th=%s)" % (
             self.__class__.__name__, self.timestamp, self.n, self.x_mm, self.y_mm, self.theta_degrees)
+
+
+class MapUpdate(Message):
+    """
+    The parts of the SLAM occupancy map that changed since the last update. The map is split into square
+    tiles of tile_size pixels, tiles holds (row, column, pixels) for every tile that changed. n is the map
+    version, a consumer that missed a version should ask for the whole map again. origin is the world position
+    in pixels of the map's top left corner, it only moves when a tiled map re-centres.
+    """
+
+    def __init__(self, timestamp, n, map_size_pixels, tile_size, tiles, origin=(0, 0)):
+        self.map_size_pixels = map_size_pixels
+        self.tile_size = tile_size
+        self.tiles = tiles
+        self.origin = origin
+
+        super(MapUpdate, self).__init__(timestamp, n)
+
+    @property
+    def version(self):
+        return self.n
+
+    def apply(self, image):
+        """Copy the changed tiles into a (map_size_pixels, map_size_pixels) image"""
+        for row, column, pixels in self.tiles:
+            y = row * self.tile_size
+            x = column * self.tile_size
+            image[y: y + pixels.shape[0], x: x + pixels.shape[1]] = pixels
+        return image
+
+    def __str__(self):
+        return "%s(t=%s, n=%s, size=%s, tile=%s, tiles=%s, origin=%s)" % (
+            self.__class__.__name__, self.timestamp, self.n, self.map_size_pixels, self.tile_size, len(self.tiles),
+            self.origin)
@@ -0,0 +1,300 @@
+import sys
+import math
+import time
+import atexit
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+__all__ = ["PipelineMetrics"]
+
+
+class PipelineMetrics:
+    """
+    Timing and queue metrics for the scanner and SLAM pipeline, kept in shared memory so anything that knows the
+    block's name can read them while the robot runs, without talking to the processes being measured.
+
+    Stages are timed with record(stage, seconds). Each stage keeps:
+        - a histogram with buckets_per_decade log spaced buckets from min_seconds up, for p50 and p99
+        - count, total, max and the last value since start
+        - per second counts and maxes over the last window_seconds, for a rate and a max that forget old stalls
+    Gauges are plain values that are overwritten, like queue depths and drop counters.
+
+    Every stage and gauge has to be written by one thread only, the writers don't lock. Readers can see a
+    record half applied, the next read is consistent again.
+
+    With shared=False the same stats are kept in this process's memory, for consumers nobody else reads.
+    """
+
+    stages = (
+        "scan_interval",  # time between the starts of consecutive serial reads
+        "serial_read",  # reading a scan off the scanner
+        "ipc_handoff",  # from publishing a scan in the device process to the node reading it out of the ring
+        "broadcast",  # LMS200.loop handing a scan to its subscribers
+        "slam_update",  # scan matching one scan
+        "slam_getmap",  # copying the map out of the SLAM algorithm
+        "scan_age",  # from the start of the serial read to the scan reaching SLAM
+    )
+    gauges = (
+        "ring_depth",  # scans published but not read yet
+        "ring_dropped",  # scans the ring discarded or overwrote before they were read
+        "slam_queue_depth",  # scans waiting for the SLAM worker
+        "slam_dropped",  # scans the SLAM worker discarded
+    )
+
+    min_seconds = 1e-6
+    buckets_per_decade = 8
+    num_decades = 8  # up to 100 seconds
+    window_seconds = 10
+    name_size = 32
+
+    header_dtype = np.dtype([
+        ("num_stages", np.uint32),
+        ("num_gauges", np.uint32),
+        ("start_time", np.float64),
+    ])
+    header_size = 64
+
+    def __init__(self, stages=None, gauges=None, name=None, shared=True):
+        """
+        :param stages, gauges: names to track, the pipeline's by default
+        :param name: attach to the block another process created with this name. None creates a new block
+        :param shared: False keeps a new block in this process instead of shared memory
+        """
+        self.is_owner = name is None
+        self.shared_memory = None
+        if self.is_owner:
+            self.stages = tuple(self.stages if stages is None else stages)
+            self.gauges = tuple(self.gauges if gauges is None else gauges)
+            if shared:
+                self.shared_memory = shared_memory.SharedMemory(create=True, size=self.block_size())
+                self.buffer = self.shared_memory.buf
+                atexit.register(self.close)
+            else:
+                self.buffer = bytearray(self.block_size())
+        else:
+            self.shared_memory = shared_memory.SharedMemory(name=name)
+            self.buffer = self.shared_memory.buf
+            header = np.ndarray((1,), dtype=self.header_dtype, buffer=self.buffer)
+            num_stages = int(header["num_stages"][0])
+            num_gauges = int(header["num_gauges"][0])
+            names = np.ndarray((num_stages + num_gauges,), dtype="S%d" % self.name_size,
+                               buffer=self.buffer, offset=self.header_size)
+            names = [name.decode() for name in names.tolist()]
+            self.stages = tuple(names[:num_stages])
+            self.gauges = tuple(names[num_stages:])
+            del header, names
+
+        self.stage_indices = {stage: index for index, stage in enumerate(self.stages)}
+        self.gauge_indices = {gauge: index for index, gauge in enumerate(self.gauges)}
+        self.num_buckets = self.buckets_per_decade * self.num_decades + 2  # plus underflow and overflow
+        self.log_min = math.log10(self.min_seconds)
+
+        self._map_arrays()
+        if self.is_owner:
+            self.header[0] = (len(self.stages), len(self.gauges), time.time())
+            self.names[:] = self.stages + self.gauges
+
+    def block_size(self):
+        num_buckets = self.buckets_per_decade * self.num_decades + 2
+        num_stages = len(self.stages)
+        return (self.header_size + (num_stages + len(self.gauges)) * self.name_size +
+                num_stages * num_buckets * 8 + num_stages * 4 * 8 + num_stages * self.window_seconds * 3 * 8 +
+                len(self.gauges) * 8)
+
+    def _map_arrays(self):
+        buffer = self.buffer
+        num_stages = len(self.stages)
+        offset = self.header_size
+
+        def array(shape, dtype):
+            nonlocal offset
+            mapped = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)
+            offset += mapped.nbytes
+            return mapped
+
+        self.header = np.ndarray((1,), dtype=self.header_dtype, buffer=buffer)
+        self.names = array((num_stages + len(self.gauges),), "S%d" % self.name_size)
+        self.histograms = array((num_stages, self.num_buckets), np.uint64)
+        self.totals = array((num_stages, 4), np.float64)  # count, sum, max, last
+        self.windows = array((num_stages, self.window_seconds, 3), np.float64)  # second, count, max
+        self.gauge_values = array((len(self.gauges),), np.float64)
+
+        # record writes through flat memoryviews, indexing them costs a fraction of indexing numpy arrays
+        self._histograms = memoryview(self.histograms).cast("B").cast("Q")
+        self._totals = memoryview(self.totals).cast("B").cast("d")
+        self._windows = memoryview(self.windows).cast("B").cast("d")
+        self._gauges = memoryview(self.gauge_values).cast("B").cast("d")
+
+    def __getstate__(self):
+        if self.shared_memory is None:
+            raise TypeError("In-process metrics can't be shared with another process")
+        return self.name
+
+    def __setstate__(self, name):
+        self.__init__(name=name)
+
+    @property
+    def name(self):
+        """Name of the shared memory block, None for in-process metrics"""
+        return None if self.shared_memory is None else self.shared_memory.name
+
+    @property
+    def closed(self):
+        return self.header is None
+
+    # ---- writers ----
+
+    def record(self, stage, seconds, now=None):
+        """Add one timing to a stage"""
+        if self.header is None:
+            return
+        index = self.stage_indices[stage]
+
+        if seconds < self.min_seconds:
+            bucket = 0
+        else:
+            bucket = min(int((math.log10(seconds) - self.log_min) * self.buckets_per_decade) + 1,
+                         self.num_buckets - 1)
+        self._histograms[index * self.num_buckets + bucket] += 1
+
+        totals = self._totals
+        start = index * 4
+        totals[start] += 1
+        totals[start + 1] += seconds
+        if seconds > totals[start + 2]:
+            totals[start + 2] = seconds
+        totals[start + 3] = seconds
+
+        second = int(time.time() if now is None else now)
+        windows = self._windows
+        start = (index * self.window_seconds + second % self.window_seconds) * 3
+        if windows[start] != second:
+            windows[start] = second
+            windows[start + 1] = 0
+            windows[start + 2] = 0
+        windows[start + 1] += 1
+        if seconds > windows[start + 2]:
+            windows[start + 2] = seconds
+
+    def set(self, gauge, value):
+        if self.header is not None:
+            self._gauges[self.gauge_indices[gauge]] = value
+
+    # ---- readers ----
+
+    def bucket_edges(self):
+        """Upper edge in seconds of every histogram bucket"""
+        edges = 10 ** (self.log_min + np.arange(self.num_buckets) / self.buckets_per_decade)
+        edges[-1] = np.inf
+        return edges
+
+    def snapshot(self):
+        """Copy of the histograms, to pass to summary(since=...) later"""
+        return self.histograms.copy()
+
+    def percentile(self, stage, percent, since=None):
+        """Upper edge of the histogram bucket the percentile falls in, 0.0 if nothing was recorded"""
+        index = self.stage_indices[stage]
+        histogram = self.histograms[index].astype(np.int64)
+        if since is not None:
+            histogram -= since[index].astype(np.int64)
+        counts = np.cumsum(histogram)
+        if counts[-1] <= 0:
+            return 0.0
+        bucket = int(np.searchsorted(counts, counts[-1] * percent / 100.0))
+        # nothing was slower than the max, the bucket's edge can be
+        return min(float(self.bucket_edges()[min(bucket, self.num_buckets - 1)]), float(self.totals[index, 2]))
+
+    def window_stats(self, stage, now=None):
+        """(events per second, max) over the last window_seconds"""
+        now = time.time() if now is None else now
+        second = int(now)
+        windows = self.windows[self.stage_indices[stage]]
+        recent = windows[(windows[:, 0] > second - self.window_seconds) & (windows[:, 0] <= second)]
+        if len(recent) == 0:
+            return 0.0, 0.0
+
+        # the current second is still filling up, and right after start there isn't a whole window yet
+        span = min(self.window_seconds - 1 + now - second, now - float(self.header["start_time"][0]))
+        return float(recent[:, 1].sum()) / max(span, 1.0), float(recent[:, 2].max())
+
+    def rate(self, stage, now=None):
+        return self.window_stats(stage, now)[0]
+
+    def summary(self, since=None):
+        """
+        Everything as a dict. Percentiles cover all timings or, with since from an earlier snapshot(), the
+        timings recorded after it
+        """
+        now = time.time()
+        stages = {}
+        for stage in self.stages:
+            count, total, max_seconds, last = self.totals[self.stage_indices[stage]].tolist()
+            rate_hz, window_max = self.window_stats(stage, now)
+            stages[stage] = dict(
+                count=int(count), mean=total / count if count > 0 else 0.0, last=last, max=max_seconds,
+                p50=self.percentile(stage, 50, since), p99=self.percentile(stage, 99, since),
+                rate_hz=rate_hz, window_max=window_max,
+            )
+        gauges = dict(zip(self.gauges, self.gauge_values.tolist()))
+        return dict(uptime=now - float(self.header["start_time"][0]), stages=stages, gauges=gauges)
+
+    def format_summary(self, since=None):
+        summary = self.summary(since)
+        lines = ["uptime %0.1fs" % summary["uptime"]]
+        for stage, stats in summary["stages"].items():
+            if stats["count"] == 0:
+                continue
+            lines.append("%-14s %8d  %7.2f/s  p50 %8.3fms  p99 %8.3fms  max %8.3fms (%0.3fms recently)" % (
+                stage, stats["count"], stats["rate_hz"], stats["p50"] * 1000, stats["p99"] * 1000,
+                stats["max"] * 1000, stats["window_max"] * 1000))
+        lines.append("  ".join("%s %d" % (gauge, value) for gauge, value in summary["gauges"].items()))
+        return "\n".join(lines)
+
+    def close(self):
+        if self.header is None:
+            return
+        self.header = None
+        self._histograms.release()
+        self._totals.release()
+        self._windows.release()
+        self._gauges.release()
+        self.names = None
+        self.histograms = None
+        self.totals = None
+        self.windows = None
+        self.gauge_values = None
+        self.buffer = None
+        if self.shared_memory is None:
+            return
+        self.shared_memory.close()
+        if self.is_owner:
+            self.shared_memory.unlink()
+            atexit.unregister(self.close)
+
+
+def main():
+    """Print the metrics of a running pipeline: python -m lms200.metrics <shared memory name> [interval]"""
+    if len(sys.argv) < 2:
+        print("usage: python -m lms200.metrics <shared memory name> [interval seconds]")
+        return
+    interval = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+
+    metrics = PipelineMetrics(name=sys.argv[1])
+    # the resource tracker unlinks blocks it saw attached when this process exits, that's up to the pipeline
+    resource_tracker.unregister(metrics.shared_memory._name, "shared_memory")
+    try:
+        previous = metrics.snapshot()
+        while True:
+            time.sleep(interval)
+            print(metrics.format_summary(since=previous))
+            print()
+            previous = metrics.snapshot()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        metrics.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import time
+import numpy as np
+
+from .slam import Slam
+from .slamworker import make_algorithm
+from .metrics import PipelineMetrics
+from .preprocessing import ScanPreprocessor
+from .playback import open_scan_source
+from .simulator import load_raw_scans, SickIOException
+from .sick import units
+
+__all__ = ["ScannerConfig", "load_session", "make_offline_slam", "run_offline_slam"]
+
+
+class ScannerConfig:
+    """The attributes Slam and LMSPlotter read off the scanner they subscribe to, taken from a log's config"""
+
+    def __init__(self, config):
+        self.scan_angle = config.get("scan_angle", 180.0)
+        self.scan_resolution = config.get("scan_resolution", 0.5)
+        self.measuring_units = config.get("measuring_units", units.MM)
+        self.max_distance = config.get("max_distance", 8.0)
+        self.update_rate_hz = config.get("update_rate_hz", 5.0)
+
+
+def load_session(path):
+    """
+    Every scan of a log as (scans, timestamps, config). Takes raw logs (logs/*/*.log.xz), converted text logs and
+    binary scan logs. Raw logs don't keep usable scan times, their timestamps are None
+    """
+    if path.endswith(".xz"):
+        scans, config = load_raw_scans(path)
+        return scans, None, config
+
+    source = open_scan_source(path)
+    try:
+        if len(source) == 0:
+            raise SickIOException("No scans in %s" % path)
+        messages = source.messages(0, len(source))
+        scans = np.array([message.ranges for message in messages], dtype=np.uint32)
+        timestamps = np.array([message.timestamp for message in messages], dtype=np.float64)
+        return scans, timestamps, dict(source.config)
+    finally:
+        source.close()
+
+
+def make_offline_slam(num_values, config, map_size_pixels, map_size_meters, deterministic=False,
+                      max_range_mm=None, parameters=None, **slam_options):
+    """
+    A Slam node set up the way initialize() would for a scanner with this config, without an orchestrator.
+    max_range_mm clamps the readings SLAM uses below the scanner's max distance, parameters go to
+    make_algorithm and slam_options to Slam
+    """
+    scanner = ScannerConfig(config)
+    max_distance_mm = scanner.max_distance * 1000
+    if max_range_mm is not None:
+        max_distance_mm = min(max_distance_mm, max_range_mm)
+
+    slam = Slam(map_size_pixels, map_size_meters, metrics=PipelineMetrics(shared=False), **slam_options)
+    slam.lms200 = scanner
+    slam.scan_rate_hz = scanner.update_rate_hz
+    slam.detection_angle_degrees = scanner.scan_angle
+    slam.distance_no_detection_mm = 1.0
+    slam.max_distance_mm = max_distance_mm
+
+    slam.preprocessor = ScanPreprocessor(
+        num_values, max_distance_mm, scale=10.0 if scanner.measuring_units == units.CM else 1.0,
+        no_detection_mm=slam.distance_no_detection_mm, **slam.preprocessor_config
+    )
+    slam.scan_size = slam.preprocessor.scan_size
+
+    laser_config = (slam.scan_size, slam.scan_rate_hz, slam.detection_angle_degrees, slam.distance_no_detection_mm)
+    slam.algorithm = make_algorithm(laser_config, map_size_pixels, map_size_meters, deterministic, parameters)
+    slam.initialized = True
+    return slam
+
+
+def run_offline_slam(slam, scans, timestamps=None):
+    """
+    Feed scans through slam as fast as it matches them. Without timestamps, scans are spaced by the scanner's
+    update rate. Returns the seconds spent
+    """
+    batch_size = slam.preprocessor.batch_size
+    if timestamps is None:
+        timestamps = np.arange(1, len(scans) + 1) / slam.scan_rate_hz
+
+    t0 = time.perf_counter()
+    prev_timestamp = timestamps[0]
+    for start in range(0, len(scans), batch_size):
+        batch = slam.preprocessor.process(scans[start: start + batch_size])
+        for distances, timestamp in zip(batch, timestamps[start: start + batch_size].tolist()):
+            # no odometry offline, only the time between scans
+            slam.slam(distances.tolist(), [0, 0, timestamp - prev_timestamp], timestamp)
+            prev_timestamp = timestamp
+    return time.perf_counter() - t0
@@ -1,15 +1,252 @@
 import os
+import re
+import time
+import mmap
 import asyncio
+import numpy as np
 
-from atlasbuggy.log.playback import PlaybackNode
+from atlasbuggy import Node
 
 from .messages import LmsScan
+from .scanlog import ScanLogReader, scan_log_extension, parse_config_flag, log_line_regex
+from .scancache import ScanCache
 
 
-class LmsPlayback(PlaybackNode):
-    def __init__(self, file_name, directory=None, enabled=True):
-        directory = os.path.join(directory, "LMS200")
-        super(LmsPlayback, self).__init__(file_name, directory=directory, enabled=enabled)
+class TextScanSource:
+    """
+    A converted text log opened through mmap. The offsets, timestamps and scan numbers of its LmsScan lines are
+    found once with a single regex pass over the file and saved next to it, so later opens only load the index.
+    Lines are only decoded and parsed when they're played. ScanCache reads logs without saving their index,
+    its entry takes the index's place.
+    """
+
+    index_dtype = np.dtype([
+        ("timestamp", "<f8"),
+        ("n", "<u4"),
+        ("offset", "<u8"),  # start of "LmsScan(" in the file
+        ("length", "<u4"),  # up to the end of the line
+    ])
+    index_extension = ".idx.npz"
+
+    scan_regex = re.compile(rb"LmsScan\(t=([\d.]+), n=(\d*),")
+    config_regex = re.compile(rb"\n(\[[^\n]*?: (?:Selected baud|Operating mode|Measuring mode|Measuring units|"
+                              rb"Scan resolution|Scan angle|Max distance|Update rate): [^\n]*)")
+
+    def __init__(self, path, save_index=True):
+        self.path = path
+        self.file = open(self.path, 'rb')
+        if os.fstat(self.file.fileno()).st_size > 0:
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.mmap = b""  # an empty file can't be mapped, it's a log without scans
+
+        self.config = {}
+        self.index = self.load_index()
+        if self.index is None:
+            self.index = self.build_index()
+            if save_index:
+                self.save_index()
+
+    @property
+    def index_path(self):
+        return self.path + self.index_extension
+
+    def stamp(self):
+        stat = os.stat(self.path)
+        return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    def load_index(self):
+        if not os.path.isfile(self.index_path):
+            return None
+        with np.load(self.index_path) as index_file:
+            if not np.array_equal(index_file["stamp"], self.stamp()):
+                return None
+            self.config = dict(zip(index_file["config_names"].tolist(), index_file["config_values"].tolist()))
+            return index_file["index"]
+
+    def build_index(self):
+        # the first line of the file has no newline in front of it
+        for match in self.config_regex.finditer(b"\n" + self.mmap[:self.first_scan_offset()]):
+            line_match = log_line_regex.match(match.group(1).decode())
+            if line_match is not None:
+                parse_config_flag(line_match.group(1), self.config)
+
+        entries = []
+        for match in self.scan_regex.finditer(self.mmap):
+            start = match.start()
+            end = self.mmap.find(b"\n", start)
+            if end == -1:
+                end = len(self.mmap)
+            n = match.group(2)
+            entries.append((float(match.group(1)), int(n) if n else 0, start, end - start))
+        return np.array(entries, dtype=self.index_dtype)
+
+    def first_scan_offset(self):
+        match = self.scan_regex.search(self.mmap)
+        return len(self.mmap) if match is None else match.start()
+
+    def save_index(self):
+        try:
+            np.savez(self.index_path, index=self.index, stamp=self.stamp(),
+                     config_names=np.array(list(self.config.keys()), dtype=str),
+                     config_values=np.array(list(self.config.values()), dtype=np.float64))
+        except OSError:
+            pass  # read-only log directory, the index is rebuilt next time
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def timestamps(self):
+        return self.index["timestamp"]
+
+    @property
+    def start_time(self):
+        return float(self.index["timestamp"][0]) if len(self.index) > 0 else 0.0
+
+    def find_timestamp(self, timestamp):
+        return int(np.searchsorted(self.index["timestamp"], timestamp))
+
+    def find_scan_number(self, n):
+        return int(np.searchsorted(self.index["n"], n))
+
+    def message(self, position):
+        entry = self.index[position]
+        offset = int(entry["offset"])
+        return LmsScan.parse(self.mmap[offset: offset + int(entry["length"])].decode())
+
+    def messages(self, start, stop):
+        return [self.message(position) for position in range(start, stop)]
+
+    def close(self):
+        if isinstance(self.mmap, mmap.mmap):
+            self.mmap.close()
+        self.file.close()
+
+
+class ScanLogSource:
+    """A binary scan log, see scanlog.py. Its index is part of the file"""
+
+    config_names = ("session_baud", "operating_mode", "measuring_mode", "measuring_units", "scan_resolution",
+                    "scan_angle", "max_distance", "update_rate_hz")
+
+    def __init__(self, path):
+        self.path = path
+        self.reader = ScanLogReader(path)
+        # fields the log doesn't know are left at -1 or 0.0
+        self.config = {}
+        for name in self.config_names:
+            value = getattr(self.reader.header, name)
+            if value not in (-1, 0):
+                self.config[name] = value
+
+    def __len__(self):
+        return len(self.reader)
+
+    @property
+    def timestamps(self):
+        return self.reader.timestamps
+
+    @property
+    def start_time(self):
+        return float(self.reader.index["timestamp"][0]) if len(self.reader.index) > 0 else 0.0
+
+    def find_timestamp(self, timestamp):
+        return self.reader.find_timestamp(timestamp)
+
+    def find_scan_number(self, n):
+        return self.reader.find_scan_number(n)
+
+    def message(self, position):
+        return self.reader.to_message(self.reader.read(position, position + 1)[0])
+
+    def messages(self, start, stop):
+        return [self.reader.to_message(record) for record in self.reader.read(start, stop)]
+
+    def close(self):
+        self.reader.close()
+
+
+def open_scan_source(path, cache=None):
+    """
+    Open a scan log, preferring an up to date binary copy of a text log if the converter made one. Text logs
+    are played from cache, a ScanCache, when one is given
+    """
+    binary_path = os.path.splitext(path)[0] + scan_log_extension
+    if path.endswith(scan_log_extension):
+        return ScanLogSource(path)
+    elif os.path.isfile(binary_path) and os.path.getmtime(binary_path) >= os.path.getmtime(path):
+        return ScanLogSource(binary_path)
+    elif cache is not None:
+        return cache.open(path)
+    else:
+        return TextScanSource(path)
+
+
+class PlaybackClock:
+    """
+    Paces playback by the timestamps recorded with each scan.
+        "realtime" - scans are sent when they were recorded
+        "<N>x" or a number - N times faster (or slower) than they were recorded
+        "max" - as fast as the subscribers keep up, scans are sent in batches
+    """
+
+    realtime = "realtime"
+    max_throughput = "max"
+
+    def __init__(self, speed=realtime):
+        if speed == self.realtime:
+            self.speed = 1.0
+        elif speed == self.max_throughput:
+            self.speed = None
+        elif isinstance(speed, str) and speed.endswith("x"):
+            self.speed = float(speed[:-1])
+        else:
+            self.speed = float(speed)
+
+        if self.speed is not None and self.speed <= 0.0:
+            raise ValueError("Invalid playback speed: %s" % speed)
+
+        self.start_wall_time = None
+        self.start_log_time = None
+
+    @property
+    def is_paced(self):
+        return self.speed is not None
+
+    def reset(self):
+        """Start timing again from the next scan, after a seek for instance"""
+        self.start_wall_time = None
+
+    async def wait_for(self, log_time):
+        """Sleep until the scan recorded at log_time is due"""
+        if self.speed is None:
+            return
+
+        if self.start_wall_time is None:
+            self.start_wall_time = time.time()
+            self.start_log_time = log_time
+            return
+
+        delay = self.start_wall_time + (log_time - self.start_log_time) / self.speed - time.time()
+        if delay > 0.0:
+            await asyncio.sleep(delay)
+
+
+class LmsPlayback(Node):
+    def __init__(self, file_name, directory=None, enabled=True, speed=PlaybackClock.realtime, batch_size=256,
+                 cache=True):
+        """
+        :param speed: "realtime", "<N>x" or a number for N times real time, or "max". See PlaybackClock
+        :param batch_size: number of scans sent between yields to the event loop with speed="max"
+        :param cache: a ScanCache to play text logs from. True uses one in the default cache directory,
+            False parses the log every time
+        """
+        super(LmsPlayback, self).__init__(enabled)
+
+        self.file_name = file_name
+        self.directory = directory
+        self.full_path = self.find_log(file_name, directory)
 
         self.session_baud = None
 
@@ -27,29 +264,84 @@ class LmsPlayback(PlaybackNode):
 
         self.scan = None
 
-        self.parse_flags = {
-            "Selected baud: ": (int, "session_baud"),
-            "Operating mode: ": (int, "operating_mode"),
-            "Measuring mode: ": (int, "measuring_mode"),
-            "Measuring units: ": (int, "measuring_units"),
-            "Scan resolution: ": (float, "scan_resolution"),
-            "Scan angle: ": (float, "scan_angle"),
-            "Max distance: ": (float, "max_distance"),
-        }
-
-    async def parse(self, line):
-        message = line.message
-
-        flag_parsed = False
-        for flag, (value_type, variable_name) in self.parse_flags.items():
-            if message.startswith(flag):
-                self.__dict__[variable_name] = value_type(message[len(flag):])
-                flag_parsed = True
-
-        if not flag_parsed:
-            lms_message = LmsScan.parse(message)
-            if lms_message is not None:
+        if cache is True:
+            cache = ScanCache()
+        self.source = open_scan_source(self.full_path, cache or None)
+        for variable_name, value in self.source.config.items():
+            if variable_name in ("session_baud", "operating_mode", "measuring_mode", "measuring_units"):
+                value = int(value)
+            self.__dict__[variable_name] = value
+
+        # next scan to play and where playback stops
+        self.position = 0
+        self.stop_position = len(self.source)
+        self.num_seeks = 0  # lets loop notice a seek in the middle of a batch
+
+        self.clock = PlaybackClock(speed)
+        self.batch_size = batch_size if not self.clock.is_paced else 1
+
+    @staticmethod
+    def find_log(file_name, directory):
+        if directory is None:
+            return file_name
+        candidates = (os.path.join(directory, file_name), os.path.join(directory, "LMS200", file_name))
+        for path in candidates:
+            if os.path.isfile(path):
+                return path
+        return candidates[-1]
+
+    @property
+    def start_time(self):
+        return self.source.start_time
+
+    def seek(self, timestamp, relative=False):
+        """Continue playback from the first scan at or after timestamp. relative counts from the start of the log"""
+        if relative:
+            timestamp += self.start_time
+        self.position = self.source.find_timestamp(timestamp)
+        self.num_seeks += 1
+        self.clock.reset()
+
+    def seek_scan(self, scan_number):
+        """Continue playback from the scan numbered scan_number"""
+        self.position = self.source.find_scan_number(scan_number)
+        self.num_seeks += 1
+        self.clock.reset()
+
+    def set_range(self, start_time=None, end_time=None, relative=False):
+        """Only play scans between start_time and end_time. None means the start or end of the log"""
+        offset = self.start_time if relative else 0.0
+        if start_time is not None:
+            self.seek(start_time + offset)
+        self.stop_position = len(self.source) if end_time is None else self.source.find_timestamp(end_time + offset)
+
+    async def loop(self):
+        while self.position < self.stop_position:
+            start = self.position
+            stop = min(start + self.batch_size, self.stop_position)
+            lms_messages = self.source.messages(start, stop)
+            num_seeks = self.num_seeks
+
+            for position, lms_message in enumerate(lms_messages, start):
+                if lms_message is None:
+                    self.logger.warning("scan %s failed to parse" % position)
+                    self.position = position + 1
+                    continue
+
+                await self.clock.wait_for(lms_message.timestamp)
+                if self.num_seeks != num_seeks:
+                    break  # the rest of the batch is from before the seek
+
+                self.position = position + 1
+                self.scan = lms_message.scan
+                self.num_scans += 1
+                self.avg_update_hz = lms_message.avg_update_hz
                 await self.broadcast(lms_message)
-            else:
-                self.logger.warning("message failed to parse: %s" % message)
-        await asyncio.sleep(0.0)
+                if self.num_seeks != num_seeks:
+                    break
+            await asyncio.sleep(0.0)
+
+        self.logger.info("Playback finished after %s scans" % self.num_scans)
+
+    async def teardown(self):
+        self.source.close()
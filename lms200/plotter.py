@@ -1,12 +1,20 @@
-import asyncio
 import math
+import time
 import numpy as np
 
 from atlasbuggy import Node
 
+from .sick import units
+
+
 class LMSPlotter(Node):
-    def __init__(self):
-        super(LMSPlotter, self).__init__()
+    def __init__(self, enabled=True, coalesce=True, max_points=None):
+        """
+        :param coalesce: when scans arrive faster than they're drawn, only draw the newest one and count the
+            rest as dropped frames. Otherwise every scan is drawn
+        :param max_points: downsample each point cloud to at most this many points. None draws every point
+        """
+        super(LMSPlotter, self).__init__(enabled)
 
         self.lms_tag = 'lms'
         self.lms = None
@@ -19,6 +27,20 @@ class LMSPlotter(Node):
 
         self.angles = None
 
+        # cos and sin of every beam angle, rebuilt when the scanner config changes
+        self.unit_vectors = None
+        self.angle_config = None
+
+        self.coalesce = coalesce
+        self.max_points = max_points
+
+        self.num_frames = 0
+        self.dropped_frames = 0
+        self.render_fps = 0.0
+        self.fps_window = 1.0  # seconds of frames render_fps is measured over
+        self._window_start = None
+        self._window_frames = 0
+
     def take(self):
         self.lms = self.lms_sub.get_producer()
         self.lms_queue = self.lms_sub.get_queue()
@@ -29,29 +51,55 @@ class LMSPlotter(Node):
 
     async def loop(self):
         while True:
-            if self.lms_queue.empty():
-                await asyncio.sleep(0.0)
-                continue
-
-            lms_msg = await self.lms_queue.get()
-            x, y = self.get_point_cloud(lms_msg.scan)
-
-            self.plotter.plot("LMS200", x, y)
-
-            await asyncio.sleep(0.0)
+            # collect every scan that piled up in the queue while the last frame was drawn
+            lms_messages = [await self.lms_queue.get()]
+            while not self.lms_queue.empty():
+                lms_messages.append(self.lms_queue.get_nowait())
+
+            if self.coalesce:
+                # the renderer is behind, skip straight to the newest scan
+                self.dropped_frames += len(lms_messages) - 1
+                lms_messages = lms_messages[-1:]
+
+            for point_cloud in self.get_point_clouds([lms_msg.ranges for lms_msg in lms_messages]):
+                point_cloud = self.decimate(point_cloud)
+                self.plotter.plot("LMS200", point_cloud[:, 0], point_cloud[:, 1])
+                self.count_frame()
+
+    def decimate(self, point_cloud):
+        """Keep every k-th point so at most max_points are drawn"""
+        if self.max_points is None or len(point_cloud) <= self.max_points:
+            return point_cloud
+        step = int(math.ceil(len(point_cloud) / self.max_points))
+        return point_cloud[::step]
+
+    def count_frame(self):
+        now = time.time()
+        self.num_frames += 1
+        if self._window_start is None:
+            self._window_start = now
+            self._window_frames = 0
+            return
+
+        self._window_frames += 1
+        elapsed = now - self._window_start
+        if elapsed >= self.fps_window:
+            self.render_fps = self._window_frames / elapsed
+            self._window_start = now
+            self._window_frames = 0
 
     def get_point_cloud(self, scan):
-        x = []
-        y = []
-        num_points = len(scan)
-        for i, r in enumerate(scan):
-            if r > self.lms.max_distance * 1000:
-                continue
-            angle = i * ((2*math.pi)/num_points)
-            x.append(r * np.cos(angle))
-            y.append(r * np.sin(angle))
-
-        return x, y
+        """Convert one scan into an (N, 2) array of x, y points in mm. Points out of range are left out"""
+        points, in_range = self.make_point_cloud(np.asarray(scan))
+        return points[in_range]
+
+    def get_point_clouds(self, scans):
+        """Convert a batch of scans. Scans of the same length are converted together"""
+        if len(scans) > 1 and all(len(scan) == len(scans[0]) for scan in scans):
+            points, in_range = self.make_point_cloud(np.vstack(scans))
+            return [scan_points[scan_in_range] for scan_points, scan_in_range in zip(points, in_range)]
+        else:
+            return [self.get_point_cloud(scan) for scan in scans]
 
     def make_angles(self):
         """Create angles list in the correct format and units (radians)"""
@@ -61,19 +109,31 @@ class LMSPlotter(Node):
 
         self.angles = np.arange(0, scan_angle_radians + resolution_radians, resolution_radians)
 
-    def make_distances(self, scan):
-        """Convert the current scan into the correct format and units (meters)"""
-        distances = np.array(scan, dtype=np.float32)
-
+    def make_unit_vectors(self, num_values):
+        """Precompute cos and sin of each beam for the current scanner config"""
+        angle_config = (self.lms.scan_angle, self.lms.scan_resolution, num_values)
+        if self.angle_config == angle_config:
+            return
+        self.angle_config = angle_config
+
+        if self.lms.scan_resolution > 0:
+            self.make_angles()
+        if self.lms.scan_resolution <= 0 or len(self.angles) != num_values:
+            # the scanner config isn't known (or doesn't match the scans), spread the beams over the scan angle
+            self.angles = np.linspace(0.0, math.radians(self.lms.scan_angle or 180.0), num_values)
+
+        self.unit_vectors = np.stack([np.cos(self.angles), np.sin(self.angles)], axis=-1)
+
+    def make_point_cloud(self, scans):
+        """
+        Convert a scan, or a (batch, N) array of scans, into x, y points in mm with shape (..., N, 2).
+        Also returns a mask of the points within the scanner's max distance.
+        """
+        self.make_unit_vectors(scans.shape[-1])
+
+        distances = scans.astype(np.float32)
         if self.lms.measuring_units == units.CM:
             distances *= 10
 
-        # self.distances = np.ma.masked_array(self.distances, self.distances > self.max_distance)
-        distances[distances > self.max_distance_mm] = 1
-
-        return distances
-
-    def make_point_cloud(self, distances):
-        """Convert distance and angle lists into a 2D point cloud using numpy operations"""
-        return np.vstack(
-            [distances * np.cos(self.angles), distances * np.sin(self.angles)]).T
+        in_range = distances <= self.lms.max_distance * 1000
+        return distances[..., np.newaxis] * self.unit_vectors, in_range
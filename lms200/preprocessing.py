@@ -0,0 +1,101 @@
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+class ScanPreprocessor:
+    """
+    Turns raw scans into the distances the SLAM engine takes, a batch at a time. All the work happens in
+    buffers allocated up front:
+        - unit conversion to mm
+        - optional median filter over median_size neighbouring beams. With outlier_threshold_mm set, only
+          beams further than that from the median of their neighbours are replaced by the median
+        - readings past max_distance_mm are replaced by no_detection_mm
+        - angular downsampling, keeping every downsample-th beam
+    """
+
+    def __init__(self, num_values, max_distance_mm, scale=1.0, no_detection_mm=1.0, batch_size=16,
+                 median_size=0, outlier_threshold_mm=None, downsample=1):
+        if median_size < 0 or (median_size > 0 and median_size % 2 == 0):
+            raise ValueError("Median filter size must be odd, got %s" % median_size)
+        if downsample < 1:
+            raise ValueError("Invalid downsample factor: %s" % downsample)
+
+        self.num_values = num_values
+        self.max_distance_mm = max_distance_mm
+        self.scale = scale
+        self.no_detection_mm = no_detection_mm
+        self.batch_size = batch_size
+        self.median_size = median_size
+        self.outlier_threshold_mm = outlier_threshold_mm
+        self.downsample = downsample
+
+        self.distances = np.zeros((batch_size, num_values), dtype=np.float32)
+
+        # outlier rejection compares against the median of the 3 nearest beams unless median_size says otherwise
+        self.window = median_size if median_size > 0 else (3 if outlier_threshold_mm is not None else 0)
+        if self.window > 0:
+            # edges are padded by repeating the end beams
+            self.padded = np.zeros((batch_size, num_values + self.window - 1), dtype=np.float32)
+            self.medians = np.zeros((batch_size, num_values), dtype=np.float32)
+            self.deviations = np.zeros((batch_size, num_values), dtype=np.float32)
+            self.outliers = np.zeros((batch_size, num_values), dtype=bool)
+        self.out_of_range = np.zeros((batch_size, num_values), dtype=bool)
+
+    @property
+    def scan_size(self):
+        """Number of beams in a preprocessed scan"""
+        return len(range(0, self.num_values, self.downsample))
+
+    def process(self, scans):
+        """
+        Preprocess up to batch_size scans. Scans with fewer than num_values beams are padded with no detections,
+        longer ones are cut off. Returns a (len(scans), scan_size) view into a buffer that's reused by the next
+        call, copy it or convert it before then.
+        """
+        num_scans = len(scans)
+        if num_scans > self.batch_size:
+            raise ValueError("Batch of %s scans, the preprocessor holds %s" % (num_scans, self.batch_size))
+
+        distances = self.distances[:num_scans]
+        lengths = []
+        for row, scan in zip(distances, scans):
+            length = min(len(scan), self.num_values)
+            row[:length] = scan[:length]
+            lengths.append(length)
+
+        if self.scale != 1.0:
+            distances *= self.scale
+
+        # beams a short scan doesn't have (subrange mode, a truncated read) are no detections
+        for row, length in zip(distances, lengths):
+            row[length:] = self.no_detection_mm
+
+        if self.window > 0:
+            self.filter(distances, num_scans)
+
+        out_of_range = np.greater(distances, self.max_distance_mm, out=self.out_of_range[:num_scans])
+        distances[out_of_range] = self.no_detection_mm
+
+        return distances[:, ::self.downsample]
+
+    def filter(self, distances, num_scans):
+        half = self.window // 2
+        padded = self.padded[:num_scans]
+        padded[:, half: half + self.num_values] = distances
+        padded[:, :half] = distances[:, :1]
+        padded[:, half + self.num_values:] = distances[:, -1:]
+
+        medians = self.medians[:num_scans]
+        # (num_scans, num_values, window) view of each beam's neighbours, sliding_window_view needs numpy 1.20
+        row_stride, beam_stride = padded.strides
+        windows = as_strided(padded, shape=(num_scans, self.num_values, self.window),
+                             strides=(row_stride, beam_stride, beam_stride), writeable=False)
+        np.median(windows, axis=-1, out=medians)
+
+        if self.outlier_threshold_mm is None:
+            distances[:] = medians
+        else:
+            deviations = np.subtract(distances, medians, out=self.deviations[:num_scans])
+            np.abs(deviations, out=deviations)
+            outliers = np.greater(deviations, self.outlier_threshold_mm, out=self.outliers[:num_scans])
+            np.copyto(distances, medians, where=outliers)
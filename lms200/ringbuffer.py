@@ -0,0 +1,275 @@
+import os
+import time
+import asyncio
+import numpy as np
+from multiprocessing import shared_memory
+
+
+class ScanRingBuffer:
+    """
+    Fixed size ring of scan slots in shared memory. One process writes scans straight into the slots
+    (get_scan_into can fill them in place), any number of readers copy them out. Nothing is pickled and
+    nothing is locked: each slot carries a sequence number that the writer invalidates before filling it
+    and sets once the scan is complete, so readers can tell when a slot changed underneath them.
+
+    overflow_policy decides what happens when the producer catches up with the consumers:
+        "overwrite" - the oldest unread scans are overwritten, readers skip ahead and count their own overruns
+        "drop" - new scans are discarded until the primary reader catches up
+
+    Every published scan also pokes a ScanNotifier so readers in an event loop can await the next scan
+    instead of polling the ring. A ring attached by name, like the device process's copy under the spawn start
+    method, can't poke the owner's notifier, so waits time out and re-check the ring every wait_timeout seconds.
+    """
+
+    overwrite_policy = "overwrite"
+    drop_policy = "drop"
+
+    writing = np.iinfo(np.uint64).max  # slot sequence number while a scan is being written
+
+    header_dtype = np.dtype([
+        ("head", np.uint64),  # sequence number of the next scan to be written
+        ("tail", np.uint64),  # next sequence number the primary reader will read
+        ("dropped", np.uint64),  # scans discarded by the drop policy
+    ])
+    header_size = 64
+
+    wait_timeout = 0.05
+
+    def __init__(self, capacity, num_values, overflow_policy="overwrite", dtype=np.uint32, name=None):
+        if overflow_policy not in (self.overwrite_policy, self.drop_policy):
+            raise ValueError("Invalid overflow policy: %s" % overflow_policy)
+        if capacity < 2:
+            raise ValueError("Ring buffer needs at least 2 slots, got %s" % capacity)
+
+        self.capacity = capacity
+        self.num_values = num_values
+        self.overflow_policy = overflow_policy
+        self.dtype = np.dtype(dtype)
+
+        self.slot_dtype = np.dtype([
+            ("seq", np.uint64),
+            ("timestamp", np.float64),
+            ("published", np.float64),  # when the scan was made visible to readers
+            ("n", np.uint64),
+            ("num_values", np.uint32),
+            ("values", self.dtype, (num_values,)),
+        ], align=True)
+
+        size = self.header_size + self.capacity * self.slot_dtype.itemsize
+        self.is_owner = name is None
+        if self.is_owner:
+            self.shared_memory = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shared_memory = shared_memory.SharedMemory(name=name)
+
+        self.header = None
+        self.slots = None
+        self._map_arrays()
+
+        if self.is_owner:
+            self.header[0] = (0, 0, 0)
+            self.slots["seq"] = self.writing
+
+        # written to instead of the ring when the drop policy discards a scan
+        self._scratch = np.zeros(self.num_values, dtype=self.dtype)
+        self._claimed = None
+
+        # pipes only survive fork, a ring attached by name has no notifier
+        self.notifier = ScanNotifier() if self.is_owner else None
+
+    def _map_arrays(self):
+        buffer = self.shared_memory.buf
+        self.header = np.ndarray((1,), dtype=self.header_dtype, buffer=buffer)
+        self.slots = np.ndarray((self.capacity,), dtype=self.slot_dtype, buffer=buffer, offset=self.header_size)
+
+    def __getstate__(self):
+        return self.name, self.capacity, self.num_values, self.overflow_policy, self.dtype
+
+    def __setstate__(self, state):
+        name, capacity, num_values, overflow_policy, dtype = state
+        self.__init__(capacity, num_values, overflow_policy, dtype, name=name)
+
+    @property
+    def name(self):
+        return self.shared_memory.name
+
+    @property
+    def head(self):
+        return int(self.header["head"][0])
+
+    @property
+    def dropped(self):
+        return int(self.header["dropped"][0])
+
+    def __len__(self):
+        """Number of scans written but not yet read by the primary reader"""
+        return min(self.head - int(self.header["tail"][0]), self.capacity)
+
+    def claim(self):
+        """
+        Producer side. Returns a writable array for the next scan. If the drop policy is discarding this scan,
+        the array is a scratch buffer and publish will throw the contents away.
+        """
+        head = self.head
+        if self.overflow_policy == self.drop_policy and head - int(self.header["tail"][0]) >= self.capacity:
+            self._claimed = None
+            return self._scratch
+
+        slot = self.slots[head % self.capacity]
+        slot["seq"] = self.writing
+        self._claimed = slot
+        return slot["values"]
+
+    def publish(self, timestamp, n, num_values):
+        """Producer side. Make the scan filled in after claim visible to readers. Returns False if it was dropped"""
+        slot = self._claimed
+        self._claimed = None
+        if slot is None:
+            self.header["dropped"] += 1
+            return False
+
+        head = self.head
+        slot["timestamp"] = timestamp
+        slot["published"] = time.time()
+        slot["n"] = n
+        slot["num_values"] = num_values
+        slot["seq"] = head
+        self.header["head"] = head + 1
+        self.notify()
+        return True
+
+    def notify(self):
+        if self.notifier is not None:
+            self.notifier.notify()
+
+    def reader(self, primary=True):
+        """
+        Create a read cursor starting at the newest scan. The primary reader's position is what the drop policy
+        compares against, there should only be one.
+        """
+        return ScanRingReader(self, primary)
+
+    def close(self):
+        self.header = None
+        self.slots = None
+        self._claimed = None
+        self.shared_memory.close()
+        if self.is_owner:
+            self.shared_memory.unlink()
+        if self.notifier is not None:
+            self.notifier.close()
+
+
+class ScanRingReader:
+    def __init__(self, ring, primary=True):
+        self.ring = ring
+        self.primary = primary
+        self.seq = ring.head
+        self.overruns = 0
+        self.published = None  # when the last scan read was published
+
+        if self.primary:
+            self.ring.header["tail"] = self.seq
+
+    def pending(self):
+        return self.ring.head - self.seq
+
+    async def wait(self):
+        """
+        Wait until there is a scan to read. Falls back to polling if the ring has no notifier, and re-checks
+        the ring every wait_timeout seconds if it does in case the writer has no way to notify it
+        """
+        while self.pending() <= 0:
+            if self.ring.notifier is None:
+                await asyncio.sleep(0.001)
+            else:
+                await self.ring.notifier.wait(self.ring.wait_timeout)
+
+    def read(self):
+        """Copy out the next scan as (timestamp, n, values). Returns None if there is no new scan"""
+        ring = self.ring
+        while True:
+            head = ring.head
+            if self.seq >= head:
+                return None
+
+            if head - self.seq > ring.capacity:
+                self._skip_to(head - ring.capacity + 1)
+                continue
+
+            slot = ring.slots[self.seq % ring.capacity]
+            if int(slot["seq"]) != self.seq:
+                # the writer lapped us while we were checking
+                self._skip_to(self.seq + 1)
+                continue
+
+            timestamp = float(slot["timestamp"])
+            published = float(slot["published"])
+            n = int(slot["n"])
+            num_values = int(slot["num_values"])
+            values = slot["values"][:num_values].copy()
+
+            if int(slot["seq"]) != self.seq:
+                self._skip_to(self.seq + 1)
+                continue
+
+            self._advance(self.seq + 1)
+            self.published = published
+            return timestamp, n, values
+
+    def _skip_to(self, seq):
+        missed = seq - self.seq
+        self.overruns += missed
+        self._advance(seq)
+
+    def _advance(self, seq):
+        self.seq = seq
+        if self.primary:
+            self.ring.header["tail"] = seq
+
+
+class ScanNotifier:
+    """
+    Wakes up an asyncio event loop from another process. The producer writes a byte into a pipe, the pipe's
+    read end is registered with the loop's add_reader so waiting costs nothing until a scan arrives.
+    """
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        os.set_blocking(self.write_fd, False)
+
+        self.event_loop = None
+        self.event = None
+
+    def notify(self):
+        try:
+            os.write(self.write_fd, b"\0")
+        except BlockingIOError:
+            pass  # the pipe is full, so the reader already has a wakeup pending
+
+    async def wait(self, timeout=None):
+        """Wait for a notification or until timeout seconds have passed"""
+        if self.event is None:
+            self.event_loop = asyncio.get_event_loop()
+            self.event = asyncio.Event()
+            self.event_loop.add_reader(self.read_fd, self._readable)
+
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.event.clear()
+
+    def _readable(self):
+        try:
+            os.read(self.read_fd, 4096)
+        except BlockingIOError:
+            pass
+        self.event.set()
+
+    def close(self):
+        if self.event_loop is not None and not self.event_loop.is_closed():
+            self.event_loop.remove_reader(self.read_fd)
+        os.close(self.read_fd)
+        os.close(self.write_fd)
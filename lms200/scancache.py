@@ -0,0 +1,252 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+from .messages import LmsScan
+from .scanlog import beam_dtype, config_num_values, max_num_values
+
+__all__ = ["ScanCache", "CachedScanSource"]
+
+
+class ScanCache:
+    """
+    Decoded scans of text logs, kept as numpy arrays so a log is only parsed the first time it's played.
+    Each log gets an entry directory named after its path holding:
+        ranges.npy - (N, values per scan) range matrix, of beam_dtype records for logs with reflectivity
+        num_values.npy, timestamps.npy, n.npy, avg_update_hz.npy - one value per scan
+        meta.json - the log's path, size and mtime when it was decoded, its scanner config and scan count
+    Entries are built chunk_size scans at a time and loaded with memory maps. An entry is rebuilt when the log's
+    size or mtime changes. Every log shares one directory, once its entries add up to more than max_bytes the
+    least recently used ones are deleted.
+    """
+
+    default_directory = os.path.join("~", ".cache", "lms200", "scans")
+    arrays = ("ranges", "num_values", "timestamps", "n", "avg_update_hz")
+    chunk_size = 4096  # scans decoded at a time while building an entry
+
+    def __init__(self, directory=None, max_bytes=1 << 30):
+        """
+        :param directory: where entries are kept. None uses ~/.cache/lms200/scans
+        """
+        self.directory = os.path.expanduser(self.default_directory if directory is None else directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def entry_path(self, path):
+        key = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:20]
+        return os.path.join(self.directory, key)
+
+    @staticmethod
+    def stamp(path):
+        stat = os.stat(path)
+        return dict(path=os.path.abspath(path), size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+    def open(self, path):
+        """
+        A CachedScanSource for a text log, decoding it into a new entry if there isn't an up to date one.
+        If the entry can't be written the log is played straight from a TextScanSource
+        """
+        entry_path = self.entry_path(path)
+        stamp = self.stamp(path)
+
+        meta = self.load_meta(entry_path)
+        if meta is None or meta["stamp"] != stamp:
+            self.misses += 1
+            meta = self.build(path, entry_path, stamp)
+            if meta is None:
+                from .playback import TextScanSource
+
+                return TextScanSource(path)
+            self.evict(keep=entry_path)
+        else:
+            self.hits += 1
+            os.utime(os.path.join(entry_path, "meta.json"))  # marks the entry as recently used
+
+        return CachedScanSource(path, entry_path, meta["config"], meta["num_scans"])
+
+    @staticmethod
+    def load_meta(entry_path):
+        try:
+            with open(os.path.join(entry_path, "meta.json")) as meta_file:
+                meta = json.load(meta_file)
+        except (OSError, ValueError):
+            return None
+        return meta if "num_scans" in meta else None  # entries from before scan counts were stored
+
+    def build(self, path, entry_path, stamp):
+        """Decode a log into entry_path. Returns the entry's meta, None if the cache directory isn't writable"""
+        from .playback import TextScanSource  # playback opens logs through the cache, it imports this module
+
+        # written to a temporary directory and moved into place, so a reader never sees half an entry
+        temporary_path = None
+        source = TextScanSource(path, save_index=False)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            temporary_path = tempfile.mkdtemp(dir=self.directory, prefix=".building-")
+            num_scans = self.write_arrays(source, temporary_path)
+
+            meta = dict(stamp=stamp, config=dict(source.config), num_scans=num_scans)
+            with open(os.path.join(temporary_path, "meta.json"), 'w') as meta_file:
+                json.dump(meta, meta_file)
+
+            if os.path.isdir(entry_path):
+                shutil.rmtree(entry_path)
+            os.rename(temporary_path, entry_path)
+        except OSError:
+            if temporary_path is not None:
+                shutil.rmtree(temporary_path, ignore_errors=True)
+            return None
+        finally:
+            source.close()
+        return meta
+
+    def write_arrays(self, source, entry_path):
+        """
+        Decode source into memory mapped .npy files, chunk_size scans at a time. Lines that don't parse are
+        skipped, so the files can have unused rows at the end. Returns the number of scans written
+        """
+        files = None
+        num_scans = 0
+        for start in range(0, len(source), self.chunk_size):
+            messages = [message for message in source.messages(start, min(start + self.chunk_size, len(source)))
+                        if message is not None]
+            if len(messages) == 0:
+                continue
+            if files is None:
+                # sized for a full scan at the log's config, widened if a scan turns out longer
+                width = max(config_num_values(source.config), len(messages[0].scan))
+                dtype = beam_dtype if messages[0].has_reflectivity else np.uint32
+                files = self.open_arrays(entry_path, len(source), width, dtype)
+
+            ranges = files["ranges"]
+            for index, message in enumerate(messages, num_scans):
+                length = len(message.scan)
+                if length > ranges.shape[1]:
+                    ranges = files["ranges"] = self.widen(entry_path, ranges, max(length, max_num_values))
+                ranges[index, :length] = message.scan
+                files["num_values"][index] = length
+                files["timestamps"][index] = message.timestamp
+                files["n"][index] = message.n
+                files["avg_update_hz"][index] = message.avg_update_hz or 0.0
+            num_scans += len(messages)
+
+        if files is None:
+            files = self.open_arrays(entry_path, 0, 0, np.uint32)
+        for array in files.values():
+            array.flush()
+        return num_scans
+
+    @staticmethod
+    def open_arrays(entry_path, num_scans, width, dtype):
+        def open_array(name, array_dtype, shape):
+            return np.lib.format.open_memmap(os.path.join(entry_path, name + ".npy"), mode='w+',
+                                             dtype=array_dtype, shape=shape)
+
+        return dict(
+            ranges=open_array("ranges", dtype, (num_scans, width)),
+            num_values=open_array("num_values", np.uint32, (num_scans,)),
+            timestamps=open_array("timestamps", np.float64, (num_scans,)),
+            n=open_array("n", np.int64, (num_scans,)),
+            avg_update_hz=open_array("avg_update_hz", np.float64, (num_scans,)),
+        )
+
+    @staticmethod
+    def widen(entry_path, ranges, width):
+        """Copy ranges into a wider range matrix that replaces it"""
+        path = os.path.join(entry_path, "ranges.npy")
+        wide_path = os.path.join(entry_path, "ranges.wide.npy")
+        wide = np.lib.format.open_memmap(wide_path, mode='w+', dtype=ranges.dtype, shape=(len(ranges), width))
+        wide[:, :ranges.shape[1]] = ranges
+        del ranges
+        os.replace(wide_path, path)
+        return wide
+
+    def entries(self):
+        """(last used, bytes, entry path) of every entry in the cache"""
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for name in os.listdir(self.directory):
+            entry_path = os.path.join(self.directory, name)
+            meta_path = os.path.join(entry_path, "meta.json")
+            if name.startswith(".") or not os.path.isfile(meta_path):
+                continue
+            size = sum(entry.stat().st_size for entry in os.scandir(entry_path) if entry.is_file())
+            entries.append((os.path.getmtime(meta_path), size, entry_path))
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=None):
+        """Delete the least recently used entries until the cache fits in max_bytes. keep is never deleted"""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_path in entries:
+            if total <= self.max_bytes:
+                break
+            if entry_path == keep:
+                continue
+            shutil.rmtree(entry_path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        """Delete every entry"""
+        for _, _, entry_path in self.entries():
+            shutil.rmtree(entry_path, ignore_errors=True)
+
+
+class CachedScanSource:
+    """A text log played from its ScanCache entry. Nothing is parsed, scans are rows of the memory mapped ranges"""
+
+    def __init__(self, path, entry_path, config, num_scans):
+        self.path = path
+        self.entry_path = entry_path
+        self.config = config
+
+        arrays = {name: np.load(os.path.join(entry_path, name + ".npy"), mmap_mode='r')[:num_scans]
+                  for name in ScanCache.arrays}
+        self.ranges = arrays["ranges"]
+        self.num_values = arrays["num_values"]
+        self.timestamps = arrays["timestamps"]
+        self.n = arrays["n"]
+        self.avg_update_hz = arrays["avg_update_hz"]
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @property
+    def start_time(self):
+        return float(self.timestamps[0]) if len(self.timestamps) > 0 else 0.0
+
+    def find_timestamp(self, timestamp):
+        return int(np.searchsorted(self.timestamps, timestamp))
+
+    def find_scan_number(self, n):
+        return int(np.searchsorted(self.n, n))
+
+    def message(self, position):
+        return LmsScan(float(self.timestamps[position]), int(self.n[position]), float(self.avg_update_hz[position]),
+                       self.ranges[position, :self.num_values[position]])
+
+    def messages(self, start, stop):
+        timestamps = self.timestamps[start: stop].tolist()
+        n = self.n[start: stop].tolist()
+        avg_update_hz = self.avg_update_hz[start: stop].tolist()
+        num_values = self.num_values[start: stop].tolist()
+        ranges = self.ranges[start: stop]
+        return [LmsScan(timestamps[index], n[index], avg_update_hz[index], ranges[index, :num_values[index]])
+                for index in range(len(timestamps))]
+
+    def close(self):
+        # the memory maps close once the scans handed out are gone
+        self.ranges = None
+        self.num_values = None
+        self.timestamps = None
+        self.n = None
+        self.avg_update_hz = None
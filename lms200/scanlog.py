@@ -0,0 +1,436 @@
+import os
+import re
+import mmap
+import zlib
+import lzma
+import struct
+import numpy as np
+
+scan_log_extension = ".lmsb"
+max_num_values = 721  # SickLMS::SICK_MAX_NUM_MEASUREMENTS, the most values a scan can have
+
+# one record per beam in MONITOR_STREAM_RANGE_AND_REFLECT, the same 4 bytes a beam takes in a uint32 scan
+beam_dtype = np.dtype([("range", "<u2"), ("reflectivity", "<u2")])
+
+
+def make_beams(ranges, reflectivity=None):
+    """A beam_dtype array from ranges and reflectivity. Beams without a reflectivity get 0"""
+    beams = np.zeros(len(ranges), dtype=beam_dtype)
+    beams["range"] = ranges
+    if reflectivity is not None:
+        beams["reflectivity"][:len(reflectivity)] = reflectivity
+    return beams
+
+
+class ScanLogHeader:
+    """
+    Fixed size header at the start of every scan log. Holds the scanner configuration that text logs
+    spread over "Selected baud: ...", "Scan angle: ..." lines, plus the layout of the records that follow.
+    """
+
+    magic = b"LMSB"
+    version = 1
+    format = struct.Struct("<4sHHIiiiddddIIBxxxQ")
+
+    compression_types = {None: 0, "zlib": 1, "lzma": 2}
+
+    reflectivity_flag = 0x1  # records hold beam_dtype beams instead of uint16 ranges
+    timestamps_flag = 0x2  # the timestamp of every scan is stored in front of the chunk index
+    known_flags = reflectivity_flag | timestamps_flag
+
+    def __init__(self, num_values, chunk_size=256, compression="zlib", session_baud=0, operating_mode=-1,
+                 measuring_mode=-1, measuring_units=-1, scan_resolution=0.0, scan_angle=0.0, max_distance=0.0,
+                 update_rate_hz=0.0, flags=0, index_offset=0):
+        if compression not in self.compression_types:
+            raise ValueError("Invalid compression: %s" % compression)
+
+        self.num_values = num_values
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.session_baud = session_baud
+        self.operating_mode = operating_mode
+        self.measuring_mode = measuring_mode
+        self.measuring_units = measuring_units
+        self.scan_resolution = scan_resolution
+        self.scan_angle = scan_angle
+        self.max_distance = max_distance
+        self.update_rate_hz = update_rate_hz
+        self.flags = flags
+        self.index_offset = index_offset
+
+    @property
+    def has_reflectivity(self):
+        return bool(self.flags & self.reflectivity_flag)
+
+    @property
+    def has_timestamps(self):
+        return bool(self.flags & self.timestamps_flag)
+
+    @property
+    def scan_field(self):
+        return "beams" if self.has_reflectivity else "ranges"
+
+    @property
+    def record_dtype(self):
+        return np.dtype([
+            ("timestamp", "<f8"),
+            ("n", "<u4"),
+            ("avg_update_hz", "<f4"),
+            ("num_values", "<u2"),
+            (self.scan_field, beam_dtype if self.has_reflectivity else "<u2", (self.num_values,)),
+        ])
+
+    def pack(self):
+        return self.format.pack(
+            self.magic, self.version, self.flags, self.session_baud, self.operating_mode, self.measuring_mode,
+            self.measuring_units, self.scan_resolution, self.scan_angle, self.max_distance, self.update_rate_hz,
+            self.num_values, self.chunk_size, self.compression_types[self.compression], self.index_offset
+        )
+
+    @classmethod
+    def unpack(cls, data):
+        (magic, version, flags, session_baud, operating_mode, measuring_mode, measuring_units, scan_resolution,
+         scan_angle, max_distance, update_rate_hz, num_values, chunk_size, compression,
+         index_offset) = cls.format.unpack_from(data)
+
+        if magic != cls.magic:
+            raise ValueError("Not a scan log (magic is %s)" % magic)
+        if version != cls.version:
+            raise ValueError("Unsupported scan log version: %s" % version)
+        if flags & ~cls.known_flags:
+            raise ValueError("Unsupported scan log flags: %#x" % flags)
+
+        compression_names = {value: name for name, value in cls.compression_types.items()}
+        return cls(num_values, chunk_size, compression_names[compression], session_baud, operating_mode,
+                   measuring_mode, measuring_units, scan_resolution, scan_angle, max_distance, update_rate_hz,
+                   flags, index_offset)
+
+
+# every chunk starts with its record count, its size on disk and whether it's compressed
+chunk_header = struct.Struct("<IIB3x")
+
+# one entry per chunk, written after the last chunk when the log is closed
+index_dtype = np.dtype([
+    ("timestamp", "<f8"),  # timestamp of the first scan in the chunk
+    ("n", "<u4"),  # scan number of the first scan in the chunk
+    ("offset", "<u8"),  # file offset of the chunk header
+    ("num_records", "<u4"),
+])
+
+
+def compress(data, compression):
+    if compression == "zlib":
+        return zlib.compress(data, 1)
+    elif compression == "lzma":
+        return lzma.compress(data, preset=1)
+    else:
+        return data
+
+
+def decompress(data, compression):
+    if compression == "zlib":
+        return zlib.decompress(data)
+    elif compression == "lzma":
+        return lzma.decompress(data)
+    else:
+        return bytes(data)
+
+
+class ScanLogWriter:
+    """
+    Writes scans as packed records (timestamp, scan number, average update rate, uint16 ranges), grouped in
+    chunks of chunk_size records that are optionally compressed. The timestamps of all scans and an index of
+    chunk offsets are appended when the log is closed. A log that was never closed is still readable, the reader
+    walks the chunks instead.
+    With reflectivity, records hold beam_dtype beams instead of ranges.
+    """
+
+    def __init__(self, path, num_values, chunk_size=256, compression="zlib", reflectivity=False, **config):
+        self.path = path
+        self.header = ScanLogHeader(num_values, chunk_size, compression, **config)
+        self.header.flags |= ScanLogHeader.timestamps_flag
+        if reflectivity:
+            self.header.flags |= ScanLogHeader.reflectivity_flag
+        self.scan_field = self.header.scan_field
+        self.record_dtype = self.header.record_dtype
+
+        self.file = open(self.path, 'wb')
+        self.file.write(self.header.pack())
+
+        self.chunk = np.zeros(chunk_size, dtype=self.record_dtype)
+        self.chunk_length = 0
+        self.index = []
+        self.timestamps = []
+        self.num_scans = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, timestamp, n, avg_update_hz, scan):
+        """scan is ranges or a beam_dtype array, whichever the log doesn't hold is converted"""
+        num_values = len(scan)
+        if num_values > self.header.num_values:
+            raise ValueError("Scan has %s values, log holds %s" % (num_values, self.header.num_values))
+
+        is_beams = isinstance(scan, np.ndarray) and scan.dtype.names is not None
+        if self.header.has_reflectivity and not is_beams:
+            scan = make_beams(scan)
+        elif not self.header.has_reflectivity and is_beams:
+            scan = scan["range"]
+
+        record = self.chunk[self.chunk_length]
+        record["timestamp"] = timestamp
+        record["n"] = n
+        record["avg_update_hz"] = avg_update_hz
+        record["num_values"] = num_values
+        values = record[self.scan_field]
+        values[:num_values] = scan
+        values[num_values:] = 0
+
+        self.chunk_length += 1
+        self.num_scans += 1
+        if self.chunk_length == len(self.chunk):
+            self.flush()
+
+    def write_message(self, message):
+        self.write(message.timestamp, message.n, message.avg_update_hz, message.scan)
+
+    def flush(self):
+        if self.chunk_length == 0:
+            return
+
+        records = self.chunk[:self.chunk_length]
+        raw = records.tobytes()
+        data = compress(raw, self.header.compression)
+        is_compressed = len(data) < len(raw)
+        if not is_compressed:
+            data = raw
+
+        self.index.append((records[0]["timestamp"], records[0]["n"], self.file.tell(), self.chunk_length))
+        self.timestamps.append(records["timestamp"].copy())
+        self.file.write(chunk_header.pack(self.chunk_length, len(data), is_compressed))
+        self.file.write(data)
+        self.chunk_length = 0
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush()
+
+        for timestamps in self.timestamps:
+            self.file.write(timestamps.tobytes())
+        self.header.index_offset = self.file.tell()
+        self.file.write(np.array(self.index, dtype=index_dtype).tobytes())
+        self.file.seek(0)
+        self.file.write(self.header.pack())
+        self.file.close()
+
+
+class ScanLogReader:
+    """
+    Random access to a scan log through mmap. Uncompressed chunks are returned as views of the file,
+    compressed chunks are decompressed on demand and the most recent one is kept around.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(self.path, 'rb')
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.header = ScanLogHeader.unpack(self.mmap)
+        self.record_dtype = self.header.record_dtype
+
+        if self.header.index_offset > 0:
+            num_chunks = (len(self.mmap) - self.header.index_offset) // index_dtype.itemsize
+            self.index = np.frombuffer(self.mmap, dtype=index_dtype, count=num_chunks,
+                                       offset=self.header.index_offset).copy()
+        else:
+            self.index = self.build_index()
+
+        # global scan number of the first record in each chunk
+        self.chunk_starts = np.zeros(len(self.index) + 1, dtype=np.int64)
+        np.cumsum(self.index["num_records"], out=self.chunk_starts[1:])
+
+        self._cached_chunk = None
+        self._cached_records = None
+
+        self._timestamps = None
+        if self.header.has_timestamps and self.header.index_offset > 0:
+            self._timestamps = np.frombuffer(self.mmap, dtype="<f8", count=len(self),
+                                             offset=self.header.index_offset - len(self) * 8).copy()
+
+    def build_index(self):
+        """Walk the chunks of a log that wasn't closed properly"""
+        index = []
+        offset = ScanLogHeader.format.size
+        end = len(self.mmap)
+        while offset + chunk_header.size <= end:
+            num_records, size, is_compressed = chunk_header.unpack_from(self.mmap, offset)
+            if offset + chunk_header.size + size > end:
+                break  # partially written chunk
+            self._cached_chunk = None
+            records = self._load_chunk(offset)
+            index.append((records[0]["timestamp"], records[0]["n"], offset, num_records))
+            offset += chunk_header.size + size
+        return np.array(index, dtype=index_dtype)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return int(self.chunk_starts[-1])
+
+    @property
+    def timestamps(self):
+        """Timestamp of every scan. Logs that weren't closed or don't store them read them from the chunks"""
+        if self._timestamps is None:
+            self._timestamps = np.zeros(len(self), dtype="<f8")
+            for chunk_index in range(len(self.index)):
+                records = self._load_chunk(int(self.index[chunk_index]["offset"]))
+                start, stop = self.chunk_starts[chunk_index], self.chunk_starts[chunk_index + 1]
+                self._timestamps[start: stop] = records["timestamp"]
+        return self._timestamps
+
+    def _load_chunk(self, offset):
+        num_records, size, is_compressed = chunk_header.unpack_from(self.mmap, offset)
+        data_offset = offset + chunk_header.size
+        if is_compressed:
+            data = decompress(self.mmap[data_offset: data_offset + size], self.header.compression)
+            return np.frombuffer(data, dtype=self.record_dtype, count=num_records)
+        else:
+            return np.frombuffer(self.mmap, dtype=self.record_dtype, count=num_records, offset=data_offset)
+
+    def read_chunk(self, chunk_index):
+        if self._cached_chunk != chunk_index:
+            self._cached_records = self._load_chunk(int(self.index[chunk_index]["offset"]))
+            self._cached_chunk = chunk_index
+        return self._cached_records
+
+    def read(self, start=0, stop=None):
+        """Records from scan index start up to stop as one structured array"""
+        stop = len(self) if stop is None else min(stop, len(self))
+        if start >= stop:
+            return np.zeros(0, dtype=self.record_dtype)
+
+        first_chunk = int(np.searchsorted(self.chunk_starts, start, side="right")) - 1
+        last_chunk = int(np.searchsorted(self.chunk_starts, stop - 1, side="right")) - 1
+
+        parts = []
+        for chunk_index in range(first_chunk, last_chunk + 1):
+            records = self.read_chunk(chunk_index)
+            chunk_start = self.chunk_starts[chunk_index]
+            parts.append(records[max(start - chunk_start, 0): stop - chunk_start])
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def __iter__(self):
+        for chunk_index in range(len(self.index)):
+            yield from self.read_chunk(chunk_index)
+
+    def find_timestamp(self, timestamp):
+        """Index of the first scan at or after timestamp"""
+        chunk_index = max(int(np.searchsorted(self.index["timestamp"], timestamp, side="right")) - 1, 0)
+        if chunk_index >= len(self.index):
+            return len(self)
+        records = self.read_chunk(chunk_index)
+        return int(self.chunk_starts[chunk_index] + np.searchsorted(records["timestamp"], timestamp))
+
+    def find_scan_number(self, n):
+        """Index of the first scan whose scan number is n or later"""
+        chunk_index = max(int(np.searchsorted(self.index["n"], n, side="right")) - 1, 0)
+        if chunk_index >= len(self.index):
+            return len(self)
+        records = self.read_chunk(chunk_index)
+        return int(self.chunk_starts[chunk_index] + np.searchsorted(records["n"], n))
+
+    def to_message(self, record):
+        from .messages import LmsScan  # messages imports beam_dtype from here
+
+        return LmsScan(float(record["timestamp"]), int(record["n"]), float(record["avg_update_hz"]),
+                       record[self.header.scan_field][:record["num_values"]])
+
+    def close(self):
+        self._cached_records = None
+        try:
+            self.mmap.close()
+        except BufferError:
+            pass  # records handed out still point into the file, the map closes once they're gone
+        self.file.close()
+
+
+# config lines text logs carry before the scans start
+config_flags = {
+    "Selected baud: ": (int, "session_baud"),
+    "Operating mode: ": (int, "operating_mode"),
+    "Measuring mode: ": (int, "measuring_mode"),
+    "Measuring units: ": (int, "measuring_units"),
+    "Scan resolution: ": (float, "scan_resolution"),
+    "Scan angle: ": (float, "scan_angle"),
+    "Max distance: ": (float, "max_distance"),
+    "Update rate: ": (float, "update_rate_hz"),
+}
+
+def config_num_values(config):
+    """Values in a full scan with config's scan angle and resolution, max_num_values if the log didn't say"""
+    scan_angle = config.get("scan_angle", 0.0)
+    scan_resolution = config.get("scan_resolution", 0.0)
+    if scan_angle > 0 and scan_resolution > 0:
+        return int(round(scan_angle / scan_resolution)) + 1
+    return max_num_values
+
+
+log_line_regex = re.compile(r"\[.*?\]\[[A-Z]*\] [\d-]* [\d:,]*: (.*)")
+
+
+def parse_config_flag(message, config):
+    for flag, (value_type, variable_name) in config_flags.items():
+        if message.startswith(flag):
+            try:
+                config[variable_name] = value_type(message[len(flag):])
+            except ValueError:
+                pass  # enums logged by name instead of value
+            return True
+    return False
+
+
+def convert_text_log(path, new_path=None, chunk_size=256, compression="zlib"):
+    """
+    Convert a converted/*/LMS200/*.log text log into a scan log next to it. Returns the new path.
+    Config lines have to come before the first scan, which is how LMS200 writes them.
+    """
+    from .messages import LmsScan  # messages imports beam_dtype from here
+
+    if new_path is None:
+        new_path = os.path.splitext(path)[0] + scan_log_extension
+
+    config = {}
+    writer = None
+    with open(path) as log_file:
+        for line in log_file:
+            match = log_line_regex.match(line)
+            message = match.group(1) if match is not None else line
+            message = message.rstrip("\n")
+
+            if parse_config_flag(message, config):
+                continue
+
+            scan = LmsScan.parse(message)
+            if scan is None:
+                continue
+
+            if writer is None:
+                # sized for a full scan, not the first one
+                writer = ScanLogWriter(new_path, max(config_num_values(config), len(scan.scan)), chunk_size,
+                                       compression, scan.has_reflectivity, **config)
+            writer.write_message(scan)
+
+    if writer is None:
+        writer = ScanLogWriter(new_path, 0, chunk_size, compression, **config)
+    writer.close()
+
+    return new_path
@@ -0,0 +1,233 @@
+import math
+import time
+import asyncio
+import collections
+import numpy as np
+
+from atlasbuggy import Node
+
+from .messages import LmsScan
+from .sick import units, operating_modes
+
+
+class ScannerMount:
+    """Where a scanner sits on the robot. x is forward, y is left, yaw turns the scanner's 0 degree beam"""
+
+    def __init__(self, x_mm=0.0, y_mm=0.0, yaw_degrees=0.0):
+        self.x_mm = x_mm
+        self.y_mm = y_mm
+        self.yaw_degrees = yaw_degrees
+
+    def __str__(self):
+        return "%s(x=%s, y=%s, yaw=%s)" % (self.__class__.__name__, self.x_mm, self.y_mm, self.yaw_degrees)
+
+
+class LatencyStats:
+    """Delay between when a scan was taken and when the group received it, over the last window_size scans"""
+
+    def __init__(self, window_size=256):
+        self.latencies = collections.deque(maxlen=window_size)
+        self.num_scans = 0
+        self.num_unmatched = 0  # scans that never found partners from the other scanners
+        self.max_latency = 0.0
+
+    def add(self, latency):
+        self.latencies.append(latency)
+        self.num_scans += 1
+        self.max_latency = max(self.max_latency, latency)
+
+    def summary(self):
+        if len(self.latencies) == 0:
+            return dict(scans=0, unmatched=self.num_unmatched, p50=0.0, p99=0.0, max=0.0)
+        p50, p99 = np.percentile(self.latencies, (50, 99))
+        return dict(scans=self.num_scans, unmatched=self.num_unmatched, p50=float(p50), p99=float(p99),
+                    max=self.max_latency)
+
+
+class ScannerGroup(Node):
+    """
+    Fuses scans from several LMS200s (or playbacks) into one 360 degree scan around the robot.
+    Each scanner is subscribed to with its own tag, all of them run in their own device processes. Scans are
+    matched by timestamp, every scanner has to contribute a scan within sync_tolerance seconds of the others.
+    The matched scans are moved into the robot frame with each scanner's ScannerMount and binned by angle
+    around the robot, the closest reading wins a bin.
+
+    The fused scans are LmsScan messages in mm with fused_resolution degrees between beams, so Slam can
+    subscribe to a group like it does to a single LMS200.
+    """
+
+    def __init__(self, mounts, enabled=True, log_level=None, sync_tolerance=0.05, fused_resolution=1.0,
+                 buffer_size=8):
+        """
+        :param mounts: dict of subscription tag to the ScannerMount of that scanner
+        :param sync_tolerance: most seconds apart the scans fused together can be
+        :param fused_resolution: degrees between the fused scan's beams
+        :param buffer_size: scans kept per scanner while waiting for the others
+        """
+        super(ScannerGroup, self).__init__(enabled, log_level)
+
+        self.mounts = mounts
+        self.sync_tolerance = sync_tolerance
+        self.buffer_size = buffer_size
+
+        self.scanner_subs = {}
+        for tag in self.mounts:
+            self.scanner_subs[tag] = self.define_subscription(
+                tag, message_type=LmsScan,
+                required_attributes=("update_rate_hz", "scan_angle", "scan_resolution", "measuring_units",
+                                     "max_distance")
+            )
+        self.scanners = {}
+        self.scanner_queues = {}
+        self.buffers = {tag: collections.deque(maxlen=buffer_size) for tag in self.mounts}
+        self.latency = {tag: LatencyStats() for tag in self.mounts}
+
+        # what Slam and the plotters read off their producer
+        self.scan_angle = 360.0
+        self.scan_resolution = fused_resolution
+        self.measuring_units = units.MM
+        self.max_distance = None
+        self.update_rate_hz = None
+        # Slam sizes its laser from the angles between 0 and scan_angle inclusive, the beams past a full turn
+        # repeat the first ones
+        resolution_radians = math.radians(fused_resolution)
+        self.num_values = len(np.arange(0, math.radians(self.scan_angle) + resolution_radians, resolution_radians))
+        self.beams_per_turn = int(round(360.0 / fused_resolution))
+
+        # beam directions of each scanner in the robot frame, built from the first scan of each
+        self.beam_directions = {}
+        self.scales = {}
+
+        self.num_fused = 0
+
+    def take(self):
+        for tag, subscription in self.scanner_subs.items():
+            self.scanners[tag] = subscription.get_producer()
+            self.scanner_queues[tag] = subscription.get_queue()
+
+    @property
+    def is_live(self):
+        """Fused scans keep the timestamps of the scans they're made of, they're live when every scanner is"""
+        return len(self.scanners) > 0 and all(getattr(scanner, "is_live", False)
+                                              for scanner in self.scanners.values())
+
+    def configure(self):
+        """Take on the slowest rate and longest range of the scanners once they're all running"""
+        self.update_rate_hz = min(scanner.update_rate_hz for scanner in self.scanners.values())
+        self.max_distance = max(scanner.max_distance for scanner in self.scanners.values())
+        for tag, scanner in self.scanners.items():
+            self.logger.info("%s at %s, %s degrees every %s degrees" % (
+                tag, self.mounts[tag], scanner.scan_angle, scanner.scan_resolution))
+
+    def make_beam_directions(self, tag, num_values):
+        scanner = self.scanners[tag]
+        mount = self.mounts[tag]
+
+        first_beam = 0
+        if getattr(scanner, "stream_mode", None) == operating_modes.MONITOR_STREAM_VALUES_SUBRANGE:
+            first_beam = scanner.subrange[0] - 1  # the scanner numbers beams from 1
+        beam_angles = np.radians((np.arange(num_values) + first_beam) * scanner.scan_resolution + mount.yaw_degrees)
+
+        self.beam_directions[tag] = np.stack([np.cos(beam_angles), np.sin(beam_angles)], axis=-1)
+        self.scales[tag] = 10.0 if scanner.measuring_units == units.CM else 1.0
+
+    async def loop(self):
+        # one pending get per scanner, whichever scanner answers first is handled first
+        getters = {}
+        try:
+            while True:
+                for tag, queue in self.scanner_queues.items():
+                    if tag not in getters:
+                        getters[tag] = asyncio.ensure_future(queue.get())
+
+                done, _ = await asyncio.wait(getters.values(), return_when=asyncio.FIRST_COMPLETED)
+                for tag in [tag for tag, getter in getters.items() if getter in done]:
+                    self.add_scan(tag, getters.pop(tag).result())
+
+                    while not self.scanner_queues[tag].empty():
+                        self.add_scan(tag, self.scanner_queues[tag].get_nowait())
+
+                fused = self.match()
+                while fused is not None:
+                    await self.broadcast(fused)
+                    fused = self.match()
+        finally:
+            for getter in getters.values():
+                getter.cancel()
+
+    def add_scan(self, tag, scan_message):
+        self.latency[tag].add(time.time() - scan_message.timestamp)
+        if len(self.buffers[tag]) == self.buffer_size:
+            self.latency[tag].num_unmatched += 1
+        self.buffers[tag].append(scan_message)
+
+    def match(self):
+        """Fuse the next set of scans that are within sync_tolerance of each other, if there is one"""
+        if any(len(buffer) == 0 for buffer in self.buffers.values()):
+            return None
+
+        # the scanner furthest behind sets the time the others are matched to
+        match_time = min(buffer[-1].timestamp for buffer in self.buffers.values())
+
+        matched = {}
+        for tag, buffer in self.buffers.items():
+            closest = min(buffer, key=lambda scan_message: abs(scan_message.timestamp - match_time))
+            if abs(closest.timestamp - match_time) > self.sync_tolerance:
+                # nothing from this scanner lines up, forget scans too old to ever match
+                self.discard_before(match_time - self.sync_tolerance)
+                return None
+            matched[tag] = closest
+
+        for tag, scan_message in matched.items():
+            while self.buffers[tag][0] is not scan_message:
+                self.buffers[tag].popleft()
+                self.latency[tag].num_unmatched += 1
+            self.buffers[tag].popleft()
+
+        return self.fuse(matched, match_time)
+
+    def discard_before(self, timestamp):
+        for tag, buffer in self.buffers.items():
+            while len(buffer) > 0 and buffer[0].timestamp < timestamp:
+                buffer.popleft()
+                self.latency[tag].num_unmatched += 1
+
+    def fuse(self, matched, timestamp):
+        if self.update_rate_hz is None:
+            self.configure()
+
+        points = []
+        for tag, scan_message in matched.items():
+            scan = np.asarray(scan_message.ranges)
+            if tag not in self.beam_directions or len(self.beam_directions[tag]) != len(scan):
+                self.make_beam_directions(tag, len(scan))
+
+            distances = scan * self.scales[tag]
+            valid = (distances > 0) & (distances <= self.scanners[tag].max_distance * 1000)
+            mount = self.mounts[tag]
+            points.append(distances[valid, np.newaxis] * self.beam_directions[tag][valid] + (mount.x_mm, mount.y_mm))
+        points = np.concatenate(points)
+
+        # back to polar around the robot's origin, keeping the closest reading in each beam
+        angles = np.degrees(np.arctan2(points[:, 1], points[:, 0])) % 360.0
+        ranges = np.hypot(points[:, 0], points[:, 1])
+        bins = np.rint(angles / self.scan_resolution).astype(np.int64) % self.beams_per_turn
+
+        closest = np.full(self.num_values, np.inf)
+        np.minimum.at(closest, bins, ranges)
+        closest[self.beams_per_turn:] = closest[:self.num_values - self.beams_per_turn]
+        closest[np.isinf(closest)] = 0
+
+        self.num_fused += 1
+        fused_scan = closest.astype(np.uint32)
+        avg_update_hz = min(scan_message.avg_update_hz or 0.0 for scan_message in matched.values())
+        return LmsScan(timestamp, self.num_fused, avg_update_hz, fused_scan)
+
+    def latency_stats(self):
+        return {tag: stats.summary() for tag, stats in self.latency.items()}
+
+    async def teardown(self):
+        for tag, stats in self.latency_stats().items():
+            self.logger.info("%s: %s scans, %s unmatched, latency p50 %0.1fms, p99 %0.1fms, max %0.1fms" % (
+                tag, stats["scans"], stats["unmatched"], stats["p50"] * 1000, stats["p99"] * 1000,
+                stats["max"] * 1000))
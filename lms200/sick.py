@@ -0,0 +1,4 @@
+# The sicktoolbox binding. A missing extension is an error: a robot that failed to build it must not end up
+# mapping a simulated room. SimulatedSickLMS is only used when it's passed to LMS200(device=...)
+from .sicktoolbox import SickLMS, units, bauds, measuring_modes, operating_modes, scan_angles, scan_resolutions, \
+    SickIOException, MAX_NUM_MEASUREMENTS
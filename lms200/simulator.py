@@ -0,0 +1,381 @@
+import os
+import re
+import enum
+import lzma
+import time
+import array
+import struct
+import numpy as np
+
+from .scanlog import log_line_regex, parse_config_flag, beam_dtype
+
+__all__ = ["SimulatedSickLMS", "sick_crc16"]
+
+
+class SickEnum(enum.IntEnum):
+    def __str__(self):
+        # logged as numbers so the config flags parse back out of text logs
+        return str(self.value)
+
+
+def make_enum(name, **members):
+    """An int enum that looks like the binding's: members compare equal to their values, values maps back"""
+    enum_type = SickEnum(name, members)
+    enum_type.values = {member.value: member for member in enum_type}
+    enum_type.names = {member.name: member for member in enum_type}
+    return enum_type
+
+
+# the sicktoolbox enums, for when the extension isn't built. Values match SickLMS.hh
+bauds = make_enum("bauds", SICK_BAUD_9600=0x42, SICK_BAUD_19200=0x41, SICK_BAUD_38400=0x40, SICK_BAUD_500K=0x48,
+                  SICK_BAUD_UNKNOWN=0xFF)
+scan_angles = make_enum("scan_angles", ANGLE_90=90, ANGLE_100=100, ANGLE_180=180, UNKNOWN=0xFF)
+scan_resolutions = make_enum("scan_resolutions", RESOLUTION_25=25, RESOLUTION_50=50, RESOLUTION_100=100,
+                             UNKNOWN=0xFF)
+units = make_enum("units", CM=0x00, MM=0x01, UNKNOWN=0xFF)
+operating_modes = make_enum(
+    "operating_modes", INSTALLATION=0x00, DIAGNOSTIC=0x10, MONITOR_STREAM_MIN_VALUE_FOR_EACH_SEGMENT=0x20,
+    MONITOR_TRIGGER_MIN_VALUE_ON_OBJECT=0x21, MONITOR_STREAM_MIN_VERT_DIST_TO_OBJECT=0x22,
+    MONITOR_TRIGGER_MIN_VERT_DIST_TO_OBJECT=0x23, MONITOR_STREAM_VALUES=0x24, MONITOR_REQUEST_VALUES=0x25,
+    MONITOR_STREAM_MEAN_VALUES=0x26, MONITOR_STREAM_VALUES_SUBRANGE=0x27, MONITOR_STREAM_MEAN_VALUES_SUBRANGE=0x28,
+    MONITOR_STREAM_VALUES_WITH_FIELDS=0x29, MONITOR_STREAM_VALUES_FROM_PARTIAL_SCAN=0x2A,
+    MONITOR_STREAM_RANGE_AND_REFLECT_FROM_PARTIAL_SCAN=0x2B, MONITOR_STREAM_MIN_VALUES_FOR_EACH_SEGMENT_SUBRANGE=0x2C,
+    MONITOR_NAVIGATION=0x2E, MONITOR_STREAM_RANGE_AND_REFLECT=0x50, UNKNOWN=0xFF
+)
+measuring_modes = make_enum(
+    "measuring_modes", MODE_8_OR_80_FA_FB_DAZZLE=0x00, MODE_8_OR_80_REFLECTOR=0x01, MODE_8_OR_80_FA_FB_FC=0x02,
+    MODE_16_REFLECTOR=0x03, MODE_16_FA_FB=0x04, MODE_32_REFLECTOR=0x05, MODE_32_FA=0x06, MODE_32_IMMEDIATE=0x0F,
+    MODE_REFLECTIVITY=0x3F, MODE_UNKNOWN=0xFF
+)
+
+MAX_NUM_MEASUREMENTS = 721
+
+
+class SickIOException(Exception):
+    pass
+
+
+class SickTimeoutException(Exception):
+    pass
+
+
+class SickConfigException(Exception):
+    pass
+
+
+def sick_crc16(data):
+    """The CRC at the end of every LMS telegram"""
+    crc = 0
+    previous = 0
+    for byte in data:
+        if crc & 0x8000:
+            crc = ((crc & 0x7fff) << 1) ^ 0x8005
+        else:
+            crc <<= 1
+        crc = (crc ^ (byte | (previous << 8))) & 0xffff
+        previous = byte
+    return crc
+
+
+class SimulatedSickLMS:
+    """
+    Stands in for the sicktoolbox SickLMS, same methods, no scanner needed. Scans come from a recorded log
+    (a raw logs/*.log.xz, a converted text log or a binary scan log) played in a loop, or from a synthetic
+    rectangular room. Synthetic rooms have reflector posts at reflector_angles degrees into the scan, they show up
+    in MONITOR_STREAM_RANGE_AND_REFLECT scans.
+
+    Scans are paced like the real device: the slower of the mirror rate and what the serial link carries at the
+    session baud, unless rate_hz is given. jitter adds gaussian delay (in seconds) to each scan. With use_pty,
+    each scan is also written as an LMS measured-values telegram to a pseudo-terminal, pty_name is the path
+    serial readers can open.
+
+    Pass one to LMS200(device=...) to run the whole pipeline without hardware. It's never used in place of the
+    scanner unless it's passed in.
+    """
+
+    baud_rates = {0x42: 9600, 0x41: 19200, 0x40: 38400, 0x48: 500000}
+    motor_rate_hz = 75.0
+    telegram_overhead_bytes = 10
+    reflector_angles = (30.0, 150.0)
+    reflector_width_degrees = 1.5
+
+    def __init__(self, address="simulated", source=None, rate_hz=None, jitter=0.0, scan_angle=180,
+                 scan_resolution=0.5, measuring_mode=0x00, measuring_units=0x01, use_pty=False, seed=None):
+        """
+        :param source: log to replay. None synthesizes scans
+        :param rate_hz: scans per second. None paces by mirror rate and baud, 0 sends scans as fast as possible
+        :param scan_angle, scan_resolution: variant of synthetic scans. Replayed logs keep their own
+        """
+        self.address = address
+        self.source = source
+        self.rate_hz = rate_hz
+        self.jitter = jitter
+        self.scan_angle = float(scan_angle)
+        self.scan_resolution = float(scan_resolution)
+        self.measuring_mode = int(measuring_mode)
+        self.measuring_units = int(measuring_units)
+        self.operating_mode = int(operating_modes.MONITOR_REQUEST_VALUES)
+        self.use_pty = use_pty
+        self.rng = np.random.default_rng(seed)
+
+        self.initialized = False
+        self.baud = None
+        self.recorded_scans = None
+        self.scan_index = 0
+        self.next_scan_time = None
+
+        self.pty_master = None
+        self.pty_slave = None
+        self.pty_name = None
+
+        self.values = np.zeros(MAX_NUM_MEASUREMENTS, dtype=np.uint32)
+        self.reflect_values = np.zeros(MAX_NUM_MEASUREMENTS, dtype=np.uint32)
+        self.num_values = 0
+
+    # ---- the SickLMS interface ----
+
+    def initialize(self, baud=0x40):
+        if self.initialized:
+            raise SickConfigException("Simulated LMS at %s is already initialized" % self.address)
+        if int(baud) not in self.baud_rates:
+            raise SickConfigException("Invalid baud: %s" % baud)
+        self.baud = self.baud_rates[int(baud)]
+
+        if self.source is not None:
+            self.recorded_scans, config = self.load_scans(self.source)
+            self.scan_angle = float(config.get("scan_angle", self.scan_angle))
+            self.scan_resolution = float(config.get("scan_resolution", self.scan_resolution))
+            self.measuring_mode = int(config.get("measuring_mode", self.measuring_mode))
+            self.measuring_units = int(config.get("measuring_units", self.measuring_units))
+        if self.use_pty:
+            import tty  # POSIX only, the rest of the simulator runs anywhere
+
+            self.pty_master, self.pty_slave = os.openpty()
+            tty.setraw(self.pty_slave)
+            os.set_blocking(self.pty_master, False)
+            self.pty_name = os.ttyname(self.pty_slave)
+
+        self.initialized = True
+        self.next_scan_time = None
+
+    def uninitialize(self):
+        if self.pty_master is not None:
+            os.close(self.pty_master)
+            os.close(self.pty_slave)
+            self.pty_master = None
+            self.pty_slave = None
+        self.initialized = False
+
+    def get_operating_mode(self):
+        return self.operating_mode
+
+    def get_measuring_mode(self):
+        return self.measuring_mode
+
+    def get_measuring_units(self):
+        return self.measuring_units
+
+    def get_scan_resolution(self):
+        return self.scan_resolution
+
+    def get_scan_angle(self):
+        return self.scan_angle
+
+    def set_variant(self, scan_angle, scan_resolution):
+        if self.recorded_scans is not None:
+            raise SickConfigException("A replayed log can't change its variant")
+        self.scan_angle = float(int(scan_angle))
+        self.scan_resolution = int(scan_resolution) / 100.0
+
+    def set_measuring_mode(self, measuring_mode):
+        self.measuring_mode = int(measuring_mode)
+
+    def set_measuring_units(self, measuring_units):
+        self.measuring_units = int(measuring_units)
+
+    def get_scan(self):
+        self.read_scan(operating_modes.MONITOR_STREAM_VALUES)
+        return tuple(self.values[:self.num_values].tolist())
+
+    def get_scan_into(self, buffer):
+        self.read_scan(operating_modes.MONITOR_STREAM_VALUES)
+        return self.fill(buffer, self.values[:self.num_values])
+
+    def get_mean_values_into(self, sample_size, buffer):
+        samples = []
+        for _ in range(sample_size):
+            self.read_scan(operating_modes.MONITOR_STREAM_MEAN_VALUES)
+            samples.append(self.values[:self.num_values].copy())
+        return self.fill(buffer, np.mean(samples, axis=0).astype(np.uint32))
+
+    def get_scan_subrange_into(self, start_index, stop_index, buffer):
+        self.read_scan(operating_modes.MONITOR_STREAM_VALUES_SUBRANGE)
+        # the scanner numbers its beams from 1, stop_index is included
+        return self.fill(buffer, self.values[start_index - 1: min(stop_index, self.num_values)])
+
+    def get_range_and_reflect_into(self, buffer):
+        self.read_scan(operating_modes.MONITOR_STREAM_RANGE_AND_REFLECT)
+        return self.fill_beams(buffer, self.values[:self.num_values], self.reflect_values[:self.num_values])
+
+    def get_scan_array(self):
+        self.read_scan(operating_modes.MONITOR_STREAM_VALUES)
+        return array.array('I', self.values[:self.num_values].tolist())
+
+    @staticmethod
+    def fill(buffer, values):
+        """Copy values into a uint32 buffer like the binding's *_into methods. Returns how many were written"""
+        if not isinstance(buffer, np.ndarray):
+            buffer = np.frombuffer(buffer, dtype=np.uint32)
+        if len(buffer) < len(values):
+            raise ValueError("Buffer holds %s values, the scan has %s" % (len(buffer), len(values)))
+        buffer[:len(values)] = values
+        return len(values)
+
+    @staticmethod
+    def fill_beams(buffer, ranges, reflectivity):
+        """Copy ranges and reflectivity into a beam_dtype buffer, or a buffer of uint16 pairs"""
+        if not isinstance(buffer, np.ndarray):
+            buffer = np.frombuffer(buffer, dtype=beam_dtype)
+        elif buffer.dtype != beam_dtype:
+            buffer = buffer.view(beam_dtype)
+        if len(buffer) < len(ranges):
+            raise ValueError("Buffer holds %s beams, the scan has %s" % (len(buffer), len(ranges)))
+        buffer["range"][:len(ranges)] = ranges
+        buffer["reflectivity"][:len(ranges)] = reflectivity
+        return len(ranges)
+
+    # ---- simulation ----
+
+    @property
+    def scan_size(self):
+        if self.recorded_scans is not None:
+            return self.recorded_scans.shape[1]
+        return int(round(self.scan_angle / self.scan_resolution)) + 1
+
+    @property
+    def scan_rate_hz(self):
+        """Scans per second the variant and baud allow, like LMS200.get_update_rate"""
+        if self.rate_hz is not None:
+            return self.rate_hz
+        scanner_rate_hz = self.motor_rate_hz / int(round(1.0 / self.scan_resolution))
+        value_bytes = 3 if self.operating_mode == int(operating_modes.MONITOR_STREAM_RANGE_AND_REFLECT) else 2
+        link_rate_hz = self.baud / ((value_bytes * self.scan_size + self.telegram_overhead_bytes) * 10.0)
+        return min(scanner_rate_hz, link_rate_hz)
+
+    def read_scan(self, operating_mode):
+        if not self.initialized:
+            raise SickIOException("Simulated LMS at %s isn't initialized" % self.address)
+        self.operating_mode = int(operating_mode)
+
+        self.wait_for_scan()
+        if self.recorded_scans is not None:
+            scan = self.recorded_scans[self.scan_index % len(self.recorded_scans)]
+        else:
+            scan = self.synthesize_scan()
+        self.scan_index += 1
+
+        self.num_values = len(scan)
+        if scan.dtype.names is not None:
+            self.values[:self.num_values] = scan["range"]
+            self.reflect_values[:self.num_values] = scan["reflectivity"]
+        else:
+            self.values[:self.num_values] = scan
+            if operating_mode == operating_modes.MONITOR_STREAM_RANGE_AND_REFLECT:
+                # logs without reflectivity replay as if nothing reflected
+                self.reflect_values[:self.num_values] = \
+                    0 if self.recorded_scans is not None else self.synthesize_reflectivity(scan)
+        if self.pty_master is not None:
+            self.write_telegram(self.values[:self.num_values])
+
+    def wait_for_scan(self):
+        rate_hz = self.scan_rate_hz
+        now = time.time()
+        if self.next_scan_time is None or rate_hz <= 0:
+            self.next_scan_time = now
+        else:
+            # scans are due on a fixed schedule, so jitter and slow readers don't shift the rate
+            self.next_scan_time = max(self.next_scan_time + 1.0 / rate_hz, now - 1.0 / rate_hz)
+
+        delay = self.next_scan_time - now
+        if self.jitter > 0:
+            delay += abs(self.rng.normal(0.0, self.jitter))
+        if delay > 0:
+            time.sleep(delay)
+
+    def synthesize_scan(self, room_width_mm=6000.0, room_depth_mm=4000.0, noise_mm=10.0):
+        """Ranges to the walls of a room with the scanner in the middle of one wall, plus noise"""
+        angles = np.radians(np.linspace(0.0, self.scan_angle, self.scan_size) + (90.0 - self.scan_angle / 2))
+        cos = np.cos(angles)
+        sin = np.sin(angles)
+        with np.errstate(divide="ignore"):
+            to_side_walls = np.where(np.abs(cos) > 1e-9, (room_width_mm / 2) / np.abs(cos), np.inf)
+            to_back_wall = np.where(sin > 1e-9, room_depth_mm / sin, np.inf)
+        ranges = np.minimum(to_side_walls, to_back_wall)
+        ranges += self.rng.normal(0.0, noise_mm, len(ranges))
+
+        if self.measuring_units == int(units.CM):
+            ranges /= 10.0
+        return np.clip(ranges, 0, 0x1fff).astype(np.uint32)
+
+    def synthesize_reflectivity(self, ranges, noise=4.0):
+        """Diffuse returns off the walls that fade with distance, and saturated returns off the reflector posts"""
+        ranges_mm = ranges * (10.0 if self.measuring_units == int(units.CM) else 1.0)
+        reflectivity = 60000.0 / np.maximum(ranges_mm, 1000.0) + self.rng.normal(0.0, noise, len(ranges))
+        angles = np.linspace(0.0, self.scan_angle, len(ranges))
+        for angle in self.reflector_angles:
+            reflectivity[np.abs(angles - angle) <= self.reflector_width_degrees / 2] = 255
+        return np.clip(reflectivity, 0, 255).astype(np.uint32)
+
+    def write_telegram(self, scan):
+        """Send a scan as a B0 (measured values) telegram from the scanner at address 0x80"""
+        count = len(scan) | (self.measuring_units << 14)
+        body = struct.pack("<BH", 0xB0, count) + np.asarray(scan, dtype="<u2").tobytes() + b"\x10"
+        telegram = struct.pack("<BBH", 0x02, 0x80, len(body)) + body
+        telegram += struct.pack("<H", sick_crc16(telegram))
+        try:
+            os.write(self.pty_master, telegram)
+        except BlockingIOError:
+            pass  # nobody is reading the terminal, a real scanner would overrun too
+
+    @staticmethod
+    def load_scans(path):
+        """Load every scan of a log as a (scans, values) array, along with the scanner config it recorded"""
+        if path.endswith(".xz"):
+            return load_raw_scans(path)
+
+        from .playback import open_scan_source
+        source = open_scan_source(path)
+        try:
+            if len(source) == 0:
+                raise SickIOException("No scans in %s" % path)
+            messages = source.messages(0, len(source))
+            scans = np.array([message.scan for message in messages],
+                             dtype=beam_dtype if messages[0].has_reflectivity else np.uint32)
+            return scans, source.config
+        finally:
+            source.close()
+
+
+def load_raw_scans(path):
+    """Scans and config from a raw robot log (logs/*/*.log.xz). Scan values follow "scan: (" on LMS200 lines"""
+    scan_regex = re.compile(r"scan: \(([\d, ]+)\)")
+    config = {}
+    scans = []
+    with lzma.open(path, 'rt') as log_file:
+        for line in log_file:
+            line_match = log_line_regex.match(line)
+            if line_match is None:
+                continue
+            message = line_match.group(1)
+            scan_match = scan_regex.match(message)
+            if scan_match is not None:
+                scan = list(map(int, scan_match.group(1).split(",")))
+                # the variant doesn't change within a log, skip anything truncated
+                if len(scans) == 0 or len(scan) == len(scans[0]):
+                    scans.append(scan)
+            elif len(scans) == 0:
+                parse_config_flag(message.rstrip("\n"), config)
+
+    if len(scans) == 0:
+        raise SickIOException("No scans in %s" % path)
+    return np.array(scans, dtype=np.uint32), config
@@ -5,13 +5,17 @@ import asyncio
 import numpy as np
 from PIL import Image
 from breezyslam.components import Laser
-from breezyslam.algorithms import RMHC_SLAM, Deterministic_SLAM
 
 from atlasbuggy import Node
 
-from .messages import LmsScan, OdometryMessage, PoseMessage
+from .messages import LmsScan, OdometryMessage, PoseMessage, MapUpdate
+from .slamworker import SlamWorker, make_algorithm, shift_algorithm
+from .tiledmap import TiledMap
+from .trajectory import Trajectory
+from .preprocessing import ScanPreprocessor
+from .metrics import PipelineMetrics
 
-from .sicktoolbox import units
+from .sick import units
 
 
 class Slam(Node):
@@ -21,7 +25,26 @@ class Slam(Node):
     """
 
     def __init__(self, map_size_pixels, map_size_meters, enabled=True, log_level=None, write_image=False,
-                 produce_images=False, force_rmhc_slam=False):
+                 produce_images=False, force_rmhc_slam=False, map_update_hz=2.0, map_tile_size=64,
+                 worker=None, worker_queue_size=4, worker_policy=SlamWorker.drop_oldest, trajectory_spill_path=None,
+                 median_filter_size=0, outlier_threshold_mm=None, scan_downsample=1, batch_size=16,
+                 tiled_map_directory=None, tiled_map_tile_pixels=None, metrics=None):
+        """
+        :param produce_images: broadcast MapUpdate messages with the tiles of the map that changed
+        :param map_update_hz: how often the map is pulled from the SLAM algorithm for produce_images.
+            None pulls it after every batch of scans. get_map and get_map_update pull it on demand
+        :param map_tile_size: side length in pixels of the tiles MapUpdate messages are split into
+        :param worker: None runs scan matching in loop. "thread" or "process" runs it in a SlamWorker so it
+            doesn't block the event loop, see SlamWorker for worker_queue_size and worker_policy
+        :param trajectory_spill_path: keep the trajectory in this file instead of memory, see Trajectory
+        :param median_filter_size, outlier_threshold_mm, scan_downsample: scan filtering, see ScanPreprocessor
+        :param batch_size: most scans preprocessed together when they pile up in the queue
+        :param tiled_map_directory: map an area of any size. The map_size_pixels map becomes a window that follows
+            the robot, the rest of the map is kept in tiles of tiled_map_tile_pixels in this directory. Poses and
+            the trajectory are in world coordinates, see TiledMap
+        :param metrics: PipelineMetrics to record timings in. None uses the producer's if it has one, or in-process
+            metrics if it doesn't
+        """
         super(Slam, self).__init__(enabled, log_level)
 
         self.angles = None
@@ -38,12 +61,43 @@ class Slam(Node):
         self.map_size_meters = map_size_meters
         self.map_scale = self.map_size_meters / self.map_size_pixels
 
-        self.trajectory = []
+        self.trajectory = Trajectory(spill_path=trajectory_spill_path)
         self.mapbytes = bytearray(self.map_size_pixels * self.map_size_pixels)
+        self.map_image = np.frombuffer(self.mapbytes, dtype=np.uint8).reshape(
+            (self.map_size_pixels, self.map_size_pixels))
+
+        # map as of the last MapUpdate, to find the tiles that changed since
+        self.map_tile_size = map_tile_size
+        self.map_tile_starts = np.arange(0, self.map_size_pixels, self.map_tile_size)
+        self.published_map = None
+        self.map_version = 0
+        self.map_update_hz = map_update_hz
+        self.prev_map_update_time = 0.0
+
+        if tiled_map_directory is None:
+            self.tiled_map = None
+        else:
+            if tiled_map_tile_pixels is None:
+                tiled_map_tile_pixels = self.map_size_pixels // 4
+            self.tiled_map = TiledMap(tiled_map_directory, self.map_size_pixels, tiled_map_tile_pixels,
+                                      self.map_size_meters)
+        self.map_recenters = 0
+        self.map_window = (0, (0, 0))  # (num_recenters, origin) of the tiled map window as of the last get_map
 
         self.laser = None
         self.algorithm = None
 
+        self.preprocessor = None
+        self.preprocessor_config = dict(median_size=median_filter_size, outlier_threshold_mm=outlier_threshold_mm,
+                                        downsample=scan_downsample, batch_size=batch_size)
+
+        self.worker_mode = worker
+        self.worker_queue_size = worker_queue_size
+        self.worker_policy = worker_policy
+        self.worker = None
+        self.pose = None
+        self.metrics = metrics
+
         self.lms_tag = "lms"
         self.lms_queue = None
         self.lms200 = None
@@ -69,6 +123,10 @@ class Slam(Node):
     def take(self):
         self.lms200 = self.lms200_sub.get_producer()
         self.lms_queue = self.lms200_sub.get_queue()
+        if self.metrics is None:
+            self.metrics = getattr(self.lms200, "metrics", None)
+            if self.metrics is None:
+                self.metrics = PipelineMetrics(shared=False)
 
         if self.is_subscribed(self.odometry_tag):
             self.odometry_queue = self.odometry_sub.get_queue()
@@ -79,57 +137,68 @@ class Slam(Node):
         self.initialized = True
         self.make_angles()
 
-        self.scan_size = len(self.angles)
         self.scan_rate_hz = self.lms200.update_rate_hz
         self.fps = self.lms200.update_rate_hz
         self.detection_angle_degrees = self.lms200.scan_angle
         self.distance_no_detection_mm = 1.0
         self.max_distance_mm = self.lms200.max_distance * 1000
 
-        self.laser = Laser(
-            self.scan_size, self.scan_rate_hz,
-            self.detection_angle_degrees, self.distance_no_detection_mm
+        self.preprocessor = ScanPreprocessor(
+            len(self.angles), self.max_distance_mm, scale=10.0 if self.lms200.measuring_units == units.CM else 1.0,
+            no_detection_mm=self.distance_no_detection_mm, **self.preprocessor_config
         )
-        if self.is_subscribed(self.odometry_tag) and not self.force_rmhc_slam:
-            self.algorithm = Deterministic_SLAM(self.laser, self.map_size_pixels, self.map_size_meters)
+        self.scan_size = self.preprocessor.scan_size
+
+        laser_config = (self.scan_size, self.scan_rate_hz, self.detection_angle_degrees,
+                        self.distance_no_detection_mm)
+        self.laser = Laser(*laser_config)
+
+        deterministic = self.is_subscribed(self.odometry_tag) and not self.force_rmhc_slam
+        if deterministic:
             self.logger.info("Using deterministic SLAM. Odometry provided.")
         else:
-            self.algorithm = RMHC_SLAM(self.laser, self.map_size_pixels, self.map_size_meters)
             self.logger.warning("Using RMHC SLAM!! Odometry not provided.")
 
+        algorithm_args = (laser_config, self.map_size_pixels, self.map_size_meters, deterministic)
+        if self.worker_mode is None:
+            self.algorithm = make_algorithm(*algorithm_args)
+        else:
+            self.worker = SlamWorker(algorithm_args, self.worker_mode, self.worker_queue_size, self.worker_policy,
+                                     self.tiled_map, self.metrics)
+            self.worker.start()
+            self.logger.info("SLAM running in a %s" % self.worker_mode)
+
         self.logger.info("SLAM initialized! %s" % self.laser)
 
     async def loop(self):
         deltas = [0, 0, 0]
 
         while True:
-            # print(self.lms_queue.empty(), self.odometry_queue.empty())
-            if not self.lms_queue.empty():
-                self.initialize()
-                scan_count = 0
-                while not self.lms_queue.empty():
-                    scan_message = await self.lms_queue.get()
-                    distances = self.make_distances(scan_message.scan)
-
-                    current_time = scan_message.timestamp
-                    scan_count += 1
-
-                    if not self.is_subscribed(self.odometry_tag):
-                        if self.prev_t is None:
-                            self.prev_t = current_time
-                        deltas = [0, 0, current_time - self.prev_t]
+            # sleep until a scan arrives instead of polling the queue
+            scan_messages = [await self.lms_queue.get()]
+            self.initialize()
+            while not self.lms_queue.empty() and len(scan_messages) < self.preprocessor.batch_size:
+                scan_messages.append(self.lms_queue.get_nowait())
+
+            batch = self.preprocessor.process([scan_message.ranges for scan_message in scan_messages])
+            for scan_message, distances in zip(scan_messages, batch):
+                current_time = scan_message.timestamp
+
+                if not self.is_subscribed(self.odometry_tag):
+                    if self.prev_t is None:
                         self.prev_t = current_time
+                    deltas = [0, 0, current_time - self.prev_t]
+                    self.prev_t = current_time
 
-                    print(deltas)
-                    await self.update_slam(distances, deltas)
-                self.log_to_buffer(time.time(), "received %s scans" % scan_count)
+                await self.update_slam(distances, deltas, current_time)
+            self.log_to_buffer(time.time(), "received %s scans" % len(scan_messages))
 
             if self.is_subscribed(self.odometry_tag):
                 if not self.odometry_queue.empty():
                     deltas = [0, 0, 0]
                     velocities_count = 0
                     while not self.odometry_queue.empty():
-                        odometry_message = await self.odometry_queue.get()
+                        odometry_message = self.odometry_queue.get_nowait()
                         deltas[0] += odometry_message.delta_xy_mm
                         deltas[1] += odometry_message.delta_theta_degrees
                         deltas[2] += odometry_message.delta_t
@@ -139,21 +208,37 @@ class Slam(Node):
 
                     self.log_to_buffer(time.time(), "deltas: %s. received %s" % (deltas, velocities_count))
 
-            if self.produce_images:
-                map_img = np.reshape(np.frombuffer(self.mapbytes, dtype=np.uint8),
-                                     (self.map_size_pixels, self.map_size_pixels))
+            if self.produce_images and self.map_update_due():
+                map_update = self.get_map_update(await self.pull_map())
+                if map_update is not None:
+                    await self.broadcast(map_update, self.slam_image_service)
 
-                await self.broadcast(map_img, self.slam_image_service)
-
-            await asyncio.sleep(0.01)
+    async def update_slam(self, distances, deltas, timestamp=None):
+        if distances is None:
+            return
+        # only live scanners stamp scans with the current time, played back scans carry when they were recorded
+        if timestamp is not None and getattr(self.lms200, "is_live", False):
+            self.metrics.record("scan_age", time.time() - timestamp)
 
-    async def update_slam(self, distances, deltas):
-        if distances is not None:
-            x_mm, y_mm, theta_degrees = self.slam(distances.tolist(), deltas)
-            pose_message = PoseMessage(time.time(), self.pose_message_counter, x_mm, y_mm, theta_degrees)
-            self.log_to_buffer(time.time(), pose_message)
-            await self.broadcast(pose_message)
-            self.pose_message_counter += 1
+        # breezyslam only takes lists, this is the one conversion a scan goes through on its way in
+        if self.worker is None:
+            await self.publish_pose(self.slam(distances.tolist(), deltas, timestamp))
+        else:
+            # hand the scan off and publish whatever poses the worker finished in the meantime
+            self.worker.submit(timestamp, distances.tolist(), deltas)
+            self.metrics.set("slam_queue_depth", len(self.worker))
+            self.metrics.set("slam_dropped", self.worker.dropped)
+            for pose_timestamp, pose in self.worker.get_poses():
+                self.trajectory.append(pose_timestamp, *pose)
+                await self.publish_pose(pose)
+
+    async def publish_pose(self, pose):
+        x_mm, y_mm, theta_degrees = pose
+        self.pose = pose
+        pose_message = PoseMessage(time.time(), self.pose_message_counter, x_mm, y_mm, theta_degrees)
+        self.log_to_buffer(time.time(), pose_message)
+        await self.broadcast(pose_message)
+        self.pose_message_counter += 1
 
     def make_angles(self):
         """Create angles list in the correct format and units (radians)"""
@@ -164,42 +249,108 @@ class Slam(Node):
         self.angles = np.arange(0, scan_angle_radians + resolution_radians, resolution_radians)
 
     def make_distances(self, scan):
-        """Convert the current scan into the correct format and units (meters)"""
-        distances = np.array(scan, dtype=np.float32)
-
-        if self.lms200.measuring_units == units.CM:
-            distances *= 10
-
-        # self.distances = np.ma.masked_array(self.distances, self.distances > self.max_distance)
-        distances[distances > self.max_distance_mm] = 1
-
-        return distances
+        """Convert the current scan into the correct format and units (mm). The result is reused by the next call"""
+        return self.preprocessor.process((scan,))[0]
 
     def make_point_cloud(self, distances):
         """Convert distance and angle lists into a 2D point cloud using numpy operations"""
         return np.vstack(
             [distances * np.cos(self.angles), distances * np.sin(self.angles)]).T
 
-    def slam(self, distances, velocity):
+    def slam(self, distances, velocity, timestamp=None):
+        t0 = time.time()
         self.algorithm.update(distances, velocity)
+        self.metrics.record("slam_update", time.time() - t0)
 
         x_mm, y_mm, theta_degrees = self.algorithm.getpos()
-        self.trajectory.append((x_mm, y_mm))
-
-        self.algorithm.getmap(self.mapbytes)
+        if self.tiled_map is not None:
+            x_mm, y_mm, theta_degrees = self.tiled_map.follow(
+                (x_mm, y_mm, theta_degrees), self.algorithm.getmap,
+                lambda mapbytes, dx_mm, dy_mm: shift_algorithm(self.algorithm, mapbytes, dx_mm, dy_mm)
+            )
+        self.trajectory.append(time.time() if timestamp is None else timestamp, x_mm, y_mm, theta_degrees)
 
         return x_mm, y_mm, theta_degrees
 
-    def make_image(self, image_name, image_format="pgm"):
-        if self.algorithm is not None:
+    def get_map(self):
+        """Pull the current map out of the SLAM algorithm. Returns a (map_size_pixels, map_size_pixels) image"""
+        t0 = time.time()
+        if self.worker is not None:
+            map_window = self.worker.get_map(self.mapbytes)
+            if map_window is not None:
+                self.map_window = map_window
+        elif self.algorithm is not None:
             self.algorithm.getmap(self.mapbytes)
-            for coords in self.trajectory:
-                x_mm, y_mm = coords
-
-                x_pix = self.mm2pix(x_mm)
-                y_pix = self.mm2pix(y_mm)
+            if self.tiled_map is not None:
+                self.map_window = self.tiled_map.num_recenters, self.tiled_map.origin
+        self.metrics.record("slam_getmap", time.time() - t0)
+        return self.map_image
+
+    async def pull_map(self):
+        """
+        get_map without blocking the event loop. A worker has to finish the scan it's matching first, and in
+        process mode the map comes back over a pipe
+        """
+        if self.worker is None:
+            return self.get_map()
+        return await asyncio.get_event_loop().run_in_executor(None, self.get_map)
+
+    def map_update_due(self):
+        now = time.time()
+        if self.map_update_hz is not None and now - self.prev_map_update_time < 1.0 / self.map_update_hz:
+            return False
+        self.prev_map_update_time = now
+        return True
+
+    def get_map_update(self, map_image=None):
+        """
+        Return a MapUpdate with the tiles of map_image that changed since the last one, or None if nothing
+        changed. The first update has every tile. None pulls the map with get_map
+        """
+        if map_image is None:
+            map_image = self.get_map()
+        # the worker can move the window at any time, only the one the map was copied from goes with it
+        num_recenters, origin = self.map_window
+        if num_recenters != self.map_recenters:
+            # the window moved, every tile is different
+            self.map_recenters = num_recenters
+            self.published_map = None
+
+        if self.published_map is None:
+            self.published_map = np.empty_like(map_image)
+            dirty = np.ones((len(self.map_tile_starts), len(self.map_tile_starts)), dtype=bool)
+        else:
+            changed = map_image != self.published_map
+            dirty = np.logical_or.reduceat(np.logical_or.reduceat(changed, self.map_tile_starts, axis=0),
+                                           self.map_tile_starts, axis=1)
+
+        tiles = []
+        for row, column in zip(*np.nonzero(dirty)):
+            y = self.map_tile_starts[row]
+            x = self.map_tile_starts[column]
+            pixels = map_image[y: y + self.map_tile_size, x: x + self.map_tile_size].copy()
+            self.published_map[y: y + self.map_tile_size, x: x + self.map_tile_size] = pixels
+            tiles.append((int(row), int(column), pixels))
+
+        if len(tiles) == 0:
+            return None
+
+        self.map_version += 1
+        if self.tiled_map is not None:
+            origin = (origin[0] * self.tiled_map.tile_size_pixels, origin[1] * self.tiled_map.tile_size_pixels)
+        return MapUpdate(time.time(), self.map_version, self.map_size_pixels, self.map_tile_size, tiles, origin)
 
-                self.mapbytes[y_pix * self.map_size_pixels + x_pix] = 0
+    def make_image(self, image_name, image_format="pgm"):
+        if self.algorithm is not None or self.worker is not None:
+            map_image = self.get_map()
+            if len(self.trajectory) > 0:
+                trajectory = self.trajectory.xy
+                if self.tiled_map is not None:
+                    # only the part of the trajectory inside the window is drawn
+                    trajectory -= np.multiply(self.map_window[1], self.tiled_map.tile_size_mm)
+                x_pix, y_pix = self.mm2pix(trajectory).T
+                on_map = (x_pix >= 0) & (x_pix < self.map_size_pixels) & (y_pix >= 0) & (y_pix < self.map_size_pixels)
+                map_image[y_pix[on_map], x_pix[on_map]] = 0
 
             if image_format == "pgm":
                 pgm_save(image_name + "." + image_format, self.mapbytes,
@@ -210,12 +361,24 @@ class Slam(Node):
                 image.save(image_name + "." + image_format)
 
     def get_pos(self):
+        if self.worker is not None:
+            return self.pose
         return self.algorithm.getpos()
 
     def mm2pix(self, mm):
+        """Convert mm to pixels. Also takes arrays of coordinates"""
+        if isinstance(mm, np.ndarray):
+            return (mm / (self.map_size_meters * 1000 / self.map_size_pixels)).astype(np.int64)
         return int(mm / (self.map_size_meters * 1000 / self.map_size_pixels))
 
     async def teardown(self):
+        if self.worker is not None:
+            # the scans still queued and the poses the worker finished belong in the map and trajectory
+            await asyncio.get_event_loop().run_in_executor(None, self.worker.drain)
+            for pose_timestamp, pose in self.worker.get_poses():
+                self.trajectory.append(pose_timestamp, *pose)
+                self.pose = pose
+
         if self.write_image:
             todays_folder = self.log_directory.split(os.sep)[1:]
             directory = os.path.join("maps", *todays_folder)
@@ -224,53 +387,75 @@ class Slam(Node):
                 os.makedirs(directory)
 
             self.make_image(os.path.join(directory, file_name))
+            self.trajectory.export(os.path.join(directory, self.log_file_name + " trajectory.csv"))
+
+        if self.tiled_map is not None:
+            if self.algorithm is not None or self.worker is not None:
+                self.tiled_map.window[:] = self.get_map()
+                self.tiled_map.store()
+            self.tiled_map.close()
+        if self.worker is not None:
+            self.worker.stop()
+            if self.worker.dropped > 0:
+                self.logger.warning("SLAM worker fell behind and dropped %s scans" % self.worker.dropped)
+        self.trajectory.close()
 
 
 def pgm_load(filename):
+    """Read a binary (P5) or ASCII (P2) 8 bit pgm. Returns the pixels as a bytearray and [width, height]"""
     print('Loading image from file %s...' % filename)
 
-    fd = open(filename, 'rt')
-
-    # Skip constant header
-    fd.readline()
+    with open(filename, 'rb') as fd:
+        data = fd.read()
 
-    # Grab image size (assume square)
-    imgsize = [int(tok) for tok in fd.readline().split()]
+    magic, width, height, max_value, data_start = pgm_header(data)
+    if max_value > 255:
+        raise ValueError("Only 8 bit pgm images are supported, %s has a max value of %s" % (filename, max_value))
 
-    # Start with empty list
-    imglist = []
+    if magic == b"P5":
+        pixels = np.frombuffer(data, dtype=np.uint8, count=width * height, offset=data_start)
+    elif magic == b"P2":
+        pixels = np.array(data[data_start:].split()[:width * height]).astype(np.uint8)
+    else:
+        raise ValueError("%s isn't a P2 or P5 pgm image" % filename)
 
-    # Read lines and append them to list until done
-    while True:
+    return bytearray(pixels), [width, height]
 
-        line = fd.readline()
 
-        if len(line) == 0:
-            break
+def pgm_header(data):
+    """Parse the magic number, width, height and max value of a pgm header, skipping comments"""
+    tokens = []
+    position = 0
+    while len(tokens) < 4:
+        while data[position: position + 1].isspace():
+            position += 1
+        if data[position: position + 1] == b"#":
+            position = data.index(b"\n", position) + 1
+            continue
 
-        imglist.extend([int(tok) for tok in line.split()])
+        start = position
+        while position < len(data) and not data[position: position + 1].isspace():
+            position += 1
+        if start == position:
+            raise ValueError("Truncated pgm header")
+        tokens.append(data[start: position])
 
-    fd.close()
+    # a single whitespace character separates the header from the pixels
+    return tokens[0], int(tokens[1]), int(tokens[2]), int(tokens[3]), position + 1
 
-    # Convert list into bytes
-    imgbytes = bytearray(imglist)
 
-    return imgbytes, imgsize
-
-
-def pgm_save(filename, imgbytes, imgsize):
+def pgm_save(filename, imgbytes, imgsize, binary=True):
+    """Write an 8 bit pgm. binary=False writes the ASCII (P2) format older maps were saved in"""
     print('\nSaving image to file %s...' % filename)
 
-    output = open(filename, 'wt')
-
-    output.write('P2\n%d %d 255\n' % imgsize)
-
     wid, hgt = imgsize
+    with open(filename, 'wb') as output:
+        if binary:
+            output.write(b'P5\n%d %d\n255\n' % (wid, hgt))
+            output.write(memoryview(imgbytes)[:wid * hgt])
+        else:
+            output.write(b'P2\n%d %d 255\n' % (wid, hgt))
+            pixels = np.frombuffer(imgbytes, dtype=np.uint8, count=wid * hgt).reshape((hgt, wid))
+            np.savetxt(output, pixels, fmt='%d', delimiter=' ')
 
-    for y in range(hgt):
-        for x in range(wid):
-            output.write('%d ' % imgbytes[y * wid + x])
-        output.write('\n')
-
-    output.close()
     print("done!")
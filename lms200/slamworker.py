@@ -0,0 +1,241 @@
+import time
+import threading
+import collections
+import multiprocessing
+
+from breezyslam.components import Laser
+from breezyslam.algorithms import RMHC_SLAM, Deterministic_SLAM
+
+
+# keyword arguments only RMHC_SLAM takes, Deterministic_SLAM only takes map_quality and hole_width_mm
+rmhc_parameters = ("random_seed", "sigma_xy_mm", "sigma_theta_degrees", "max_search_iter")
+
+
+def make_algorithm(laser_config, map_size_pixels, map_size_meters, deterministic, parameters=None):
+    """
+    Build the breezyslam objects. They can't be pickled, so a SLAM process builds its own from the same
+    arguments. laser_config is (scan_size, scan_rate_hz, detection_angle_degrees, distance_no_detection_mm),
+    parameters is a dict of keyword arguments for the algorithm. None keeps breezyslam's defaults
+    """
+    laser = Laser(*laser_config)
+    parameters = {} if parameters is None else parameters
+    if deterministic:
+        parameters = {name: value for name, value in parameters.items() if name not in rmhc_parameters}
+        return Deterministic_SLAM(laser, map_size_pixels, map_size_meters, **parameters)
+    else:
+        return RMHC_SLAM(laser, map_size_pixels, map_size_meters, **parameters)
+
+
+def shift_algorithm(algorithm, mapbytes, dx_mm, dy_mm):
+    """Replace the algorithm's map with one that was shifted by dx_mm, dy_mm and move the robot to match"""
+    algorithm.setmap(mapbytes)
+    algorithm.position.x_mm -= dx_mm
+    algorithm.position.y_mm -= dy_mm
+
+
+def run_slam_process(connection, algorithm_args):
+    """Body of the SLAM process. Serves update, getmap and setmap requests until it receives None"""
+    algorithm = make_algorithm(*algorithm_args)
+    mapbytes = bytearray(algorithm_args[1] * algorithm_args[1])
+    try:
+        while True:
+            request = connection.recv()
+            if request is None:
+                break
+
+            command = request[0]
+            if command == "update":
+                algorithm.update(request[1], request[2])
+                connection.send(algorithm.getpos())
+            elif command == "getmap":
+                algorithm.getmap(mapbytes)
+                connection.send_bytes(mapbytes)
+            elif command == "setmap":
+                mapbytes[:] = connection.recv_bytes()
+                shift_algorithm(algorithm, mapbytes, request[1], request[2])
+                connection.send(True)
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        connection.close()
+
+
+class SlamWorker:
+    """
+    Runs breezyslam scan matching off the event loop. Scans are handed over with submit and poses come back
+    through get_poses, the coroutine never waits on the algorithm.
+
+    mode decides where the algorithm runs:
+        "thread" - a thread in this process. Only helps as far as breezyslam releases the GIL
+        "process" - a separate process. A thread here forwards scans to it over a pipe
+
+    Scans wait in a queue of at most queue_size. When it's full, policy decides which scan goes:
+        "drop_oldest" - the oldest waiting scan is discarded along with its odometry
+        "merge_odometry" - the oldest waiting scan is discarded, its odometry is added to the scan after it
+            so no motion is lost
+    """
+
+    thread_mode = "thread"
+    process_mode = "process"
+
+    drop_oldest = "drop_oldest"
+    merge_odometry = "merge_odometry"
+
+    def __init__(self, algorithm_args, mode="thread", queue_size=4, policy="drop_oldest", tiled_map=None,
+                 metrics=None):
+        if mode not in (self.thread_mode, self.process_mode):
+            raise ValueError("Invalid SLAM worker mode: %s" % mode)
+        if policy not in (self.drop_oldest, self.merge_odometry):
+            raise ValueError("Invalid SLAM queue policy: %s" % policy)
+        if queue_size < 1:
+            raise ValueError("SLAM queue needs at least 1 slot, got %s" % queue_size)
+
+        self.algorithm_args = algorithm_args
+        self.map_size_pixels = algorithm_args[1]
+        self.mode = mode
+        self.queue_size = queue_size
+        self.policy = policy
+        self.tiled_map = tiled_map  # re-centred from the worker thread, poses come back in world coordinates
+        self.metrics = metrics  # slam_update is recorded from the worker thread
+
+        self.scans = collections.deque()
+        self.condition = threading.Condition()
+        self.running = False
+        self.draining = False
+        self.dropped = 0
+
+        # algorithm calls from the worker thread and get_map take turns
+        self.algorithm_lock = threading.Lock()
+        self.algorithm = None
+        self.process = None
+        self.connection = None
+
+        self.poses = collections.deque()  # appended by the worker thread, popped by get_poses
+        self.thread = None
+
+    def start(self):
+        if self.mode == self.process_mode:
+            self.connection, child_connection = multiprocessing.Pipe()
+            self.process = multiprocessing.Process(target=run_slam_process,
+                                                   args=(child_connection, self.algorithm_args), daemon=True)
+            self.process.start()
+            child_connection.close()
+        else:
+            self.algorithm = make_algorithm(*self.algorithm_args)
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, timestamp, distances, deltas):
+        """Queue a scan for the worker. distances is the list breezyslam takes, deltas the odometry since the last"""
+        with self.condition:
+            if len(self.scans) >= self.queue_size:
+                _, _, oldest_deltas = self.scans.popleft()
+                self.dropped += 1
+                if self.policy == self.merge_odometry:
+                    if len(self.scans) > 0:
+                        next_timestamp, next_distances, next_deltas = self.scans[0]
+                        self.scans[0] = (next_timestamp, next_distances, add_deltas(oldest_deltas, next_deltas))
+                    else:
+                        deltas = add_deltas(oldest_deltas, deltas)
+
+            self.scans.append((timestamp, distances, deltas))
+            self.condition.notify()
+
+    def __len__(self):
+        return len(self.scans)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and len(self.scans) == 0:
+                    self.condition.wait()
+                if not self.running and not (self.draining and len(self.scans) > 0):
+                    return
+                timestamp, distances, deltas = self.scans.popleft()
+
+            pose = self.update(distances, deltas)
+            self.poses.append((timestamp, pose))
+
+    def update(self, distances, deltas):
+        with self.algorithm_lock:
+            t0 = time.time()
+            if self.mode == self.process_mode:
+                self.connection.send(("update", distances, deltas))
+                pose = self.connection.recv()
+            else:
+                self.algorithm.update(distances, deltas)
+                pose = self.algorithm.getpos()
+            if self.metrics is not None:
+                self.metrics.record("slam_update", time.time() - t0)
+
+            if self.tiled_map is not None:
+                pose = self.tiled_map.follow(pose, self._get_map, self._set_map)
+            return pose
+
+    def get_map(self, mapbytes):
+        """
+        Copy the current map into mapbytes. Waits for the scan being matched to finish. With a tiled map, returns
+        the (num_recenters, origin) of the window the map belongs to, read before the worker can move it again
+        """
+        with self.algorithm_lock:
+            self._get_map(mapbytes)
+            if self.tiled_map is not None:
+                return self.tiled_map.num_recenters, self.tiled_map.origin
+
+    def _get_map(self, mapbytes):
+        if self.mode == self.process_mode:
+            self.connection.send(("getmap",))
+            self.connection.recv_bytes_into(mapbytes)
+        else:
+            self.algorithm.getmap(mapbytes)
+
+    def _set_map(self, mapbytes, dx_mm, dy_mm):
+        if self.mode == self.process_mode:
+            self.connection.send(("setmap", dx_mm, dy_mm))
+            self.connection.send_bytes(mapbytes)
+            self.connection.recv()
+        else:
+            shift_algorithm(self.algorithm, mapbytes, dx_mm, dy_mm)
+
+    def get_poses(self):
+        """Poses the worker finished since the last call, as (scan timestamp, (x_mm, y_mm, theta_degrees))"""
+        poses = []
+        while len(self.poses) > 0:
+            poses.append(self.poses.popleft())
+        return poses
+
+    def drain(self):
+        """
+        Match the scans still queued and stop the worker thread. Blocks until they're done, their poses are left
+        for get_poses. The map can be read until stop
+        """
+        with self.condition:
+            self.running = False
+            self.draining = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def stop(self):
+        """Stop the worker, discarding the scans still queued, and shut the SLAM process down"""
+        with self.condition:
+            self.running = False
+            self.draining = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        if self.process is not None:
+            self.connection.send(None)
+            self.process.join(timeout=1)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.connection.close()
+
+
+def add_deltas(first, second):
+    return [first[0] + second[0], first[1] + second[1], first[2] + second[2]]
@@ -0,0 +1,167 @@
+import os
+import collections
+import numpy as np
+
+
+class TiledMap:
+    """
+    A map of unbounded size for SLAM. The world is cut into square tiles of tile_size_pixels, each kept in
+    its own file and opened through memmap. SLAM only ever sees a window of window_size_pixels around the
+    robot. When the robot leaves the window's central tiles, the window is written back to its tiles and
+    shifted by whole tiles so the robot is near the middle again. Memory use and the cost of a scan depend
+    on the window size, not on how far the robot has driven.
+
+    World coordinates are the window coordinates SLAM started with, origin is the world position (in tiles)
+    of the window's top left corner.
+    """
+
+    tile_extension = ".tile"
+
+    def __init__(self, directory, window_size_pixels, tile_size_pixels, map_size_meters, unknown_value=127,
+                 max_open_tiles=64):
+        if window_size_pixels % tile_size_pixels != 0:
+            raise ValueError("Map size (%s px) has to be a multiple of the tile size (%s px)" % (
+                window_size_pixels, tile_size_pixels))
+        self.window_tiles = window_size_pixels // tile_size_pixels
+        if self.window_tiles < 3:
+            raise ValueError("The map has to be at least 3 tiles wide, got %s" % self.window_tiles)
+
+        self.directory = directory
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        self.window_size_pixels = window_size_pixels
+        self.tile_size_pixels = tile_size_pixels
+        self.tile_size_mm = map_size_meters * 1000 / window_size_pixels * tile_size_pixels
+        self.unknown_value = unknown_value
+
+        self.window_bytes = bytearray(window_size_pixels * window_size_pixels)
+        self.window = np.frombuffer(self.window_bytes, dtype=np.uint8).reshape(
+            (window_size_pixels, window_size_pixels))
+
+        self.origin = (0, 0)  # (x, y) in tiles
+        self.num_recenters = 0
+
+        # least recently used tiles are flushed and closed first
+        self.max_open_tiles = max_open_tiles
+        self.open_tiles = collections.OrderedDict()
+
+    @property
+    def origin_mm(self):
+        return self.origin[0] * self.tile_size_mm, self.origin[1] * self.tile_size_mm
+
+    @property
+    def origin_pixels(self):
+        return self.origin[0] * self.tile_size_pixels, self.origin[1] * self.tile_size_pixels
+
+    def tile_path(self, tile_x, tile_y):
+        return os.path.join(self.directory, "%d_%d%s" % (tile_x, tile_y, self.tile_extension))
+
+    def tile(self, tile_x, tile_y):
+        """The memmapped pixels of a world tile, created as unknown space the first time it's used"""
+        key = (tile_x, tile_y)
+        if key in self.open_tiles:
+            self.open_tiles.move_to_end(key)
+            return self.open_tiles[key]
+
+        path = self.tile_path(tile_x, tile_y)
+        shape = (self.tile_size_pixels, self.tile_size_pixels)
+        if os.path.isfile(path):
+            tile = np.memmap(path, dtype=np.uint8, mode='r+', shape=shape)
+        else:
+            tile = np.memmap(path, dtype=np.uint8, mode='w+', shape=shape)
+            tile[:] = self.unknown_value
+
+        self.open_tiles[key] = tile
+        while len(self.open_tiles) > self.max_open_tiles:
+            _, evicted = self.open_tiles.popitem(last=False)
+            evicted.flush()
+        return tile
+
+    def window_slices(self):
+        """(world tile x, world tile y, window region) for every tile in the window"""
+        for row in range(self.window_tiles):
+            for column in range(self.window_tiles):
+                y = row * self.tile_size_pixels
+                x = column * self.tile_size_pixels
+                region = (slice(y, y + self.tile_size_pixels), slice(x, x + self.tile_size_pixels))
+                yield self.origin[0] + column, self.origin[1] + row, region
+
+    def store(self):
+        """Write the window back to its tiles"""
+        for tile_x, tile_y, region in self.window_slices():
+            self.tile(tile_x, tile_y)[:] = self.window[region]
+
+    def load(self):
+        """Fill the window from the tiles around origin"""
+        for tile_x, tile_y, region in self.window_slices():
+            self.window[region] = self.tile(tile_x, tile_y)
+
+    def recenter_shift(self, x_mm, y_mm):
+        """Tiles to move the window by so a robot at window position x_mm, y_mm is in a central tile"""
+        shift = []
+        for position_mm in (x_mm, y_mm):
+            tile_index = int(position_mm // self.tile_size_mm)
+            if 1 <= tile_index <= self.window_tiles - 2:
+                shift.append(0)
+            else:
+                shift.append(tile_index - self.window_tiles // 2)
+        return tuple(shift)
+
+    def follow(self, pose, get_window, set_window):
+        """
+        Re-centre the window if the robot at pose (in window coordinates) left the central tiles.
+        get_window(mapbytes) copies the SLAM map out, set_window(mapbytes, dx_mm, dy_mm) puts the shifted map
+        back and moves the robot by -dx_mm, -dy_mm. Returns the pose in world coordinates.
+        """
+        x_mm, y_mm, theta_degrees = pose
+        shift_x, shift_y = self.recenter_shift(x_mm, y_mm)
+        if shift_x != 0 or shift_y != 0:
+            get_window(self.window_bytes)
+            self.store()
+            self.origin = (self.origin[0] + shift_x, self.origin[1] + shift_y)
+            self.load()
+
+            dx_mm = shift_x * self.tile_size_mm
+            dy_mm = shift_y * self.tile_size_mm
+            set_window(self.window_bytes, dx_mm, dy_mm)
+            x_mm -= dx_mm
+            y_mm -= dy_mm
+            self.num_recenters += 1
+
+        origin_x_mm, origin_y_mm = self.origin_mm
+        return x_mm + origin_x_mm, y_mm + origin_y_mm, theta_degrees
+
+    def tile_keys(self):
+        """Every tile on disk, as (tile x, tile y)"""
+        keys = []
+        for file_name in os.listdir(self.directory):
+            name, extension = os.path.splitext(file_name)
+            if extension == self.tile_extension:
+                tile_x, tile_y = name.split("_")
+                keys.append((int(tile_x), int(tile_y)))
+        return keys
+
+    def mosaic(self):
+        """Stitch every stored tile into one image. Returns the image and the world tile of its top left corner"""
+        keys = self.tile_keys()
+        if len(keys) == 0:
+            return np.zeros((0, 0), dtype=np.uint8), (0, 0)
+
+        min_x = min(key[0] for key in keys)
+        min_y = min(key[1] for key in keys)
+        width = max(key[0] for key in keys) - min_x + 1
+        height = max(key[1] for key in keys) - min_y + 1
+
+        image = np.full((height * self.tile_size_pixels, width * self.tile_size_pixels), self.unknown_value,
+                        dtype=np.uint8)
+        for tile_x, tile_y in keys:
+            y = (tile_y - min_y) * self.tile_size_pixels
+            x = (tile_x - min_x) * self.tile_size_pixels
+            image[y: y + self.tile_size_pixels, x: x + self.tile_size_pixels] = self.tile(tile_x, tile_y)
+        return image, (min_x, min_y)
+
+    def close(self):
+        for tile in self.open_tiles.values():
+            tile.flush()
+        self.open_tiles.clear()
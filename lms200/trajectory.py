@@ -0,0 +1,121 @@
+import os
+import numpy as np
+
+
+class Trajectory:
+    """
+    Poses stored as numpy columns (timestamp, x_mm, y_mm, theta_degrees) in fixed size chunks, so appending is
+    cheap and nothing is copied as the trajectory grows. With spill_path set, full chunks are appended to
+    that file and read back through a memmap, only the chunk being filled stays in memory.
+    Timestamps are expected to increase, time slicing relies on it.
+    """
+
+    dtype = np.dtype([
+        ("timestamp", "<f8"),
+        ("x_mm", "<f8"),
+        ("y_mm", "<f8"),
+        ("theta_degrees", "<f8"),
+    ])
+
+    def __init__(self, chunk_size=4096, spill_path=None):
+        self.chunk_size = chunk_size
+        self.spill_path = spill_path
+
+        self.chunks = []  # full chunks kept in memory
+        self.chunk = np.zeros(self.chunk_size, dtype=self.dtype)
+        self.chunk_length = 0
+
+        self.spill_file = None
+        self.num_spilled = 0
+        self._spilled = None  # memmap of the spill file, reopened when it grows
+        if self.spill_path is not None:
+            self.spill_file = open(self.spill_path, 'wb')
+
+    def append(self, timestamp, x_mm, y_mm, theta_degrees):
+        self.chunk[self.chunk_length] = (timestamp, x_mm, y_mm, theta_degrees)
+        self.chunk_length += 1
+        if self.chunk_length == self.chunk_size:
+            self._retire_chunk()
+
+    def _retire_chunk(self):
+        if self.spill_file is not None:
+            self.spill_file.write(self.chunk.tobytes())
+            self.spill_file.flush()
+            self.num_spilled += self.chunk_size
+            self._spilled = None
+        else:
+            self.chunks.append(self.chunk)
+            self.chunk = np.zeros(self.chunk_size, dtype=self.dtype)
+        self.chunk_length = 0
+
+    def __len__(self):
+        return self.num_spilled + len(self.chunks) * self.chunk_size + self.chunk_length
+
+    def segments(self):
+        """The stored poses as a list of arrays in order: the spill file, full chunks, then the partial chunk"""
+        segments = []
+        if self.num_spilled > 0:
+            if self._spilled is None:
+                self._spilled = np.memmap(self.spill_path, dtype=self.dtype, mode='r', shape=(self.num_spilled,))
+            segments.append(self._spilled)
+        segments.extend(self.chunks)
+        if self.chunk_length > 0:
+            segments.append(self.chunk[:self.chunk_length])
+        return segments
+
+    def read(self, start=0, stop=None):
+        """Poses from index start up to stop as one structured array"""
+        stop = len(self) if stop is None else min(stop, len(self))
+        parts = []
+        offset = 0
+        for segment in self.segments():
+            if offset >= stop:
+                break
+            end = offset + len(segment)
+            if end > start:
+                parts.append(segment[max(start - offset, 0): stop - offset])
+            offset = end
+
+        if len(parts) == 0:
+            return np.zeros(0, dtype=self.dtype)
+        return np.concatenate(parts)
+
+    def find_timestamp(self, timestamp):
+        """Index of the first pose at or after timestamp"""
+        offset = 0
+        for segment in self.segments():
+            if segment["timestamp"][-1] >= timestamp:
+                return offset + int(np.searchsorted(segment["timestamp"], timestamp))
+            offset += len(segment)
+        return offset
+
+    def slice_time(self, start_time=None, end_time=None):
+        """Poses recorded from start_time up to (not including) end_time. None means the start or end"""
+        start = 0 if start_time is None else self.find_timestamp(start_time)
+        stop = len(self) if end_time is None else self.find_timestamp(end_time)
+        return self.read(start, stop)
+
+    @property
+    def xy(self):
+        """(N, 2) array of x, y in mm"""
+        poses = self.read()
+        return np.stack([poses["x_mm"], poses["y_mm"]], axis=-1)
+
+    @property
+    def last(self):
+        if len(self) == 0:
+            return None
+        return self.read(len(self) - 1)[0]
+
+    def export(self, path):
+        """Save the trajectory as .npy (structured array) or .csv, picked by the file extension"""
+        poses = self.read()
+        if os.path.splitext(path)[1] == ".csv":
+            np.savetxt(path, poses, fmt="%0.6f", delimiter=",", header=",".join(self.dtype.names), comments="")
+        else:
+            np.save(path, poses)
+
+    def close(self):
+        self._spilled = None
+        if self.spill_file is not None:
+            self.spill_file.close()
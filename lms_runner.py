@@ -3,10 +3,17 @@ import argparse
 from atlasbuggy import Orchestrator, run
 from atlasbuggy.plotters import LivePlotter
 
-from lms200 import Slam, LMS200, LmsPlayback, LMSPlotter
+from lms200 import Slam, LMS200, LmsPlayback, LMSPlotter, ScannerGroup, ScannerMount, SimulatedSickLMS
+from lms200.sick import operating_modes
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-p", "--play", help="run in playback mode", action="store_true")
+parser.add_argument("-s", "--speed", help="playback speed: realtime, <N>x or max", default="realtime")
+parser.add_argument("-b", "--baud", help="serial baud rate. 500000 needs an RS-422 link", type=int, default=38400)
+parser.add_argument("-r", "--rear", help="serial port of a rear facing scanner to fuse with the front one")
+parser.add_argument("--simulate", help="run live without a scanner, replaying SOURCE (a log) or a synthetic room",
+                    nargs="?", const="", metavar="SOURCE")
+parser.add_argument("--reflect", help="stream reflectivity along with the ranges", action="store_true")
 args = parser.parse_args()
 
 playback = args.play
@@ -26,7 +33,7 @@ class PlaybackOrchestrator(Orchestrator):
     def __init__(self, event_loop):
         super(PlaybackOrchestrator, self).__init__(event_loop)
 
-        sicklms = LmsPlayback(file_name, "converted")
+        sicklms = LmsPlayback(file_name, "converted", speed=args.speed)
         plotter = LivePlotter(title="LMS200 Data")
         lms_plotter = LMSPlotter()
 
@@ -36,16 +43,43 @@ class PlaybackOrchestrator(Orchestrator):
         self.subscribe(plotter, lms_plotter, lms_plotter.plotter_tag)
         self.subscribe(sicklms, lms_plotter, lms_plotter.lms_tag)
 
+front_port = "/dev/serial/by-id/usb-Prolific_Technology_Inc._USB-Serial_Controller-if00-port0"
+# front_port = "/dev/cu.usbserial"
+
+# where the scanners sit on the robot. Their 90 degree beam points straight out, measure the offsets on the robot
+scanner_mounts = {
+    "front": ScannerMount(x_mm=0.0, y_mm=0.0, yaw_degrees=-90.0),
+    "rear": ScannerMount(x_mm=0.0, y_mm=0.0, yaw_degrees=90.0),
+}
+
+
 class LiveOrchestrator(Orchestrator):
     def __init__(self, event_loop):
         super(LiveOrchestrator, self).__init__(event_loop)
 
-        sicklms = LMS200(
-            "/dev/serial/by-id/usb-Prolific_Technology_Inc._USB-Serial_Controller-if00-port0"
-            # "/dev/cu.usbserial"
-        )
-        self.add_nodes(sicklms, slam)
-        self.subscribe(sicklms, slam, slam.lms_tag)
+        if args.reflect:
+            stream_mode = operating_modes.MONITOR_STREAM_RANGE_AND_REFLECT
+        else:
+            stream_mode = operating_modes.MONITOR_STREAM_VALUES
+        sicklms = LMS200(front_port, baud=args.baud, stream_mode=stream_mode, device=self.make_device(front_port))
+        if args.rear is None:
+            self.add_nodes(sicklms, slam)
+            self.subscribe(sicklms, slam, slam.lms_tag)
+        else:
+            # both scanners stream the same way so the fused scans line up
+            rear_sicklms = LMS200(args.rear, baud=args.baud, stream_mode=stream_mode,
+                                  device=self.make_device(args.rear))
+            scanners = ScannerGroup(scanner_mounts)
+            self.add_nodes(sicklms, rear_sicklms, scanners, slam)
+            self.subscribe(sicklms, scanners, "front")
+            self.subscribe(rear_sicklms, scanners, "rear")
+            self.subscribe(scanners, slam, slam.lms_tag)
+
+    def make_device(self, port):
+        """A simulated scanner standing in for the one at port with --simulate, otherwise None"""
+        if args.simulate is None:
+            return None
+        return SimulatedSickLMS(port, source=args.simulate or None)
 
 
 if playback:
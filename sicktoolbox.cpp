@@ -1,20 +1,260 @@
 #include <boost/python.hpp>
 #include <SickLMS.hh>
+#include <cstring>
+#include <mutex>
 using namespace boost::python;
 using namespace SickToolbox;
 
-unsigned int values[SickLMS::SICK_MAX_NUM_MEASUREMENTS] = {0};
-unsigned int num_values = 0;
+// Releases the GIL for as long as the object lives so blocking serial I/O doesn't stall other python threads
+class ReleaseGIL {
+public:
+    ReleaseGIL() {
+        state = PyEval_SaveThread();
+    }
+
+    ~ReleaseGIL() {
+        PyEval_RestoreThread(state);
+    }
 
-tuple GetScan(SickLMS *sick_lms) {
-    sick_lms->GetSickScan(values, num_values);
+private:
+    PyThreadState *state;
+};
 
-    list values_list;
-    for (int index = 0; index < num_values; index++) {
-        values_list.append(values[index]);
+// Holds a writable, C-contiguous view of a python buffer-protocol object (numpy array, bytearray, array.array)
+// for as long as the scan is being copied into it.
+class ScanBuffer {
+public:
+    Py_buffer view;
+
+    ScanBuffer(object buffer) {
+        if (PyObject_GetBuffer(buffer.ptr(), &view, PyBUF_WRITABLE | PyBUF_FORMAT | PyBUF_C_CONTIGUOUS) != 0) {
+            throw_error_already_set();
+        }
+    }
+
+    ~ScanBuffer() {
+        PyBuffer_Release(&view);
+    }
+
+    // Single-byte buffers (bytearray, uint8 arrays) are filled with packed native uint16 values
+    unsigned int value_size() {
+        return view.itemsize == 1 ? sizeof(uint16_t) : (unsigned int)view.itemsize;
+    }
+
+    unsigned int capacity() {
+        return (unsigned int)(view.len / value_size());
+    }
+
+    void check_format() {
+        char code = view.format == NULL ? 'B' : view.format[strlen(view.format) - 1];
+        bool is_integer = strchr("BbcHhIiLl", code) != NULL;
+        if (!is_integer || (view.itemsize != 1 && view.itemsize != 2 && view.itemsize != 4)) {
+            PyErr_SetString(PyExc_TypeError, "scan buffer must hold 8, 16, or 32 bit integers");
+            throw_error_already_set();
+        }
+    }
+
+    void fill(const unsigned int *scan_values, unsigned int count) {
+        if (count > capacity()) {
+            PyErr_Format(PyExc_ValueError, "scan buffer holds %u values, scan has %u", capacity(), count);
+            throw_error_already_set();
+        }
+        if (value_size() == sizeof(uint16_t)) {
+            uint16_t *output = (uint16_t *)view.buf;
+            for (unsigned int index = 0; index < count; index++) {
+                output[index] = (uint16_t)scan_values[index];
+            }
+        }
+        else {
+            memcpy(view.buf, scan_values, count * sizeof(unsigned int));
+        }
+    }
+
+    // Range and reflectivity are packed as one record of two native uint16 per beam: a numpy structured array
+    // of lms200.scanlog.beam_dtype, a uint16 array holding the pairs, or raw bytes
+    void check_beam_format() {
+        bool is_record = view.format != NULL && strstr(view.format, "T{") != NULL &&
+                         view.itemsize == 2 * sizeof(uint16_t);
+        char code = view.format == NULL ? 'B' : view.format[strlen(view.format) - 1];
+        bool is_pairs = view.itemsize == 1 || (view.itemsize == sizeof(uint16_t) && strchr("Hh", code) != NULL);
+        if (!is_record && !is_pairs) {
+            PyErr_SetString(PyExc_TypeError, "beam buffer must hold (range, reflectivity) uint16 records");
+            throw_error_already_set();
+        }
+    }
+
+    // Interleaves both measurements in one pass. The scanner sends reflectivity for the first num_reflect beams,
+    // the rest get 0
+    void fill_beams(const unsigned int *range_values, const unsigned int *reflect_values, unsigned int num_ranges,
+                    unsigned int num_reflect) {
+        unsigned int beam_capacity = (unsigned int)(view.len / (2 * sizeof(uint16_t)));
+        if (num_ranges > beam_capacity) {
+            PyErr_Format(PyExc_ValueError, "beam buffer holds %u beams, scan has %u", beam_capacity, num_ranges);
+            throw_error_already_set();
+        }
+        uint16_t *output = (uint16_t *)view.buf;
+        for (unsigned int index = 0; index < num_ranges; index++) {
+            output[2 * index] = (uint16_t)range_values[index];
+            output[2 * index + 1] = index < num_reflect ? (uint16_t)reflect_values[index] : 0;
+        }
+    }
+};
+
+// SickLMS with its own scan buffer and lock so several devices can be polled from separate threads.
+// Blocking calls give up the GIL first and only then take the device lock, so a thread waiting on the
+// lock never holds the GIL.
+class PySickLMS : public SickLMS {
+public:
+    unsigned int values[SickLMS::SICK_MAX_NUM_MEASUREMENTS];
+    unsigned int num_values;
+    unsigned int reflect_values[SickLMS::SICK_MAX_NUM_MEASUREMENTS];
+    unsigned int num_reflect_values;
+    std::mutex device_lock;
+
+    PySickLMS(std::string device_path) : SickLMS(device_path), num_values(0), num_reflect_values(0) {
+        memset(values, 0, sizeof(values));
+        memset(reflect_values, 0, sizeof(reflect_values));
+    }
+
+    void initialize(sick_lms_baud_t baud) {
+        ReleaseGIL release;
+        std::lock_guard<std::mutex> guard(device_lock);
+        Initialize(baud);
+    }
+
+    void uninitialize() {
+        ReleaseGIL release;
+        std::lock_guard<std::mutex> guard(device_lock);
+        Uninitialize();
+    }
+
+    sick_lms_operating_mode_t get_operating_mode() {
+        ReleaseGIL release;
+        std::lock_guard<std::mutex> guard(device_lock);
+        return GetSickOperatingMode();
+    }
+
+    sick_lms_measuring_mode_t get_measuring_mode() {
+        ReleaseGIL release;
+        std::lock_guard<std::mutex> guard(device_lock);
+        return GetSickMeasuringMode();
+    }
+
+    sick_lms_measuring_units_t get_measuring_units() {
+        ReleaseGIL release;
+        std::lock_guard<std::mutex> guard(device_lock);
+        return GetSickMeasuringUnits();
+    }
+
+    double get_scan_resolution() {
+        ReleaseGIL release;
+        std::lock_guard<std::mutex> guard(device_lock);
+        return GetSickScanResolution();
+    }
+
+    double get_scan_angle() {
+        ReleaseGIL release;
+        std::lock_guard<std::mutex> guard(device_lock);
+        return GetSickScanAngle();
+    }
+
+    void set_variant(sick_lms_scan_angle_t scan_angle, sick_lms_scan_resolution_t scan_resolution) {
+        ReleaseGIL release;
+        std::lock_guard<std::mutex> guard(device_lock);
+        SetSickVariant(scan_angle, scan_resolution);
     }
-    return tuple(values_list);
-}
+
+    void set_measuring_mode(sick_lms_measuring_mode_t measuring_mode) {
+        ReleaseGIL release;
+        std::lock_guard<std::mutex> guard(device_lock);
+        SetSickMeasuringMode(measuring_mode);
+    }
+
+    void set_measuring_units(sick_lms_measuring_units_t measuring_units) {
+        ReleaseGIL release;
+        std::lock_guard<std::mutex> guard(device_lock);
+        SetSickMeasuringUnits(measuring_units);
+    }
+
+    // Runs one of the GetSick* scan calls without the GIL. Returns with the GIL held and device_lock locked
+    // through scan_guard, so values can be copied out before another thread overwrites them
+    template <typename ScanFunction>
+    void read_scan(std::unique_lock<std::mutex> &scan_guard, ScanFunction scan_function) {
+        ReleaseGIL release;
+        scan_guard.lock();
+        scan_function();
+    }
+
+    void read_scan(std::unique_lock<std::mutex> &scan_guard) {
+        read_scan(scan_guard, [this]() { GetSickScan(values, num_values); });
+    }
+
+    template <typename ScanFunction>
+    unsigned int read_scan_into(object buffer, ScanFunction scan_function) {
+        ScanBuffer scan_buffer(buffer);
+        scan_buffer.check_format();
+
+        std::unique_lock<std::mutex> scan_guard(device_lock, std::defer_lock);
+        read_scan(scan_guard, scan_function);
+        scan_buffer.fill(values, num_values);
+
+        return num_values;
+    }
+
+    tuple get_scan() {
+        std::unique_lock<std::mutex> scan_guard(device_lock, std::defer_lock);
+        read_scan(scan_guard);
+
+        list values_list;
+        for (unsigned int index = 0; index < num_values; index++) {
+            values_list.append(values[index]);
+        }
+        return tuple(values_list);
+    }
+
+    // Switches the device to MONITOR_STREAM_VALUES
+    unsigned int get_scan_into(object buffer) {
+        return read_scan_into(buffer, [this]() { GetSickScan(values, num_values); });
+    }
+
+    // Switches the device to MONITOR_STREAM_MEAN_VALUES, each value is averaged over sample_size scans
+    unsigned int get_mean_values_into(unsigned int sample_size, object buffer) {
+        return read_scan_into(buffer, [this, sample_size]() {
+            GetSickMeanValues((uint8_t)sample_size, values, num_values);
+        });
+    }
+
+    // Switches the device to MONITOR_STREAM_VALUES_SUBRANGE, only the values from start to stop index are sent
+    unsigned int get_scan_subrange_into(unsigned int start_index, unsigned int stop_index, object buffer) {
+        return read_scan_into(buffer, [this, start_index, stop_index]() {
+            GetSickScanSubrange((uint16_t)start_index, (uint16_t)stop_index, values, num_values);
+        });
+    }
+
+    // Switches the device to MONITOR_STREAM_RANGE_AND_REFLECT, buffer gets one (range, reflectivity) record per beam
+    unsigned int get_range_and_reflect_into(object buffer) {
+        ScanBuffer scan_buffer(buffer);
+        scan_buffer.check_beam_format();
+
+        std::unique_lock<std::mutex> scan_guard(device_lock, std::defer_lock);
+        read_scan(scan_guard, [this]() { GetSickScan(values, reflect_values, num_values, num_reflect_values); });
+        scan_buffer.fill_beams(values, reflect_values, num_values, num_reflect_values);
+
+        return num_values;
+    }
+
+    object get_scan_array() {
+        std::unique_lock<std::mutex> scan_guard(device_lock, std::defer_lock);
+        read_scan(scan_guard);
+
+        // array.array('I') pickles as raw bytes and can be wrapped by numpy.frombuffer without a copy
+        object scan_array = import("array").attr("array")("I");
+        object raw_values(handle<>(PyBytes_FromStringAndSize((const char *)values, num_values * sizeof(unsigned int))));
+        scan_array.attr("frombytes")(raw_values);
+
+        return scan_array;
+    }
+};
 
 //PyObject *sickIOExceptionType = NULL;
 //
@@ -27,16 +267,31 @@ tuple GetScan(SickLMS *sick_lms) {
 
 BOOST_PYTHON_MODULE(sicktoolbox)
 {
-    class_<SickLMS>("SickLMS", init<std::string>())
-        .def("initialize", &SickLMS::Initialize)
-        .def("get_scan", GetScan)
-        .def("uninitialize", &SickLMS::Uninitialize)
-
-        .def("get_operating_mode", &SickToolbox::SickLMS::GetSickOperatingMode)
-        .def("get_measuring_mode", &SickToolbox::SickLMS::GetSickMeasuringMode)
-        .def("get_measuring_units", &SickToolbox::SickLMS::GetSickMeasuringUnits)
-        .def("get_scan_resolution", &SickToolbox::SickLMS::GetSickScanResolution)
-        .def("get_scan_angle", &SickToolbox::SickLMS::GetSickScanAngle)
+    scope().attr("MAX_NUM_MEASUREMENTS") = (unsigned int)SickLMS::SICK_MAX_NUM_MEASUREMENTS;
+
+#if PY_VERSION_HEX < 0x03070000
+    PyEval_InitThreads();
+#endif
+
+    class_<PySickLMS, boost::noncopyable>("SickLMS", init<std::string>())
+        .def("initialize", &PySickLMS::initialize)
+        .def("get_scan", &PySickLMS::get_scan)
+        .def("get_scan_into", &PySickLMS::get_scan_into)
+        .def("get_scan_array", &PySickLMS::get_scan_array)
+        .def("get_mean_values_into", &PySickLMS::get_mean_values_into)
+        .def("get_scan_subrange_into", &PySickLMS::get_scan_subrange_into)
+        .def("get_range_and_reflect_into", &PySickLMS::get_range_and_reflect_into)
+        .def("uninitialize", &PySickLMS::uninitialize)
+
+        .def("get_operating_mode", &PySickLMS::get_operating_mode)
+        .def("get_measuring_mode", &PySickLMS::get_measuring_mode)
+        .def("get_measuring_units", &PySickLMS::get_measuring_units)
+        .def("get_scan_resolution", &PySickLMS::get_scan_resolution)
+        .def("get_scan_angle", &PySickLMS::get_scan_angle)
+
+        .def("set_variant", &PySickLMS::set_variant)
+        .def("set_measuring_mode", &PySickLMS::set_measuring_mode)
+        .def("set_measuring_units", &PySickLMS::set_measuring_units)
     ;
     enum_<SickLMS::sick_lms_baud_t>("bauds")
         .value("SICK_BAUD_9600", SickToolbox::SickLMS::SICK_BAUD_9600)
@@ -46,6 +301,20 @@ BOOST_PYTHON_MODULE(sicktoolbox)
         .value("SICK_BAUD_UNKNOWN", SickToolbox::SickLMS::SICK_BAUD_UNKNOWN)
     ;
 
+    enum_<SickLMS::sick_lms_scan_angle_t>("scan_angles")
+        .value("ANGLE_90", SickToolbox::SickLMS::SICK_SCAN_ANGLE_90)
+        .value("ANGLE_100", SickToolbox::SickLMS::SICK_SCAN_ANGLE_100)
+        .value("ANGLE_180", SickToolbox::SickLMS::SICK_SCAN_ANGLE_180)
+        .value("UNKNOWN", SickToolbox::SickLMS::SICK_SCAN_ANGLE_UNKNOWN)
+    ;
+
+    enum_<SickLMS::sick_lms_scan_resolution_t>("scan_resolutions")
+        .value("RESOLUTION_25", SickToolbox::SickLMS::SICK_SCAN_RESOLUTION_25)
+        .value("RESOLUTION_50", SickToolbox::SickLMS::SICK_SCAN_RESOLUTION_50)
+        .value("RESOLUTION_100", SickToolbox::SickLMS::SICK_SCAN_RESOLUTION_100)
+        .value("UNKNOWN", SickToolbox::SickLMS::SICK_SCAN_RESOLUTION_UNKNOWN)
+    ;
+
     enum_<SickLMS::sick_lms_measuring_units_t>("units")
         .value("CM", SickToolbox::SickLMS::SICK_MEASURING_UNITS_CM)
         .value("MM", SickToolbox::SickLMS::SICK_MEASURING_UNITS_MM)
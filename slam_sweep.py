@@ -0,0 +1,156 @@
+import os
+import glob
+import json
+import time
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from lms200 import load_session, make_offline_slam, run_offline_slam
+from lms200.simulator import SickIOException
+
+
+def make_grid(map_sizes_pixels, map_sizes_meters, algorithms, max_ranges_m, seeds):
+    """Every combination of the SLAM parameters, as dicts"""
+    grid = []
+    for map_size_pixels, map_size_meters, algorithm, max_range_m, seed in itertools.product(
+            map_sizes_pixels, map_sizes_meters, algorithms, max_ranges_m, seeds):
+        grid.append(dict(map_size_pixels=map_size_pixels, map_size_meters=map_size_meters, algorithm=algorithm,
+                         max_range_m=max_range_m, seed=seed))
+    return grid
+
+
+def run_name(path, parameters):
+    """Directory name of one run, the log's day and session followed by its parameters"""
+    day = os.path.basename(os.path.dirname(path))
+    session = os.path.basename(path).split(".")[0]
+    max_range = "full" if parameters["max_range_m"] is None else "%sm" % parameters["max_range_m"]
+    return os.path.join("%s_%s" % (day, session), "%spx_%sm_%s_range-%s_seed-%s" % (
+        parameters["map_size_pixels"], parameters["map_size_meters"], parameters["algorithm"], max_range,
+        parameters["seed"]))
+
+
+def run_log(path, grid, output_directory):
+    """
+    SLAM one log with every set of parameters in grid. The log is decoded once and dropped when the grid is done.
+    Returns the stats of the runs that finished and (parameters, error message) of the ones that failed
+    """
+    t0 = time.perf_counter()
+    try:
+        scans, timestamps, config = load_session(path)
+    except SickIOException:
+        return [], []  # logs recorded without the LMS200 running
+    load_seconds = time.perf_counter() - t0
+
+    runs = []
+    failures = []
+    for parameters in grid:
+        try:
+            runs.append(run_one(path, scans, timestamps, config, load_seconds, parameters, output_directory))
+        except Exception as error:
+            failures.append((parameters, str(error)))
+    return runs, failures
+
+
+def run_one(path, scans, timestamps, config, load_seconds, parameters, output_directory):
+    """SLAM a decoded log with one set of parameters. Writes the map and trajectory, returns the run's stats"""
+    max_range_m = parameters["max_range_m"]
+    slam = make_offline_slam(
+        scans.shape[1], config, parameters["map_size_pixels"], parameters["map_size_meters"],
+        deterministic=parameters["algorithm"] == "deterministic",
+        max_range_mm=None if max_range_m is None else max_range_m * 1000,
+        parameters=dict(random_seed=parameters["seed"])
+    )
+    try:
+        slam_seconds = run_offline_slam(slam, scans, timestamps)
+
+        directory = os.path.join(output_directory, run_name(path, parameters))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        t0 = time.perf_counter()
+        slam.make_image(os.path.join(directory, "map"))
+        slam.trajectory.export(os.path.join(directory, "trajectory.csv"))
+        save_seconds = time.perf_counter() - t0
+
+        update_stats = slam.metrics.summary()["stages"]["slam_update"]
+        stats = dict(
+            log=path, directory=directory, parameters=parameters, scans=len(scans), load_seconds=load_seconds,
+            slam_seconds=slam_seconds, scans_per_s=len(scans) / slam_seconds if slam_seconds > 0 else 0.0,
+            update_p50_seconds=update_stats["p50"], update_p99_seconds=update_stats["p99"],
+            update_max_seconds=update_stats["max"], save_seconds=save_seconds,
+            final_pose=[float(value) for value in slam.get_pos()],
+        )
+    finally:
+        slam.metrics.close()
+        slam.trajectory.close()
+
+    with open(os.path.join(directory, "run.json"), 'w') as stats_file:
+        json.dump(stats, stats_file, indent=4)
+    return stats
+
+
+def sweep(paths, grid, output_directory="sweeps", jobs=None):
+    """
+    Run every log with every set of parameters in a process pool, one task per log so each log is only decoded
+    once and only held by the process running its grid. Returns the stats of the runs that finished
+    """
+    t0 = time.time()
+    runs = []
+    failures = 0
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(run_log, path, grid, output_directory): path for path in paths}
+
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                log_runs, log_failures = future.result()
+            except Exception as error:
+                failures += len(grid)
+                print("%s: failed: %s" % (path, error))
+                continue
+
+            failures += len(log_failures)
+            for parameters, error in log_failures:
+                print("%s: failed %s: %s" % (path, parameters, error))
+            runs.extend(log_runs)
+            for stats in log_runs:
+                print("%s: %s scans in %0.2fs (%0.0f scans/s), update p99 %0.1fms" % (
+                    stats["directory"], stats["scans"], stats["slam_seconds"], stats["scans_per_s"],
+                    stats["update_p99_seconds"] * 1000))
+
+    duration = time.time() - t0
+    runs.sort(key=lambda stats: stats["directory"])
+    if not os.path.isdir(output_directory):
+        os.makedirs(output_directory)
+    with open(os.path.join(output_directory, "sweep.json"), 'w') as summary_file:
+        json.dump(dict(duration=duration, failures=failures, runs=runs), summary_file, indent=4)
+
+    print("%s runs (%s failed) in %0.1fs" % (len(runs), failures, duration))
+    return runs
+
+
+def parse_range(value):
+    return None if value == "full" else float(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run SLAM offline over logs with every combination of parameters")
+    parser.add_argument("paths", nargs="*", help="logs to run. Defaults to logs/*/*.log.xz")
+    parser.add_argument("-o", "--output", default="sweeps", help="directory to write maps and trajectories to")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes. Defaults to the core count")
+    parser.add_argument("-p", "--pixels", type=int, nargs="+", default=[1600], help="map sizes in pixels")
+    parser.add_argument("-m", "--meters", type=float, nargs="+", default=[50], help="map sizes in meters")
+    parser.add_argument("-a", "--algorithms", nargs="+", choices=("rmhc", "deterministic"), default=["rmhc"])
+    parser.add_argument("-r", "--ranges", type=parse_range, nargs="+", default=[None],
+                        help="max ranges in meters SLAM uses, or full for the scanner's max distance")
+    parser.add_argument("-s", "--seeds", type=int, nargs="+", default=[1], help="RMHC random seeds")
+    args = parser.parse_args()
+
+    paths = args.paths or sorted(glob.glob(os.path.join("logs", "*", "*.log.xz")))
+    grid = make_grid(args.pixels, args.meters, args.algorithms, args.ranges, args.seeds)
+    print("%s logs x %s parameter sets" % (len(paths), len(grid)))
+    sweep(paths, grid, args.output, args.jobs)
+
+
+if __name__ == "__main__":
+    main()
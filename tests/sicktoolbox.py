@@ -1,9 +1,9 @@
 import time
-from lms200 import LMS200, Bauds
+from lms200.sick import SickLMS, bauds
 
-sicklms = LMS200("/dev/cu.usbserial")
+sicklms = SickLMS("/dev/cu.usbserial")
 try:
-    sicklms.initialize(Bauds.SICK_BAUD_38400)
+    sicklms.initialize(bauds.SICK_BAUD_38400)
 
     scan = sicklms.get_scan()
     print(scan)
@@ -0,0 +1,82 @@
+import pickle
+
+import pytest
+
+from lms200.metrics import PipelineMetrics
+
+
+@pytest.fixture(params=[True, False], ids=["shared", "in-process"])
+def metrics(request):
+    metrics = PipelineMetrics(stages=("read", "update"), gauges=("depth",), shared=request.param)
+    yield metrics
+    metrics.close()
+
+
+def test_percentiles(metrics):
+    for _ in range(90):
+        metrics.record("read", 0.001)
+    for _ in range(10):
+        metrics.record("read", 0.1)
+
+    bucket_width = 10 ** (1.0 / metrics.buckets_per_decade)
+    assert 0.001 <= metrics.percentile("read", 50) <= 0.001 * bucket_width
+    # capped at the slowest timing instead of the bucket's upper edge
+    assert metrics.percentile("read", 99) == 0.1
+    assert metrics.percentile("update", 50) == 0.0
+
+    stats = metrics.summary()["stages"]["read"]
+    assert stats["count"] == 100
+    assert stats["max"] == 0.1
+    assert stats["last"] == 0.1
+    assert stats["mean"] == pytest.approx((90 * 0.001 + 10 * 0.1) / 100)
+
+
+def test_percentiles_since_snapshot(metrics):
+    for _ in range(100):
+        metrics.record("read", 0.1)
+    snapshot = metrics.snapshot()
+    for _ in range(10):
+        metrics.record("read", 0.001)
+    assert metrics.percentile("read", 99, since=snapshot) <= 0.001 * 10 ** (1.0 / metrics.buckets_per_decade)
+
+
+def test_window_forgets_old_timings(metrics):
+    now = int(metrics.header["start_time"][0]) + 100
+    metrics.record("update", 5.0, now=now - 30)
+    for second in range(now - 8, now + 1):
+        metrics.record("update", 0.01, now=second)
+        metrics.record("update", 0.02, now=second)
+
+    rate_hz, window_max = metrics.window_stats("update", now=now)
+    assert rate_hz == pytest.approx(2.0)
+    assert window_max == 0.02
+    assert metrics.summary()["stages"]["update"]["max"] == 5.0
+
+
+def test_gauges(metrics):
+    metrics.set("depth", 3)
+    metrics.set("depth", 7)
+    assert metrics.summary()["gauges"] == {"depth": 7.0}
+
+
+def test_attached_metrics_see_records():
+    metrics = PipelineMetrics(stages=("read",), gauges=("depth",))
+    attached = pickle.loads(pickle.dumps(metrics))
+    try:
+        assert attached.stages == ("read",)
+        attached.record("read", 0.01)
+        attached.set("depth", 2)
+        assert metrics.summary()["stages"]["read"]["count"] == 1
+        assert metrics.summary()["gauges"]["depth"] == 2.0
+    finally:
+        attached.close()
+        metrics.close()
+
+
+def test_in_process_metrics_cannot_be_shared():
+    metrics = PipelineMetrics(shared=False)
+    assert metrics.name is None
+    with pytest.raises(TypeError):
+        pickle.dumps(metrics)
+    metrics.close()
+    metrics.record("slam_update", 0.01)  # closed metrics ignore records
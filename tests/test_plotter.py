@@ -0,0 +1,46 @@
+import math
+import types
+
+import numpy as np
+import pytest
+
+from lms200.plotter import LMSPlotter
+from lms200.sick import units
+
+
+def make_plotter(scan_angle, scan_resolution):
+    plotter = LMSPlotter()
+    plotter.lms = types.SimpleNamespace(scan_angle=scan_angle, scan_resolution=scan_resolution,
+                                        measuring_units=units.MM, max_distance=8.0)
+    return plotter
+
+
+def test_point_cloud():
+    plotter = make_plotter(180.0, 0.5)
+    points = plotter.get_point_cloud(np.full(361, 1000))
+    assert points.shape == (361, 2)
+    np.testing.assert_allclose(points[0], [1000.0, 0.0], atol=1e-3)
+    np.testing.assert_allclose(points[180], [0.0, 1000.0], atol=1e-3)
+    np.testing.assert_allclose(points[-1], [-1000.0, 0.0], atol=1e-3)
+
+
+def test_out_of_range_points_are_dropped():
+    plotter = make_plotter(180.0, 1.0)
+    scan = np.full(181, 1000)
+    scan[10] = 9000
+    assert len(plotter.get_point_cloud(scan)) == 180
+
+
+@pytest.mark.parametrize("scan_angle, scan_resolution", [(0.0, 0.0), (180.0, 0.0), (100.0, 1.0)])
+def test_unknown_config_spreads_beams(scan_angle, scan_resolution):
+    plotter = make_plotter(scan_angle, scan_resolution)
+    plotter.make_unit_vectors(361)
+    assert plotter.unit_vectors.shape == (361, 2)
+    assert plotter.angles[-1] == pytest.approx(math.radians(scan_angle or 180.0))
+
+
+def test_batches_match_single_scans():
+    plotter = make_plotter(180.0, 1.0)
+    scans = [np.arange(181) * 10 + offset for offset in (100, 200, 300)]
+    for batch_points, points in zip(plotter.get_point_clouds(scans), [plotter.get_point_cloud(s) for s in scans]):
+        np.testing.assert_allclose(batch_points, points)
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from lms200.preprocessing import ScanPreprocessor
+
+
+def test_converts_units_and_drops_out_of_range():
+    preprocessor = ScanPreprocessor(5, 3000, scale=10.0, no_detection_mm=1.0)
+    distances = preprocessor.process([[10, 100, 200, 400, 50]])
+    np.testing.assert_array_equal(distances, [[100, 1000, 2000, 1.0, 500]])
+
+
+def test_median_filter():
+    preprocessor = ScanPreprocessor(6, 10000, median_size=3)
+    distances = preprocessor.process([[100, 5000, 120, 130, 140, 150]])
+    # edges repeat the end beams
+    np.testing.assert_array_equal(distances, [[100, 120, 130, 130, 140, 150]])
+
+
+def test_outlier_rejection_only_replaces_outliers():
+    preprocessor = ScanPreprocessor(6, 10000, outlier_threshold_mm=500)
+    distances = preprocessor.process([[1000, 1100, 5000, 1200, 1300, 1250]])
+    np.testing.assert_array_equal(distances, [[1000, 1100, 1200, 1200, 1300, 1250]])
+
+
+def test_pads_short_and_cuts_long_scans():
+    preprocessor = ScanPreprocessor(4, 10000, scale=10.0, no_detection_mm=1.0)
+    distances = preprocessor.process([[10, 20], [10, 20, 30, 40, 50]])
+    np.testing.assert_array_equal(distances, [[100, 200, 1, 1], [100, 200, 300, 400]])
+
+
+def test_downsample():
+    preprocessor = ScanPreprocessor(7, 10000, downsample=3)
+    assert preprocessor.scan_size == 3
+    distances = preprocessor.process([np.arange(7) * 100])
+    np.testing.assert_array_equal(distances, [[0, 300, 600]])
+
+
+def test_batches_reuse_the_buffer():
+    preprocessor = ScanPreprocessor(3, 10000, batch_size=2, median_size=3)
+    scans = np.arange(12).reshape(4, 3) * 100
+    first = preprocessor.process(scans[:2]).copy()
+    second = preprocessor.process(scans[2:])
+    np.testing.assert_array_equal(first, scans[:2])
+    np.testing.assert_array_equal(second, scans[2:])
+    with pytest.raises(ValueError):
+        preprocessor.process(scans)
+
+
+def test_rejects_even_median_size():
+    with pytest.raises(ValueError):
+        ScanPreprocessor(10, 10000, median_size=4)
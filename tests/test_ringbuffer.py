@@ -0,0 +1,88 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from lms200.ringbuffer import ScanRingBuffer
+
+
+@pytest.fixture
+def make_ring():
+    rings = []
+
+    def make(capacity=4, num_values=8, overflow_policy="overwrite"):
+        ring = ScanRingBuffer(capacity, num_values, overflow_policy)
+        rings.append(ring)
+        return ring
+
+    yield make
+    for ring in rings:
+        ring.close()
+
+
+def write(ring, n, num_values=3):
+    values = ring.claim()
+    values[:num_values] = n
+    return ring.publish(float(n), n, num_values)
+
+
+def test_read_in_order_across_wraparound(make_ring):
+    ring = make_ring(capacity=4)
+    reader = ring.reader()
+    for n in range(10):
+        assert write(ring, n)
+        timestamp, scan_n, values = reader.read()
+        assert (timestamp, scan_n) == (float(n), n)
+        np.testing.assert_array_equal(values, [n, n, n])
+    assert reader.read() is None
+    assert reader.pending() == 0
+
+
+def test_overwrite_skips_to_the_oldest_scan_left(make_ring):
+    ring = make_ring(capacity=4)
+    reader = ring.reader()
+    other = ring.reader(primary=False)
+    for n in range(10):
+        write(ring, n)
+
+    assert [reader.read()[1] for _ in range(3)] == [7, 8, 9]
+    assert reader.read() is None
+    assert reader.overruns == 7
+    # every reader counts the scans it missed itself
+    assert other.overruns == 0
+    assert other.read()[1] == 7
+    assert other.overruns == 7
+    assert ring.dropped == 0
+
+
+def test_drop_keeps_unread_scans(make_ring):
+    ring = make_ring(capacity=4, overflow_policy="drop")
+    reader = ring.reader()
+    results = [write(ring, n) for n in range(6)]
+    assert results == [True] * 4 + [False] * 2
+    assert ring.dropped == 2
+    assert len(ring) == 4
+
+    assert [reader.read()[1] for _ in range(4)] == [0, 1, 2, 3]
+    assert reader.overruns == 0
+    assert write(ring, 6)
+    assert reader.read()[1] == 6
+
+
+def test_attached_ring_shares_scans(make_ring):
+    ring = make_ring()
+    attached = pickle.loads(pickle.dumps(ring))
+    try:
+        assert not attached.is_owner
+        reader = ring.reader()
+        write(attached, 5, num_values=8)
+        assert reader.read()[1] == 5
+    finally:
+        attached.close()
+
+
+def test_rejects_bad_arguments():
+    with pytest.raises(ValueError):
+        ScanRingBuffer(4, 8, "block")
+    with pytest.raises(ValueError):
+        ScanRingBuffer(1, 8)
@@ -0,0 +1,108 @@
+import os
+
+import numpy as np
+
+from lms200.messages import LmsScan
+from lms200.playback import TextScanSource
+from lms200.scancache import ScanCache, CachedScanSource
+
+
+def write_text_log(path, lengths, start_n=0):
+    with open(path, 'w') as log_file:
+        log_file.write("[LMS200][DEBUG] 2017-09-16 12:00:00,000: Scan resolution: 0.5\n")
+        log_file.write("[LMS200][DEBUG] 2017-09-16 12:00:00,000: Scan angle: 180.0\n")
+        for index, length in enumerate(lengths):
+            scan = LmsScan(100.0 + index * 0.2, start_n + index, 5.0, np.arange(length) + index)
+            log_file.write("[LMS200][DEBUG] 2017-09-16 12:00:00,000: %s\n" % scan)
+    return [np.arange(length) + index for index, length in enumerate(lengths)]
+
+
+def test_entries_match_the_log(tmp_path):
+    path = str(tmp_path / "scans.log")
+    scans = write_text_log(path, [361] * 9 + [100])
+    cache = ScanCache(str(tmp_path / "cache"))
+    cache.chunk_size = 4
+
+    source = cache.open(path)
+    assert isinstance(source, CachedScanSource)
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert len(source) == len(scans)
+    assert source.config["scan_resolution"] == 0.5
+    assert source.ranges.shape[1] == 361  # sized from the scan angle and resolution
+    for message, scan in zip(source.messages(0, len(source)), scans):
+        np.testing.assert_array_equal(message.scan, scan)
+    source.close()
+
+    # the entry replaces the log's index, nothing is written next to the log
+    assert not os.path.exists(path + TextScanSource.index_extension)
+
+    cache.open(path).close()
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_longer_scans_widen_the_entry(tmp_path):
+    path = str(tmp_path / "scans.log")
+    scans = write_text_log(path, [361, 361, 401])
+    cache = ScanCache(str(tmp_path / "cache"))
+    cache.chunk_size = 2
+
+    source = cache.open(path)
+    np.testing.assert_array_equal(source.message(2).scan, scans[2])
+    np.testing.assert_array_equal(source.message(0).scan, scans[0])
+    source.close()
+
+
+def test_changed_log_is_rebuilt(tmp_path):
+    path = str(tmp_path / "scans.log")
+    write_text_log(path, [361] * 3)
+    cache = ScanCache(str(tmp_path / "cache"))
+    cache.open(path).close()
+
+    write_text_log(path, [361] * 5, start_n=10)
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1))
+    source = cache.open(path)
+    assert cache.misses == 2
+    assert len(source) == 5
+    assert source.message(0).n == 10
+    source.close()
+
+
+def test_size_limit_covers_every_log(tmp_path):
+    cache = ScanCache(str(tmp_path / "cache"))
+    paths = []
+    for name in ("a", "b", "c"):
+        directory = tmp_path / name
+        directory.mkdir()
+        paths.append(str(directory / "scans.log"))
+        write_text_log(paths[-1], [361] * 20)
+
+    cache.open(paths[0]).close()
+    entry_size = cache.size()
+    cache.max_bytes = int(entry_size * 2.5)
+    for path in paths[1:]:
+        cache.open(path).close()
+
+    assert len(cache.entries()) == 2
+    assert not os.path.isdir(cache.entry_path(paths[0]))  # least recently used
+    assert cache.size() <= cache.max_bytes
+
+
+def test_unwritable_cache_plays_the_log(tmp_path):
+    path = str(tmp_path / "scans.log")
+    write_text_log(path, [361] * 3)
+    blocker = tmp_path / "cache"
+    blocker.write_text("not a directory")
+
+    source = ScanCache(str(blocker / "entries")).open(path)
+    assert isinstance(source, TextScanSource)
+    assert len(source) == 3
+    source.close()
+
+
+def test_empty_log(tmp_path):
+    path = str(tmp_path / "empty.log")
+    open(path, 'w').close()
+    source = ScanCache(str(tmp_path / "cache")).open(path)
+    assert len(source) == 0
+    assert source.start_time == 0.0
+    source.close()
@@ -0,0 +1,129 @@
+import numpy as np
+import pytest
+
+from lms200.scanlog import ScanLogWriter, ScanLogReader, ScanLogHeader, beam_dtype, make_beams, chunk_header, \
+    config_num_values, max_num_values
+
+
+def make_scans(num_scans, num_values=361, seed=1):
+    rng = np.random.default_rng(seed)
+    scans = []
+    for n in range(num_scans):
+        # an occasional short scan, like a subrange or a truncated read
+        length = num_values if n % 7 else num_values // 2
+        scans.append((1500000000.0 + n * 0.2, n, 5.0 + n * 0.01, rng.integers(0, 8000, length)))
+    return scans
+
+
+def write_log(path, scans, **options):
+    with ScanLogWriter(path, 361, **options) as writer:
+        for scan in scans:
+            writer.write(*scan)
+
+
+def check_records(reader, scans, start=0):
+    records = reader.read(start, start + len(scans))
+    assert len(records) == len(scans)
+    for record, (timestamp, n, avg_update_hz, ranges) in zip(records, scans):
+        assert record["timestamp"] == timestamp
+        assert record["n"] == n
+        assert record["avg_update_hz"] == pytest.approx(avg_update_hz)
+        assert record["num_values"] == len(ranges)
+        np.testing.assert_array_equal(record["ranges"][:len(ranges)], ranges)
+        assert not record["ranges"][len(ranges):].any()
+
+
+@pytest.mark.parametrize("compression", [None, "zlib", "lzma"])
+def test_round_trip(tmp_path, compression):
+    path = str(tmp_path / "scans.lmsb")
+    scans = make_scans(300)
+    write_log(path, scans, chunk_size=64, compression=compression, scan_angle=180.0, scan_resolution=0.5)
+
+    with ScanLogReader(path) as reader:
+        assert len(reader) == len(scans)
+        assert len(reader.index) == 5
+        assert reader.header.compression == compression
+        assert reader.header.scan_angle == 180.0
+        assert reader.header.scan_resolution == 0.5
+        check_records(reader, scans)
+        check_records(reader, scans[60:130], start=60)  # across chunk boundaries
+        assert len(list(reader)) == len(scans)
+
+        assert reader.find_timestamp(scans[100][0]) == 100
+        assert reader.find_timestamp(scans[100][0] - 0.1) == 100
+        assert reader.find_scan_number(250) == 250
+        assert reader.find_timestamp(scans[-1][0] + 1.0) == len(scans)
+        np.testing.assert_array_equal(reader.timestamps, [scan[0] for scan in scans])
+
+
+def test_to_message(tmp_path):
+    pytest.importorskip("atlasbuggy")
+    path = str(tmp_path / "scans.lmsb")
+    scans = make_scans(10)
+    write_log(path, scans)
+
+    with ScanLogReader(path) as reader:
+        for record, (timestamp, n, avg_update_hz, ranges) in zip(reader.read(), scans):
+            message = reader.to_message(record)
+            assert message.timestamp == timestamp
+            assert message.n == n
+            assert message.avg_update_hz == pytest.approx(avg_update_hz)
+            assert not message.has_reflectivity
+            np.testing.assert_array_equal(message.ranges, ranges)
+
+
+def test_reflectivity_round_trip(tmp_path):
+    path = str(tmp_path / "beams.lmsb")
+    beams = make_beams(np.arange(361) * 10, np.arange(361) % 256)
+    with ScanLogWriter(path, 361, reflectivity=True) as writer:
+        writer.write(1.0, 1, 5.0, beams)
+        writer.write(1.2, 2, 5.0, np.arange(100))  # plain ranges get no reflectivity
+
+    with ScanLogReader(path) as reader:
+        assert reader.header.has_reflectivity
+        records = reader.read()
+        assert records["beams"].dtype == beam_dtype
+        np.testing.assert_array_equal(records[0]["beams"], beams)
+        np.testing.assert_array_equal(records[1]["beams"]["range"][:100], np.arange(100))
+        assert not records[1]["beams"]["reflectivity"].any()
+
+
+def test_unclosed_log(tmp_path):
+    path = str(tmp_path / "unclosed.lmsb")
+    scans = make_scans(150)
+    writer = ScanLogWriter(path, 361, chunk_size=64)
+    for scan in scans:
+        writer.write(*scan)
+    writer.flush()
+    # a crash in the middle of writing the next chunk
+    writer.file.write(chunk_header.pack(64, 1 << 20, True) + b"partial")
+    writer.file.flush()
+
+    with ScanLogReader(path) as reader:
+        assert reader.header.index_offset == 0
+        assert len(reader.index) == 3
+        assert len(reader) == len(scans)
+        check_records(reader, scans)
+        assert reader.find_scan_number(100) == 100
+        np.testing.assert_array_equal(reader.timestamps, [scan[0] for scan in scans])
+    writer.file.close()
+
+
+def test_rejects_unknown_flags(tmp_path):
+    path = str(tmp_path / "future.lmsb")
+    write_log(path, make_scans(1))
+    with open(path, 'r+b') as log_file:
+        header = ScanLogHeader.unpack(log_file.read(ScanLogHeader.format.size))
+        header.flags = 0x80
+        log_file.seek(0)
+        log_file.write(header.pack())
+
+    with pytest.raises(ValueError):
+        ScanLogReader(path)
+
+
+def test_config_num_values():
+    assert config_num_values(dict(scan_angle=180.0, scan_resolution=0.5)) == 361
+    assert config_num_values(dict(scan_angle=100.0, scan_resolution=0.25)) == 401
+    assert config_num_values(dict(scan_angle=180.0)) == max_num_values
+    assert config_num_values({}) == max_num_values
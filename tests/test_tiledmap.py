@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from lms200.tiledmap import TiledMap
+
+
+@pytest.fixture
+def tiled_map(tmp_path):
+    # 4 x 4 tiles of 10 pixels, 1 m each
+    tiled_map = TiledMap(str(tmp_path / "tiles"), 40, 10, 4, max_open_tiles=4)
+    yield tiled_map
+    tiled_map.close()
+
+
+def make_window():
+    return np.arange(40 * 40, dtype=np.uint16).reshape(40, 40).astype(np.uint8)
+
+
+def test_stays_put_in_the_central_tiles(tiled_map):
+    assert tiled_map.recenter_shift(1500, 2500) == (0, 0)
+    assert tiled_map.follow((1500.0, 2500.0, 10.0), None, None) == (1500.0, 2500.0, 10.0)
+    assert tiled_map.num_recenters == 0
+
+
+def test_follow_shifts_the_window(tiled_map):
+    window = make_window()
+    shifts = []
+
+    def get_window(mapbytes):
+        mapbytes[:] = window.tobytes()
+
+    def set_window(mapbytes, dx_mm, dy_mm):
+        shifts.append((dx_mm, dy_mm))
+
+    assert tiled_map.recenter_shift(3500, 500) == (1, -2)
+    pose = tiled_map.follow((3500.0, 500.0, 45.0), get_window, set_window)
+
+    assert shifts == [(1000.0, -2000.0)]
+    assert tiled_map.origin == (1, -2)
+    assert tiled_map.num_recenters == 1
+    # world coordinates don't change when the window moves
+    assert pose == (3500.0, 500.0, 45.0)
+
+    # the old top rows moved down two tiles and left one, the rest is unknown
+    np.testing.assert_array_equal(tiled_map.window[20:40, 0:30], window[0:20, 10:40])
+    assert (tiled_map.window[0:20] == tiled_map.unknown_value).all()
+    assert (tiled_map.window[:, 30:40] == tiled_map.unknown_value).all()
+
+
+def test_tiles_round_trip_through_disk(tiled_map):
+    window = make_window()
+    tiled_map.window[:] = window
+    tiled_map.store()
+    tiled_map.close()  # more tiles than max_open_tiles were written, all of them have to be on disk
+
+    tiled_map.window[:] = 0
+    tiled_map.load()
+    np.testing.assert_array_equal(tiled_map.window, window)
+
+    assert sorted(tiled_map.tile_keys()) == [(x, y) for x in range(4) for y in range(4)]
+    image, corner = tiled_map.mosaic()
+    assert corner == (0, 0)
+    np.testing.assert_array_equal(image, window)
+
+
+def test_rejects_bad_sizes(tmp_path):
+    with pytest.raises(ValueError):
+        TiledMap(str(tmp_path / "tiles"), 45, 10, 4)
+    with pytest.raises(ValueError):
+        TiledMap(str(tmp_path / "tiles"), 20, 10, 4)
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from lms200.trajectory import Trajectory
+
+
+@pytest.fixture(params=[False, True], ids=["memory", "spilled"])
+def trajectory(request, tmp_path):
+    trajectory = Trajectory(chunk_size=4, spill_path=str(tmp_path / "poses.bin") if request.param else None)
+    for index in range(10):
+        trajectory.append(float(index), index * 10.0, index * -10.0, index * 1.5)
+    yield trajectory
+    trajectory.close()
+
+
+def test_read_across_chunks(trajectory):
+    assert len(trajectory) == 10
+    poses = trajectory.read()
+    np.testing.assert_array_equal(poses["timestamp"], np.arange(10))
+    np.testing.assert_array_equal(trajectory.read(3, 9)["x_mm"], np.arange(3, 9) * 10.0)
+    assert len(trajectory.read(8, 100)) == 2
+    assert len(trajectory.read(5, 5)) == 0
+    assert trajectory.last["theta_degrees"] == 13.5
+    np.testing.assert_array_equal(trajectory.xy[2], [20.0, -20.0])
+
+
+def test_slice_time(trajectory):
+    np.testing.assert_array_equal(trajectory.slice_time(2.5, 6.0)["timestamp"], [3.0, 4.0, 5.0])
+    assert len(trajectory.slice_time(end_time=4.0)) == 4
+    assert len(trajectory.slice_time(start_time=20.0)) == 0
+
+
+def test_export(trajectory, tmp_path):
+    trajectory.export(str(tmp_path / "poses.npy"))
+    np.testing.assert_array_equal(np.load(str(tmp_path / "poses.npy")), trajectory.read())
+
+    trajectory.export(str(tmp_path / "poses.csv"))
+    rows = np.loadtxt(str(tmp_path / "poses.csv"), delimiter=",", skiprows=1)
+    np.testing.assert_allclose(rows[:, 1], trajectory.read()["x_mm"])
+
+
+def test_empty():
+    trajectory = Trajectory()
+    assert len(trajectory) == 0
+    assert trajectory.last is None
+    assert len(trajectory.read()) == 0
+    assert trajectory.find_timestamp(1.0) == 0